@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for performance sensitive parts of swadr. Run this file directly to
+execute every benchmark or pass the names of specific benchmarks as arguments.
+"""
+from __future__ import print_function
+
+import csv
+import io
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import timeit
+
+import swadr
+
+
+def best_of(function, repeat=5, number=1):
+    """
+    Return the fastest time in seconds that `number` calls to `function` took
+    out of `repeat` trials.
+    """
+    return min(timeit.repeat(function, repeat=repeat, number=number))
+
+
+def report(name, timings):
+    """
+    Print the timings of each variation of a benchmark relative to the first.
+    """
+    print(name)
+    baseline = timings[0][1]
+    for label, seconds in timings:
+        speedup = baseline / seconds
+        print("  %-26s %9.4f sec %6.2fx" % (label, seconds, speedup))
+
+
+def benchmark_detect_types():
+    """
+    Compare checking types one value at a time against checking entire columns
+    with `TypeInference.update_many` on a wide table.
+    """
+    rng = random.Random(0)
+    generators = [
+        lambda: str(rng.randint(-10 ** 6, 10 ** 6)),
+        lambda: "%0.4f" % rng.uniform(-1000, 1000),
+        lambda: rng.choice(["red", "green", "blue", ""]),
+        lambda: str(rng.randint(0, 99)) if rng.random() < 0.999 else "N/A",
+    ]
+    columns = [generators[n % len(generators)] for n in range(300)]
+    table = [[generate() for generate in columns] for _ in range(2000)]
+    typemap = swadr.SQLite3CSVImporter.typemap
+    typepatterns = swadr.SQLite3CSVImporter.typepatterns
+
+    def by_value():
+        inference = swadr.TypeInference(typemap)
+        for row in table:
+            inference.update(row)
+        return inference.types()
+
+    def by_column():
+        inference = swadr.TypeInference(typemap, typepatterns)
+        inference.update_many(table)
+        return inference.types()
+
+    assert by_value() == by_column()
+    report("detect_types: 2000 rows x 300 columns", [
+        ("value at a time", best_of(by_value)),
+        ("column at a time", best_of(by_column)),
+    ])
+
+
+def benchmark_textwidth():
+    """
+    Compare measuring every cell of a table with `wcwidth.wcswidth` twice, as
+    `pretty_print_table` used to while computing column widths and padding,
+    against measuring them once with `textwidth`. The time taken to render
+    each table with `pretty_print_table` is also reported.
+    """
+    if not swadr.WCWIDTH_SUPPORT:
+        print("textwidth: skipped; the wcwidth module is not installed")
+        return
+
+    import wcwidth
+
+    def wcswidth(text):
+        length = wcwidth.wcswidth(text)
+        return len(text) if length == -1 else length
+
+    rng = random.Random(0)
+    alphabets = [
+        ("ASCII", u"abcdefghijklmnopqrstuvwxyz0123456789 "),
+        ("mixed CJK", u"abcdefgh \u65e5\u672c\u8a9e\u4e2d\u6587\ud55c\uad6d"),
+        ("emoji", u"\U0001f600\U0001f389\U0001f680\u2764\ufe0f\U0001f44d a"),
+    ]
+    for label, alphabet in alphabets:
+        # Half of the columns hold a handful of repeated values and the other
+        # half hold values that are rarely repeated.
+        choices = ["".join(rng.choice(alphabet) for _ in range(8))
+                   for _ in range(5)]
+        table = [
+            [rng.choice(choices) if n % 2 else
+             "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 30)))
+             for n in range(10)]
+            for _ in range(5000)
+        ]
+        lines = [column for row in table for column in row]
+
+        def by_wcswidth():
+            return [wcswidth(line) for line in lines + lines]
+
+        def by_textwidth():
+            return [swadr.textwidth(line) for line in lines]
+
+        def render():
+            swadr.pretty_print_table(table, dest=io.StringIO())
+
+        report("textwidth: 5000 rows x 10 columns, %s" % label, [
+            ("wcswidth twice", best_of(by_wcswidth)),
+            ("textwidth once", best_of(by_textwidth)),
+            ("pretty_print_table", best_of(render)),
+        ])
+
+
+def benchmark_parsers():
+    """
+    Compare parsing tab-separated data with `csv.reader`, replacing empty
+    fields with `None` as the importer does, against `split_reader` which is
+    used by default. The data either has no empty fields, has an empty field
+    on one line in ten or has a quoted field on one line in a hundred.
+    """
+    rng = random.Random(0)
+    fields = ["%d" % n for n in range(1000)] + ["red", "green", "3.14159"]
+    lines = ["\t".join(rng.choice(fields) for _ in range(12)) + "\r\n"
+             for _ in range(100000)]
+    datasets = [
+        ("plain", lines),
+        ("10% empty", [line if n % 10 else "\t" + line
+                       for n, line in enumerate(lines)]),
+        ("1% quoted", [line if n % 100 else '"a\tb"\t' + line
+                       for n, line in enumerate(lines)]),
+    ]
+    dialect = csv.excel_tab
+    split_reader = swadr.SQLite3CSVImporter.split_reader
+
+    def csv_reader(data):
+        return ([value if value else None for value in row]
+                for row in csv.reader(data, dialect))
+
+    for label, data in datasets:
+        def by_csv():
+            for row in csv_reader(data):
+                pass
+
+        def by_split():
+            for row in split_reader(data, dialect):
+                pass
+
+        assert list(csv_reader(data)) == list(split_reader(data, dialect))
+        report("parsers: 100000 lines x 12 fields, %s" % label, [
+            ("csv.reader", best_of(by_csv)),
+            ("split_reader", best_of(by_split)),
+        ])
+
+
+def benchmark_typed_values():
+    """
+    Compare importing a file of mostly numeric columns while relying on
+    SQLite's type affinity against converting the values with `typed_values`.
+    """
+    rng = random.Random(0)
+    lines = ["%d,%d,%0.3f,%0.3f,%s\n" % (
+                rng.randint(0, 10 ** 6), rng.randint(-100, 100),
+                rng.uniform(0, 1000), rng.uniform(-1, 1),
+                rng.choice(["red", "green", "blue"]))
+             for _ in range(100000)]
+    tmpio = tempfile.NamedTemporaryFile(mode="w", suffix=".csv", delete=False)
+    try:
+        tmpio.write("A,B,C,D,E\n" + "".join(lines))
+        tmpio.close()
+
+        def load(typed_values):
+            dbc = sqlite3.connect(":memory:")
+            importer = swadr.SQLite3CSVImporter(dbc, typed_values=typed_values)
+            importer.loadfile(tmpio.name, "T")
+            dbc.close()
+
+        report("typed_values: 100000 rows x 5 columns", [
+            ("type affinity", best_of(lambda: load(False), repeat=3)),
+            ("typed values", best_of(lambda: load(True), repeat=3)),
+        ])
+    finally:
+        os.unlink(tmpio.name)
+
+
+def benchmark_query_split():
+    """
+    Compare splitting a script pasted into the REPL one line at a time by
+    re-splitting the incomplete text after every line with the approach
+    `query_split` used to take, which checks `sqlite3.complete_statement` for
+    every prefix ending in a semicolon, against feeding each line to a
+    `QuerySplitter`. The script is an INSERT statement spanning hundreds of
+    lines with semicolons in its string literals followed by short queries.
+    """
+    def legacy_query_split(text):
+        segments = re.split("(;)", text)
+        j = 0
+        for k in range(len(segments) + 1):
+            query = "".join(segments[j:k]).strip()
+            if query and sqlite3.complete_statement(query):
+                yield query
+                j = k
+
+        if "".join(segments[j:]).strip():
+            yield "".join(segments[j:])
+
+    lines = ["INSERT INTO t VALUES"]
+    lines.extend("  (%d, 'a;b;c')," % n for n in range(200))
+    lines.append("  (0, '');")
+    lines.extend("SELECT %d;" % n for n in range(2000))
+
+    def by_resplitting():
+        count = 0
+        linebuffer = ""
+        for line in lines:
+            linebuffer += line + "\n"
+            for query in legacy_query_split(linebuffer):
+                if sqlite3.complete_statement(query):
+                    count += 1
+                    linebuffer = ""
+                else:
+                    linebuffer = query
+        return count
+
+    def by_feeding():
+        splitter = swadr.QuerySplitter()
+        return sum(len(splitter.feed(line + "\n")) for line in lines)
+
+    assert by_resplitting() == by_feeding() == 2001
+    report("query_split: %d pasted lines" % len(lines), [
+        ("re-split every line", best_of(by_resplitting, repeat=1)),
+        ("QuerySplitter.feed", best_of(by_feeding, repeat=3)),
+    ])
+
+
+def benchmark_execute_script():
+    """
+    Compare executing a script of INSERT statements on a database file with
+    every statement committed on its own, as happens in the REPL, against
+    grouping them into transactions of 1000 statements.
+    """
+    def script(count):
+        return "CREATE TABLE t (a INTEGER, b TEXT);\n" + "".join(
+            "INSERT INTO t VALUES (%d, 'row %d');\n" % (n, n)
+            for n in range(count))
+
+    def run(text, transaction_size):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "script.sqlite3")
+        try:
+            connection = sqlite3.connect(path)
+            swadr.execute_script(connection, io.StringIO(text),
+                                 transaction_size=transaction_size)
+            connection.close()
+        finally:
+            os.unlink(path)
+            os.rmdir(directory)
+
+    # Committing every statement takes minutes for the larger script, so that
+    # is only measured with the smaller one.
+    text = script(1000)
+    report("execute_script: 1000 INSERT statements", [
+        ("1 statement per commit", best_of(lambda: run(text, 1), repeat=1)),
+        ("1000 statements per commit", best_of(lambda: run(text, 1000))),
+    ])
+    text = script(100000)
+    report("execute_script: 100000 INSERT statements", [
+        ("1000 statements per commit",
+         best_of(lambda: run(text, 1000), repeat=3)),
+    ])
+
+
+def benchmark_parallel_queries():
+    """
+    Compare running independent aggregate queries on a database file one at a
+    time on a single connection against running them with
+    `parallel_queries` on separate read-only connections.
+    """
+    rng = random.Random(0)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "parallel.sqlite3")
+    try:
+        connection = sqlite3.connect(path)
+        connection.execute("CREATE TABLE t (a INTEGER, b REAL, c TEXT)")
+        connection.executemany("INSERT INTO t VALUES (?, ?, ?)", (
+            (rng.randint(0, 10 ** 6), rng.random(), rng.choice("abcdef"))
+            for _ in range(500000)))
+        connection.commit()
+        queries = [
+            "SELECT c, COUNT(*), AVG(b) FROM t GROUP BY c",
+            "SELECT SUM(a * b) FROM t WHERE c != 'a'",
+            "SELECT COUNT(DISTINCT a) FROM t",
+            "SELECT MAX(LENGTH(a || c)), MIN(b) FROM t",
+        ]
+
+        def sequential():
+            return [connection.execute(query).fetchall() for query in queries]
+
+        def parallel(workers):
+            return [cursor.fetchall() for cursor, _, _ in
+                    swadr.parallel_queries(path, queries, workers)]
+
+        assert sequential() == parallel(4)
+        report("parallel_queries: 4 queries on 500000 rows", [
+            ("1 connection", best_of(sequential, repeat=3)),
+            ("2 workers", best_of(lambda: parallel(2), repeat=3)),
+            ("4 workers", best_of(lambda: parallel(4), repeat=3)),
+        ])
+        connection.close()
+    finally:
+        os.unlink(path)
+        os.rmdir(directory)
+
+
+def benchmark_sharded_import():
+    """
+    Compare importing a file into a single table against partitioning its
+    rows by checksum across 4 shard tables and across 4 shard databases that
+    are written concurrently.
+    """
+    rng = random.Random(0)
+    lines = ["%d,%d,%0.3f,%s\n" % (n, rng.randint(0, 10 ** 6),
+                                   rng.uniform(0, 1000),
+                                   rng.choice(["red", "green", "blue"]))
+             for n in range(200000)]
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "data.csv")
+    with open(path, "w") as iostream:
+        iostream.write("A,B,C,D\n" + "".join(lines))
+
+    def load(shard_directory=None, sharded=True):
+        database = os.path.join(directory, "import.sqlite3")
+        sharding = None
+        if sharded:
+            sharding = swadr.Sharding("A", count=4, directory=shard_directory)
+        dbc = sqlite3.connect(database)
+        importer = swadr.SQLite3CSVImporter(dbc, import_profile="bulk",
+                                            sharding=sharding)
+        importer.loadfile(path, "T")
+        dbc.close()
+        os.unlink(database)
+        if shard_directory:
+            shutil.rmtree(shard_directory)
+
+    try:
+        shards = os.path.join(directory, "shards")
+        report("sharded_import: 200000 rows x 4 columns", [
+            ("1 table", best_of(lambda: load(sharded=False), repeat=3)),
+            ("4 shard tables", best_of(load, repeat=3)),
+            ("4 shard databases", best_of(lambda: load(shards), repeat=3)),
+        ])
+    finally:
+        shutil.rmtree(directory)
+
+
+BENCHMARKS = [
+    benchmark_detect_types,
+    benchmark_textwidth,
+    benchmark_parsers,
+    benchmark_typed_values,
+    benchmark_query_split,
+    benchmark_execute_script,
+    benchmark_parallel_queries,
+    benchmark_sharded_import,
+]
+
+
+def main(names):
+    for benchmark in BENCHMARKS:
+        name = benchmark.__name__[len("benchmark_"):]
+        if not names or name in names:
+            benchmark()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,25 +2,75 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
+import base64
+import bisect
+import collections
+import contextlib
+import copy
 import csv
 import getopt
+import gzip
+import hashlib
 import io
 import itertools
+import json
+import locale
 import logging
+import marshal
+import math
+import multiprocessing.pool
 import numbers
+import operator
 import os
+import pickle
+import random
 import re
 import sqlite3
 import string
+import struct
 import sys
+import tempfile
 import textwrap
+import threading
 import time
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 try:
     import readline
 except ImportError:
     pass
 
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from functools import lru_cache
+except ImportError:
+    lru_cache = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
 try:
     import wcwidth
     WCWIDTH_SUPPORT = True
@@ -28,16 +78,475 @@ except ImportError:
     WCWIDTH_SUPPORT = False
 
 
+try:
+    clock = time.monotonic
+except AttributeError:
+    clock = time.time
+
 PYTHON_3 = sys.version_info >= (3, )
 EXIT_GENERAL_FAILURE = 1
 EXIT_DATABASE_ERROR = 2
+TEXTWIDTH_CACHE_SIZE = 4096
+OUTPUT_FLUSH_SIZE = 1 << 16
+FETCH_SIZE = 1000
+SQLITE_INTEGER_LIMIT = 1 << 63
+LEADING_ZERO_REGEX = re.compile(r"\s*[+-]?0[0-9]")
+COLUMNAR_MAGIC = b"SWADRCOL2\n"
+OUTPUT_FORMATS = ("tsv", "pretty", "csv", "jsonl", "columnar")
+NON_ASCII_REGEX = re.compile("[^\x00-\x7f]")
+SCRIPT_BLOCK_SIZE = 1 << 16
+TRANSACTION_CONTROL_REGEX = re.compile(
+    r"\s*(?:BEGIN|COMMIT|END|ROLLBACK|SAVEPOINT|RELEASE)\b", re.I)
+NON_TRANSACTIONAL_REGEX = re.compile(
+    r"\s*(?:VACUUM|ATTACH|DETACH|PRAGMA\s+(?:\w+\s*\.\s*)?journal_mode)\b",
+    re.I)
+METAQUERY_REGEX = re.compile(r"\s*(?:DESC|SHOW)", re.I)
 
 __all__ = ["PYTHON_3", "EXIT_GENERAL_FAILURE", "EXIT_DATABASE_ERROR",
-    "SQLite3CSVImporter", "pretty_print_table", "query_split",
-    "metaquery_conversion", "sqlite3_repl", "WCWIDTH_SUPPORT"]
+    "SQLite3CSVImporter", "TypeInference", "Sharding", "ImportCache",
+    "LazyTables", "CachedCursor", "ResultCache", "Profiler", "TimedCursor",
+    "pretty_print_table", "OutputBuffer", "textwidth", "fetch_rows",
+    "write_csv", "write_jsonl", "write_columnar", "read_columnar",
+    "QuerySplitter", "query_split", "execute_script", "read_only_query",
+    "parallel_queries", "metaquery_conversion",
+    "explain_query_plan", "format_query_plan", "suggest_indexes",
+    "sqlite3_repl", "WCWIDTH_SUPPORT"]
 __license__ = "BSD 2-Clause"
 
 
+class ThreadedReader(io.RawIOBase):
+    """
+    Unseekable, read-only stream that reads `source` in chunks of `chunk_size`
+    bytes from a background thread so that the work done by `source`, e.g.
+    decompression, can overlap with processing of the data already read. Up
+    to `depth` chunks are read ahead of the consumer.
+    """
+    def __init__(self, source, chunk_size=1 << 20, depth=4):
+        io.RawIOBase.__init__(self)
+        self.source = source
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(maxsize=depth)
+        self.chunk = b""
+        self.offset = 0
+        self.eof = False
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self._read_ahead)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read_ahead(self):
+        def put(item):
+            while not self.cancelled.is_set():
+                try:
+                    self.chunks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+
+            return False
+
+        try:
+            while True:
+                chunk = self.source.read(self.chunk_size)
+                if not put(chunk) or not chunk:
+                    return
+        except Exception as e:
+            put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.offset >= len(self.chunk):
+            if self.eof:
+                return 0
+
+            chunk = self.chunks.get()
+            if isinstance(chunk, Exception):
+                self.eof = True
+                raise chunk
+            elif not chunk:
+                self.eof = True
+                return 0
+
+            self.chunk = chunk
+            self.offset = 0
+
+        count = min(len(buffer), len(self.chunk) - self.offset)
+        buffer[:count] = self.chunk[self.offset:self.offset + count]
+        self.offset += count
+        return count
+
+    def close(self):
+        if not self.closed:
+            self.cancelled.set()
+            self.thread.join()
+            self.source.close()
+
+        io.RawIOBase.close(self)
+
+
+class PrefixedReader(io.RawIOBase):
+    """
+    Unseekable, read-only stream that returns the bytes `prefix` followed by
+    the contents of `source`. This puts bytes read from the start of an
+    unseekable stream back in front of the rest of it.
+    """
+    def __init__(self, prefix, source):
+        io.RawIOBase.__init__(self)
+        self.prefix = prefix
+        self.source = source
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.prefix:
+            chunk = self.prefix[:len(buffer)]
+            self.prefix = self.prefix[len(chunk):]
+        else:
+            read = getattr(self.source, "read1", self.source.read)
+            chunk = read(len(buffer))
+
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def close(self):
+        if not self.closed:
+            self.source.close()
+
+        io.RawIOBase.close(self)
+
+
+class ByteCountingLines:
+    """
+    Iterator over the lines of the binary stream `iostream` decoded using
+    `encoding` that keeps track of the `offset` just past the last line it
+    returned. A trailing line without a newline is never returned because it
+    may still be in the middle of being written.
+    """
+    def __init__(self, iostream, encoding):
+        self.iostream = iostream
+        self.encoding = encoding
+        self.offset = iostream.tell()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.iostream.readline()
+        if not line.endswith(b"\n"):
+            raise StopIteration
+
+        self.offset += len(line)
+        if PYTHON_3:
+            return line.decode(self.encoding, "surrogateescape")
+        return line
+
+    next = __next__
+
+    def seek(self, offset):
+        self.iostream.seek(offset)
+        self.offset = offset
+
+    def close(self):
+        pass
+
+
+def _sqlite_int(value):
+    """
+    Convert `value` to an integer like `int` does. Values outside the range
+    of SQLite's 64-bit INTEGER storage class are converted to floats, which
+    is what SQLite's type affinity would have stored for them. Values with
+    leading zeros are rejected since the zeros would be lost.
+    """
+    if LEADING_ZERO_REGEX.match(value):
+        raise ValueError("leading zeros in %r would be lost" % (value, ))
+
+    number = int(value)
+    if -SQLITE_INTEGER_LIMIT <= number < SQLITE_INTEGER_LIMIT:
+        return number
+
+    return _finite_float(value)
+
+
+def _sqlite_float(value):
+    """
+    Convert `value` to a float like `float` does, except values with leading
+    zeros are rejected since the zeros would be lost.
+    """
+    if LEADING_ZERO_REGEX.match(value):
+        raise ValueError("leading zeros in %r would be lost" % (value, ))
+
+    return _finite_float(value)
+
+
+def _finite_float(value):
+    """
+    Convert `value` to a float, rejecting values such as "nan" and "inf" that
+    SQLite would store as NULL or that only look like numbers.
+    """
+    number = float(value)
+    if math.isnan(number) or math.isinf(number):
+        raise ValueError("%r is not a finite number" % (value, ))
+
+    return number
+
+
+class TypeInference:
+    """
+    Incrementally infer the SQL types of the columns in a stream of rows.
+    Every column starts out untyped and is only ever widened to the first
+    entry in `typemap` whose caster accepts all of the non-empty values seen
+    so far, so rows can be fed in any order and in any number of passes.
+
+    The optional `typepatterns` dictionary maps SQL types to compiled regular
+    expressions matching a subset of the values accepted by the corresponding
+    caster, allowing `update_many` to check entire columns with a single
+    match. Types mapped to `None` are checked by passing the concatenation of
+    all values in a column to the caster which is only valid for casters that
+    accept a string if and only if they accept each of its parts.
+    """
+    def __init__(self, typemap, typepatterns=None):
+        self.typemap = typemap
+        self.typepatterns = typepatterns or dict()
+        self.levels = None
+
+    def copy(self):
+        """
+        Return an independent copy of this instance.
+        """
+        clone = TypeInference(self.typemap, self.typepatterns)
+        if self.levels is not None:
+            clone.levels = list(self.levels)
+        return clone
+
+    def widen(self, level, value):
+        """
+        Return the index of the first entry in the `typemap` at or after
+        `level` whose caster accepts `value`.
+        """
+        for index in range(max(level, 0), len(self.typemap)):
+            try:
+                self.typemap[index][1](value)
+                return index
+            except Exception:
+                pass
+
+        raise ValueError("Could not detect type of %r" % (value,))
+
+    def accepts(self, level, values):
+        """
+        Return a boolean indicating whether or not the caster at index `level`
+        of the `typemap` accepts every string in the list of `values`.
+        """
+        typedef, caster = self.typemap[level]
+        if typedef in self.typepatterns:
+            pattern = self.typepatterns[typedef]
+            text = "\n".join(values)
+            if pattern is None:
+                try:
+                    caster(text)
+                    return True
+                except Exception:
+                    return False
+
+            # Values containing newlines would throw off the match, and values
+            # the pattern does not match might still be accepted by the caster.
+            elif (text.count("\n") == len(values) - 1 and
+                  pattern.match(text)):
+                return True
+
+        try:
+            for value in values:
+                caster(value)
+            return True
+        except Exception:
+            return False
+
+    def update_many(self, rows):
+        """
+        Widen the column types as needed to accommodate the values in `rows`.
+        This is equivalent to calling `update` on each row, but the values are
+        checked a whole column at a time which is much faster for large
+        samples.
+        """
+        rows = list(rows)
+        if not rows:
+            return
+
+        width = min(len(row) for row in rows)
+        levels = self.levels
+        if levels is None:
+            self.levels = levels = [-1] * width
+        elif width < len(levels):
+            del levels[width:]
+
+        last = len(self.typemap) - 1
+        for index, column in zip(range(len(levels)), zip(*rows)):
+            if levels[index] >= last:
+                continue
+
+            values = [value for value in column if value]
+            if not values:
+                continue
+
+            for level in range(max(levels[index], 0), last + 1):
+                if self.accepts(level, values):
+                    levels[index] = level
+                    break
+            else:
+                raise ValueError("Could not detect type of %r" % (column,))
+
+    def update(self, row):
+        """
+        Widen the column types as needed to accommodate the values in `row`.
+        Like `zip`, only as many columns as the shortest row are tracked.
+        """
+        levels = self.levels
+        if levels is None:
+            self.levels = levels = [-1] * len(row)
+        elif len(row) < len(levels):
+            del levels[len(row):]
+
+        last = len(self.typemap) - 1
+        for index, value in zip(range(len(levels)), row):
+            if value and levels[index] < last:
+                levels[index] = self.widen(levels[index], value)
+
+    def types(self):
+        """
+        Return a list of the SQL types of the columns seen so far. Columns
+        that only contained empty values are typed as if they held an empty
+        string.
+        """
+        if self.levels is None:
+            return []
+
+        return [self.typemap[self.widen(level, "") if level < 0 else level][0]
+                for level in self.levels]
+
+
+class Sharding:
+    """
+    Partitioning of the rows imported into a table across several shards by
+    the value of one of its columns; see `SQLite3CSVImporter.loadfile`.
+    """
+    # SQLite's default SQLITE_MAX_ATTACHED, the number of databases that can
+    # be attached at once, which Python provides no way to query. It limits
+    # the number of shard databases of all tables stored in a directory.
+    max_attached = 10
+
+    def __init__(self, column, count=4, bounds=None, directory=None):
+        """
+        Rows are partitioned by the value of the column named `column`. When
+        `bounds`, a sorted sequence of values, is given, rows are split by
+        range: rows whose value is less than the first bound go into the
+        first shard, rows whose value is at least the first bound but less
+        than the second go into the second shard and so on, so there is one
+        more shard than there are bounds. Otherwise rows are split into
+        `count` shards by the CRC-32 checksum of their value, which does not
+        change between runs. Values of INTEGER and REAL columns are compared
+        as numbers. NULL values and values that cannot be compared with the
+        bounds go into the first shard.
+
+        The shards are tables named by `shard_name` in the importer's
+        database unless a `directory` is given, in which case every shard is a
+        database file in that directory containing a table with the original
+        name. The files are written concurrently, and each is attached to the
+        importer's database using the name of its shard as the schema name.
+        Existing shard files are replaced when the importer's database is in
+        memory or temporary; otherwise, loading the file fails like it does
+        when the table already exists.
+        SQLite only allows `max_attached` databases to be attached by default.
+        """
+        if bounds is not None:
+            bounds = list(bounds)
+            count = len(bounds) + 1
+
+        if count < 1:
+            raise ValueError("Number of shards must be positive")
+
+        self.column = column
+        self.count = count
+        self.bounds = bounds
+        self.directory = directory
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def shard_name(tablename, index):
+        """
+        Return the name of the shard of `tablename` with the given `index`.
+        """
+        return "%s_shard_%d" % (tablename, index)
+
+    def shard_path(self, tablename, index):
+        """
+        Return the path of the database file of a shard of `tablename`.
+        """
+        return os.path.join(self.directory,
+                            self.shard_name(tablename, index) + ".sqlite3")
+
+    def column_index(self, columns):
+        """
+        Return the position of the sharding column in the list of column
+        names `columns`. Names are compared case-insensitively.
+        """
+        lowered = [name.lower() for name in columns]
+        try:
+            return lowered.index(self.column.lower())
+        except ValueError:
+            raise ValueError("There is no column named %r to shard by; the "
+                             "columns are %s" % (self.column,
+                                                 ", ".join(columns)))
+
+    def partitioner(self, column_type):
+        """
+        Return a function that maps a value of the sharding column, whose type
+        is `column_type`, to the index of the shard it belongs in.
+        """
+        count = self.count
+        numeric = column_type in ("INTEGER", "REAL")
+
+        if self.bounds is None:
+            def partition(value):
+                if value is None:
+                    return 0
+                if isinstance(value, numbers.Number):
+                    value = str(value)
+                if not isinstance(value, bytes):
+                    if PYTHON_3:
+                        value = value.encode("utf-8", "surrogateescape")
+                    else:
+                        value = value.encode("utf-8")
+                return (zlib.crc32(value) & 0xffffffff) % count
+
+            return partition
+
+        if numeric:
+            try:
+                bounds = [float(bound) for bound in self.bounds]
+            except ValueError:
+                raise ValueError("Bounds of a numeric column must be numbers")
+        else:
+            bounds = self.bounds
+
+        if bounds != sorted(bounds):
+            raise ValueError("Shard bounds must be sorted")
+
+        def partition(value):
+            if value is None:
+                return 0
+            try:
+                return bisect.bisect_right(bounds, float(value) if numeric
+                                           else value)
+            except (TypeError, ValueError):
+                return 0
+
+        return partition
+
+
 class SQLite3CSVImporter:
     sniffer = csv.Sniffer()
     typemap = [
@@ -47,17 +556,233 @@ class SQLite3CSVImporter:
         ("BLOB", (lambda v: v.encode("utf-8", errors="surrogateescape"))
                   if PYTHON_3 else str),
     ]
+    typepatterns = {
+        "INTEGER": re.compile(r"(?:[+-]?[0-9]+\n)*[+-]?[0-9]+\Z"),
+        "REAL": re.compile(
+            r"(?:[+-]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][+-]?[0-9]+)?\n)*"
+            r"[+-]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][+-]?[0-9]+)?\Z"
+        ),
+        "TEXT": None,
+        "BLOB": None,
+    }
 
-    def __init__(self, dbc, ignore_errors=True, log_warnings=True):
+    # Pragmas applied for the duration of an import by each import profile.
+    # With the exception of the page size, which can only be changed before
+    # any tables are created, the original settings are restored once the
+    # import is finished.
+    import_profiles = {
+        "default": [],
+        "bulk": [
+            ("page_size", 65536),
+            ("journal_mode", "OFF"),
+            ("synchronous", "OFF"),
+            ("cache_size", -262144),
+            ("temp_store", "MEMORY"),
+            ("locking_mode", "EXCLUSIVE"),
+        ],
+    }
+    unrestorable_pragmas = ("page_size", )
+
+    sampling_methods = ("head", "reservoir", "full")
+
+    # With the "auto" parser, lines without any characters that need special
+    # handling are split on the delimiter instead of going through the csv
+    # module; the "csv" parser always uses the csv module.
+    parsers = ("auto", "csv")
+
+    # Number of rejected rows that are logged individually before only
+    # summaries are logged, and the minimum number of seconds between those
+    # summaries.
+    reject_warning_limit = 10
+    reject_summary_interval = 5
+
+    # A reject rate given by `max_reject_rate` is only enforced once this many
+    # rows of a file have been processed.
+    reject_rate_min_rows = 1000
+
+    # Functions used to convert values to the storage class of their column's
+    # type when `typed_values` is set. Values in columns of other types are
+    # inserted as they are.
+    converters = {
+        "INTEGER": _sqlite_int,
+        "REAL": _sqlite_float,
+    }
+    if PYTHON_3:
+        converters["BLOB"] = typemap[3][1]
+
+    # Types are detected with the converters when `typed_values` is set so
+    # columns containing numbers with leading zeros, like "007", are TEXT
+    # columns and keep their zeros.
+    typed_typemap = [
+        ("INTEGER", _sqlite_int),
+        ("REAL", _sqlite_float),
+    ] + typemap[2:]
+    typed_typepatterns = {
+        "INTEGER": re.compile(r"(?:[+-]?(?:0|[1-9][0-9]*)\n)*"
+                              r"[+-]?(?:0|[1-9][0-9]*)\Z"),
+        "REAL": re.compile(
+            r"(?:[+-]?(?:(?:0|[1-9][0-9]*)(?:\.[0-9]*)?|\.[0-9]+)"
+            r"(?:[eE][+-]?[0-9]+)?\n)*"
+            r"[+-]?(?:(?:0|[1-9][0-9]*)(?:\.[0-9]*)?|\.[0-9]+)"
+            r"(?:[eE][+-]?[0-9]+)?\Z"
+        ),
+        "TEXT": None,
+        "BLOB": None,
+    }
+
+    # Table used to store the position of the last record loaded from each
+    # file in incremental mode and the csv.Dialect attributes saved with it.
+    offsets_table = "swadr_import_offsets"
+    dialect_attributes = ("delimiter", "doublequote", "escapechar",
+                          "lineterminator", "quotechar", "quoting",
+                          "skipinitialspace")
+
+    # Attributes that affect the data imported from a file. These make up part
+    # of the fingerprints used by the ImportCache.
+    data_settings = ("sampling", "sample_size", "typed_values")
+
+    # Table of change counters that are incremented whenever rows are imported
+    # into a table when `track_versions` is set; see `ResultCache`.
+    versions_table = "swadr_table_versions"
+    versions_schema = ("CREATE TABLE IF NOT EXISTS %s (name TEXT PRIMARY KEY, "
+                       "version INTEGER NOT NULL)" % versions_table)
+
+    # Table of the shard databases of tables sharded into a directory; see
+    # `attach_shards`.
+    shards_table = "swadr_shards"
+    shards_schema = ("CREATE TABLE IF NOT EXISTS %s (tablename TEXT NOT NULL, "
+                     "shard INTEGER NOT NULL, path TEXT NOT NULL, "
+                     "PRIMARY KEY (tablename, shard))" % shards_table)
+
+    # Each compression format is described by its name, the magic number at
+    # the start of compressed files and a function that wraps a binary stream
+    # with a stream of the decompressed data.
+    compression_formats = [
+        ("gzip", b"\x1f\x8b", lambda f: gzip.GzipFile(fileobj=f, mode="rb")),
+    ]
+    if bz2 and PYTHON_3:
+        compression_formats.append(("bzip2", b"BZh", bz2.BZ2File))
+    if lzma:
+        compression_formats.append(("xz", b"\xfd7zXZ\x00", lzma.LZMAFile))
+    if zstandard:
+        compression_formats.append(("zstd", b"\x28\xb5\x2f\xfd", lambda f:
+            io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f))))
+
+    def __init__(self, dbc, ignore_errors=True, log_warnings=True,
+                 batch_size=1000, import_profile="default", sample_size=20,
+                 sampling="head", threaded_decompression=False,
+                 incremental=False, profiler=None, indexes=None,
+                 parser="auto", typed_values=False, reject_file=None,
+                 max_rejects=None, max_reject_rate=None, track_versions=False,
+                 sharding=None):
         """
         Setup SQLite3CSVImporter. When `ignore_errors` is set, any SQL errors
         encountered while inserting rows into the database will be ignored and,
         if `log_warnings` is set, a warning containing information about the
-        failed INSERT will be logged.
+        failed INSERT will be logged. The `batch_size` controls how many rows
+        are handed to SQLite at once; setting it to 1 inserts records one row
+        at a time. The `import_profile` is the name of an entry in
+        `import_profiles` and determines which pragmas are used while data is
+        being imported.
+
+        Column types are inferred from a sample of `sample_size` records
+        chosen using the `sampling` method: "head" uses the first records in
+        the file, "reservoir" picks records uniformly at random from the whole
+        file and "full" ignores `sample_size` and scans every record. The
+        latter two methods read the file twice, so unseekable files are copied
+        to a temporary file while they are scanned.
+
+        Compressed files are decompressed on the fly. When
+        `threaded_decompression` is set, decompression is done in a separate
+        thread so it can overlap with parsing and inserting the data.
+
+        In `incremental` mode, the byte offset and line number of the last
+        record loaded from each file is stored in the `offsets_table` of the
+        database. When the same file is loaded into the same table again, only
+        the records appended since then are imported. If the file shrank or
+        its first line changed, the table is dropped and the file is reloaded
+        in its entirety. Compressed files and standard input are always
+        reloaded.
+
+        When a `Profiler` is given as the `profiler`, the time spent detecting
+        the dialect, detecting the column types and inserting the rows of each
+        file is reported to it.
+
+        The `indexes` are a mapping of table names to lists of column name
+        sequences; see `declare_index`.
+
+        The `parser` is one of the `parsers` and determines how records are
+        split into fields; see `reader`.
+
+        When `typed_values` is set, values are converted to the storage class
+        of their column's declared type before they are inserted instead of
+        relying on SQLite's type affinity; see `convert_rows`. Numbers with
+        leading zeros and values like "nan" and "inf" are not converted, so
+        columns whose sample contains them are TEXT columns, and such values
+        in other INTEGER or REAL columns are invalid data.
+
+        Rows that cannot be inserted are counted by error class. When a
+        `reject_file` stream is given, they are also written to it as CSV
+        records; see `insert_failed`. The import of a file is aborted with a
+        `ValueError` once more than `max_rejects` of its rows or, after the
+        first `reject_rate_min_rows` rows, more than the fraction
+        `max_reject_rate` of them have been rejected. The rows of the file
+        inserted before then are rolled back, except with the "bulk"
+        `import_profile`: with the rollback journal disabled, the outcome of a
+        rollback is undefined, so the table may keep some of the rows or be
+        left corrupted.
+
+        When `track_versions` is set, the change counter of each table in the
+        `versions_table` is incremented in the same transaction that imports
+        rows into the table.
+
+        When a `Sharding` is given as `sharding`, the rows of every file are
+        partitioned across several shards; see `loadfile`. Sharding cannot be
+        combined with `incremental` mode.
         """
+        if import_profile not in self.import_profiles:
+            raise ValueError("Unknown import profile %r" % (import_profile,))
+        if sampling not in self.sampling_methods:
+            raise ValueError("Unknown sampling method %r" % (sampling,))
+        if parser not in self.parsers:
+            raise ValueError("Unknown parser %r" % (parser,))
+        if sharding and incremental:
+            raise ValueError("Sharded tables cannot be loaded incrementally")
+
         self.dbc = dbc
         self.ignore_errors = ignore_errors
         self.log_warnings = log_warnings
+        self.batch_size = batch_size
+        self.import_profile = import_profile
+        self.sample_size = sample_size
+        self.sampling = sampling
+        self.threaded_decompression = threaded_decompression
+        self.incremental = incremental
+        self.profiler = profiler
+        self.parser = parser
+        self.typed_values = typed_values
+        if typed_values:
+            self.typemap = self.typed_typemap
+            self.typepatterns = self.typed_typepatterns
+        self.reject_file = reject_file
+        self.reject_writer = reject_file and csv.writer(reject_file)
+        self.max_rejects = max_rejects
+        self.max_reject_rate = max_reject_rate
+        self.track_versions = track_versions
+        self.sharding = sharding
+        self.reject_counts = collections.Counter()
+        self.rows_processed = 0
+        self._last_reject_summary = 0
+        self.indexes = dict()
+        self._profile_depth = 0
+        self._temp_views = list()
+
+        # Header of every file parsed by this importer, or `None` for files
+        # without one, keyed by the file name.
+        self.headers = dict()
+        for tablename, indexes in (indexes or dict()).items():
+            for columns in indexes:
+                self.declare_index(tablename, columns)
 
     @classmethod
     def detect_types(cls, table):
@@ -65,28 +790,133 @@ class SQLite3CSVImporter:
         Return list of SQL type definition clauses that can safely be applied
         to each of the columns in the `table`.
         """
-        typedefs = list()
-        for column in zip(*table):
-            rows_with_content = [value for value in column if value]
-            if not rows_with_content:
-                scanned_columns = ("", )
-            else:
-                scanned_columns = rows_with_content
+        inference = TypeInference(cls.typemap, cls.typepatterns)
+        inference.update_many(table)
+        return inference.types()
 
-            for typedef, caster in cls.typemap:
-                try:
-                    for value in scanned_columns:
-                        caster(value)
-                    colschema = typedef
-                    break
-                except Exception:
-                    pass
-            else:
-                raise ValueError("Could not detect type of %r" % (column,))
+    @staticmethod
+    def split_reader(lines, dialect, batch_size=1000):
+        """
+        Return an iterator that yields the fields of each record in `lines`
+        like `csv.reader` does for the given `dialect`, except empty fields are
+        `None`, by splitting the lines on the delimiter. The lines are
+        processed `batch_size` at a time, and batches containing a quote
+        character, an escape character or a carriage return that does not end
+        a line are parsed with `csv.reader` instead, so quoted fields may
+        still span several lines. The `dialect` must not use
+        `skipinitialspace`.
+        """
+        special = [dialect.escapechar, "\r"]
+        if dialect.quoting != csv.QUOTE_NONE:
+            special.append(dialect.quotechar)
+        special = [char for char in special if char]
+        split = operator.methodcaller("split", dialect.delimiter)
+
+        def nulled(record):
+            return [value if value else None for value in record]
+
+        def split_nulled(record):
+            # Blank lines have no fields at all.
+            if len(record) == 1:
+                return []
+            return [value if value else None for value in record]
+
+        def split_records(records):
+            return [split_nulled(record) if "" in record else record
+                    for record in map(split, records)]
+
+        def batches(lines):
+            while True:
+                batch = list(itertools.islice(lines, batch_size))
+                if not batch:
+                    return
+
+                text = "".join(batch)
+                if "\r" in text:
+                    text = text.replace("\r\n", "\n")
+
+                # A carriage return that does not end a line means the lines
+                # of the batch cannot be found by splitting on newlines, so
+                # the whole batch is parsed by csv.reader which stops at the
+                # end of the batch since it does not read ahead.
+                if "\r" in text:
+                    records = list()
+                    reader = csv.reader(itertools.chain(batch, lines),
+                                        dialect)
+                    for record in reader:
+                        records.append(nulled(record))
+                        if reader.line_num >= len(batch):
+                            break
+
+                    yield records
+                    continue
+
+                lines_text = text.split("\n")
+                if text.endswith("\n"):
+                    lines_text.pop()
+
+                # Every line up to the next one containing a special character
+                # is split on the delimiter, and the record starting on that
+                # line is parsed by csv.reader.
+                records = list()
+                index = offset = 0
+                while index < len(batch):
+                    found = [position for position in
+                             (text.find(char, offset) for char in special)
+                             if position >= 0]
+                    if not found:
+                        records.extend(split_records(lines_text[index:]))
+                        break
+
+                    position = min(found)
+                    special_index = index + text.count("\n", offset, position)
+                    records.extend(split_records(
+                        lines_text[index:special_index]))
+
+                    reader = csv.reader(
+                        itertools.chain(batch[special_index:], lines), dialect)
+                    records.append(nulled(next(reader)))
+                    index = special_index + reader.line_num
+                    offset = text.rfind("\n", 0, position) + 1
+                    for _ in range(reader.line_num):
+                        offset = text.find("\n", offset) + 1
 
-            typedefs.append(typedef)
+                yield records
 
-        return typedefs
+        return itertools.chain.from_iterable(batches(iter(lines)))
+
+    def reader(self, lines, dialect):
+        """
+        Return an iterator that yields the fields of each record in `lines`
+        with empty fields replaced by `None`. When the `parser` is "auto" and
+        the `dialect` allows it, records are parsed by `split_reader`, and
+        otherwise `csv.reader` is used.
+        """
+        if self.parser == "auto" and not dialect.skipinitialspace:
+            return self.split_reader(lines, dialect)
+
+        return ([val if val else None for val in row]
+                for row in csv.reader(lines, dialect))
+
+    @staticmethod
+    def reservoir_sample(iterable, size):
+        """
+        Return a list of up to `size` items selected uniformly at random from
+        `iterable`.
+        """
+        sample = list()
+        if size < 1:
+            return sample
+
+        for count, item in enumerate(iterable):
+            if count < size:
+                sample.append(item)
+            else:
+                index = random.randint(0, count)
+                if index < size:
+                    sample[index] = item
+
+        return sample
 
     @staticmethod
     def quote_identifier(identifier):
@@ -95,17 +925,66 @@ class SQLite3CSVImporter:
         """
         return '"' + identifier.replace('"', '""') + '"'
 
-    def create_table(self, tablename, types, columns=None, if_not_exists=True):
+    @classmethod
+    def index_statement(cls, tablename, columns, schema=None):
         """
-        Create a table named `tablename` with a column named after each element
-        in `columns` with corresponding type defintions in the `types` list. If
-        `columns` is not specified, the column names will be generated
-        automatically. When `if_not_exists` is set, the "IF NOT EXISTS" infix
-        will be added to the "CREATE TABLE" query.
+        Return a CREATE INDEX statement for an index on the `columns` of
+        `tablename` in the database named `schema`, or the main database if
+        it is not specified. The name of the index is derived from the names
+        of the table and columns.
         """
-        if not types:
-            raise ValueError("Must specify types.")
+        name = re.sub(r"\W+", "_", "_".join([tablename] + list(columns)))
+        name = cls.quote_identifier(name + "_idx")
+        if schema:
+            name = cls.quote_identifier(schema) + "." + name
+
+        return "CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (
+            name,
+            cls.quote_identifier(tablename),
+            ", ".join(map(cls.quote_identifier, columns)))
+
+    def declare_index(self, tablename, columns):
+        """
+        Declare an index on the sequence of `columns` of `tablename`. Declared
+        indexes are created by `create_indexes` after the rows of the table
+        have been inserted, which is much faster than updating the index as
+        each row is inserted.
+        """
+        declared = self.indexes.setdefault(tablename.lower(), list())
+        if tuple(columns) not in declared:
+            declared.append(tuple(columns))
 
+    def create_indexes(self, tablename):
+        """
+        Create the indexes declared for `tablename` that do not exist yet.
+        When `sharding` is set, the indexes are created on every shard.
+        """
+        targets = [(tablename, None)]
+        if self.sharding:
+            names = [self.sharding.shard_name(tablename, index)
+                     for index in range(self.sharding.count)]
+            if self.sharding.directory:
+                targets = [(tablename, name) for name in names]
+            else:
+                targets = [(name, None) for name in names]
+
+        for columns in self.indexes.get(tablename.lower(), ()):
+            start = clock()
+            with self.dbc:
+                for table, schema in targets:
+                    self.dbc.execute(self.index_statement(table, columns,
+                                                          schema))
+            logging.info("Indexed %s (%s) in %0.2f sec", tablename,
+                         ", ".join(columns), clock() - start)
+
+    @staticmethod
+    def column_names(tablename, columns, count):
+        """
+        Return the names of the first `count` columns of a table named
+        `tablename` created with the header `columns`. Names are restricted to
+        "word" characters and made unique. When `columns` is not specified,
+        names are generated from the first letter of the table name.
+        """
         if not columns:
             for char in tablename:
                 if char.isalpha():
@@ -115,6 +994,7 @@ class SQLite3CSVImporter:
                 char = "n"
 
             columns = (char + str(n) for n in itertools.count(1))
+            return list(itertools.islice(columns, count))
 
         else:
             # Restrict column identifiers to "word" characters.
@@ -128,8 +1008,20 @@ class SQLite3CSVImporter:
                     column = word_column + "_" + str(base)
                 _columns.append(column)
 
-            columns = _columns
+            return _columns[:count]
+
+    def create_table(self, tablename, types, columns=None, if_not_exists=True):
+        """
+        Create a table named `tablename` with a column named after each element
+        in `columns` with corresponding type defintions in the `types` list. If
+        `columns` is not specified, the column names will be generated
+        automatically. When `if_not_exists` is set, the "IF NOT EXISTS" infix
+        will be added to the "CREATE TABLE" query.
+        """
+        if not types:
+            raise ValueError("Must specify types.")
 
+        columns = self.column_names(tablename, columns, len(types))
         columns = (self.quote_identifier(column) for column in columns)
         table = self.quote_identifier(tablename)
         body = ",\n  ".join(("%s %s" % (c, t) for c, t in zip(columns, types)))
@@ -138,103 +1030,2007 @@ class SQLite3CSVImporter:
         cursor = self.dbc.cursor()
         cursor.execute("CREATE TABLE %s%s (\n  %s\n)" % (infix, table, body))
 
-    def loadfile(self, filename, tablename, create_table=True):
+    @contextlib.contextmanager
+    def pragma_profile(self):
+        """
+        Context manager that applies the pragmas of the importer's
+        `import_profile` to the database connection and restores the original
+        settings on exit. When nested, the pragmas are only applied by the
+        outermost context.
+
+        Changing the "temp_store" setting deletes every temporary view, so the
+        temporary views of sharded tables are only created once the outermost
+        context exits.
+        """
+        pragmas = self.import_profiles[self.import_profile]
+        self._profile_depth += 1
+        try:
+            if self._profile_depth > 1 or not pragmas:
+                yield
+                return
+
+            # Most pragmas cannot be changed in the middle of a transaction.
+            self.dbc.commit()
+            cursor = self.dbc.cursor()
+            original_settings = list()
+            for pragma, value in pragmas:
+                if pragma not in self.unrestorable_pragmas:
+                    current = cursor.execute("PRAGMA " + pragma).fetchone()
+                    original_settings.append((pragma, current[0]))
+
+                logging.debug("Setting PRAGMA %s = %s", pragma, value)
+                cursor.execute("PRAGMA %s = %s" % (pragma, value))
+
+            try:
+                yield
+            finally:
+                self.dbc.commit()
+                for pragma, value in reversed(original_settings):
+                    logging.debug("Restoring PRAGMA %s = %s", pragma, value)
+                    cursor.execute("PRAGMA %s = %s" % (pragma, value))
+
+                # Leaving exclusive locking mode only releases the lock once
+                # the database is accessed again.
+                cursor.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+
+        finally:
+            self._profile_depth -= 1
+            if not self._profile_depth:
+                with self.dbc:
+                    while self._temp_views:
+                        self.dbc.execute(self._temp_views.pop(0))
+
+    def loadfile(self, filename, tablename, create_table=True,
+                 create_indexes=True):
         """
         Load a CSV file into the specified database table. When `create_table`
         is set, this method will auto-detect the CSV schema and create the
-        `tablename` if it does not already exist. Please note that this method
-        **will not** work on un-seekable files in Python 3.
+        `tablename` if it does not already exist. The number of rows inserted
+        into the table is returned. Passing "-" as the `filename` will load
+        data from standard input. When `create_indexes` is set, the indexes
+        declared for the table are created once the file has been loaded.
+
+        When `sharding` is set, the rows are partitioned across the shards it
+        describes, and a view named `tablename` that combines the shards with
+        UNION ALL is created so queries can use the table as usual. Shards
+        stored in separate databases are combined by a temporary view, which
+        only exists as long as the database connection is open, so the paths
+        of the shards are recorded in the database for `attach_shards`.
         """
-        def csv_open(path):
-            """
-            Open `path` in a manner best suited for use with csv module.
-            """
-            if PYTHON_3:
-                # https://docs.python.org/3/library/csv.html#csv.reader
-                return open(path, newline="", errors="surrogateescape")
-            else:
-                return open(path, mode="rbU")
-
-        with csv_open(filename) as iostream:
-            # Use first 20 lines to determine CSV dialect.
-            sample_lines = "".join(itertools.islice(iostream, 20))
-            dialect = self.sniffer.sniff(sample_lines)
-
-            # In Python 2, this method supports reading data from unseekable
-            # files by buffering the sampled data into a BytesIO object. I
-            # could not figure out how to get BytesIO in Python 3 to play
-            # nicely with the csv module, so I gave up supporting unseekable
-            # files in Python 3.
-            if PYTHON_3:
-                sample_reader_io = iostream
+        start = clock()
+        with self.pragma_profile():
+            if self.sharding:
+                count = self._loadfile_sharded(filename, tablename)
+            elif self.incremental:
+                count = self._loadfile_incremental(filename, tablename,
+                                                   create_table)
             else:
-                sample_reader_io = io.BytesIO(sample_lines)
+                with self.parse(filename) as (schema, records):
+                    count = self.insert(filename, tablename, schema, records,
+                                        create_table)
 
-            # Read the first 20 CSV records.
-            sample_reader_io.seek(0)
-            sample_reader = csv.reader(sample_reader_io, dialect)
-            sample_rows = list(itertools.islice(sample_reader, 20))
+            logging.info("Loaded %s into %s in %0.2f sec (%s import profile)",
+                         filename, tablename, clock() - start,
+                         self.import_profile)
 
-            # Figure out the table schema using the sniffed records.
-            sample_reader_io.seek(0)
-            types_with_row_one = self.detect_types(sample_rows)
-            types_sans_row_one = self.detect_types(sample_rows[1:])
-            has_header = types_sans_row_one != types_with_row_one
-            types = types_sans_row_one or types_with_row_one
+            if create_indexes:
+                self.create_indexes(tablename)
 
-            if has_header:
+        return count
+
+    def _loadfile_incremental(self, filename, tablename, create_table):
+        """
+        Load the records in `filename` that were added since the last time it
+        was loaded into `tablename`. See `incremental` in `__init__`.
+        """
+        path = os.path.abspath(filename)
+        cursor = self.dbc.cursor()
+        with self.dbc:
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS %s (\n"
+                "  path TEXT,\n"
+                "  tablename TEXT,\n"
+                "  offset INTEGER,\n"
+                "  lineno INTEGER,\n"
+                "  header_hash TEXT,\n"
+                "  dialect TEXT,\n"
+                "  width INTEGER,\n"
+                "  PRIMARY KEY (path, tablename)\n"
+                ")" % self.offsets_table)
+
+        if filename == "-":
+            # Standard input cannot be resumed, so it is always reloaded and
+            # no state is kept for it.
+            logging.info("Reloading %s from standard input", tablename)
+            with self.dbc:
+                cursor.execute("DROP TABLE IF EXISTS %s" %
+                               self.quote_identifier(tablename))
+                cursor.execute("DELETE FROM %s WHERE path = ? AND "
+                               "tablename = ?" % self.offsets_table,
+                               (path, tablename))
+            with self.parse(filename) as (schema, records):
+                return self.insert(filename, tablename, schema, records,
+                                   create_table)
+
+        with open(filename, "rb") as iostream:
+            header_hash = hashlib.sha1(iostream.readline()).hexdigest()
+
+        query = ("SELECT offset, lineno, header_hash, dialect, width FROM %s "
+                 "WHERE path = ? AND tablename = ?" % self.offsets_table)
+        state = cursor.execute(query, (path, tablename)).fetchone()
+        resume = None
+        if state:
+            offset, lineno, previous_hash, dialect, width = state
+            table_exists = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND "
+                "name = ?", (tablename, )).fetchone()
+
+            if (not table_exists or offset is None or
+                    header_hash != previous_hash or
+                    os.path.getsize(filename) < offset):
+                logging.info("%s was truncated or replaced; reloading %s",
+                             filename, tablename)
+                with self.dbc:
+                    cursor.execute("DROP TABLE IF EXISTS %s" %
+                                   self.quote_identifier(tablename))
+                    cursor.execute("DELETE FROM %s WHERE path = ? AND "
+                                   "tablename = ?" % self.offsets_table,
+                                   (path, tablename))
+            else:
+                resume = {
+                    "offset": offset,
+                    "lineno": lineno,
+                    "dialect": type("Dialect", (csv.Dialect, ),
+                                    json.loads(dialect)),
+                    "width": width,
+                }
+                logging.info("Resuming %s from line %d", filename, lineno)
+
+        position = [resume["lineno"] if resume else 0]
+
+        def tracked(records):
+            for record in records:
+                position[0] = record[0]
+                yield record
+
+        with self.parse(filename, resume) as (schema, records):
+            def save_state(cursor):
+                stream = schema["stream"]
+                offset = getattr(stream, "offset", None)
+                dialect = dict((name, getattr(schema["dialect"], name))
+                               for name in self.dialect_attributes)
+                cursor.execute(
+                    "INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?, ?, ?)" %
+                    self.offsets_table,
+                    (path, tablename, offset, position[0], header_hash,
+                     json.dumps(dialect), schema["width"]))
+
+            return self.insert(filename, tablename, schema, tracked(records),
+                               create_table and not resume, save_state)
+
+    def _loadfile_sharded(self, filename, tablename):
+        """
+        Load the records in `filename` into the shards of `tablename` and
+        create the view that combines them. See `sharding` in `loadfile`.
+        Shard tables in the database are written by `insert`, and shard
+        databases are written by `_insert_shards`.
+        """
+        sharding = self.sharding
+        names = [sharding.shard_name(tablename, index)
+                 for index in range(sharding.count)]
+        view = self.quote_identifier(tablename)
+        cursor = self.dbc.cursor()
+        existing = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND "
+            "name = ? COLLATE NOCASE", (tablename, )).fetchone()
+        if existing:
+            raise ValueError("Cannot shard %s into %s since a table with that "
+                             "name already exists; drop it or load the file "
+                             "into another table" % (filename, tablename))
+
+        if sharding.directory:
+            paths = [sharding.shard_path(tablename, index)
+                     for index in range(sharding.count)]
+            databases = dict((row[1], row[2]) for row in
+                             cursor.execute("PRAGMA database_list"))
+            existing = [path for path in paths if os.path.exists(path)]
+            # Shard databases left behind by an earlier run are only replaced
+            # when the database they belonged to is gone with it.
+            if existing and (databases.get("main") or
+                             any(name in databases for name in names)):
+                raise ValueError("Cannot shard %s into %s since its shard "
+                                 "databases already exist in %s; delete them "
+                                 "or load the file into another table" %
+                                 (filename, tablename, sharding.directory))
+
+            for path in existing:
+                for suffix in ("", "-journal", "-wal", "-shm"):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+
+        with self.parse(filename) as (schema, records):
+            columns = self.column_names(tablename, schema["columns"],
+                                        schema["width"])
+            try:
+                column_index = sharding.column_index(columns)
+            except ValueError as exc:
+                raise ValueError("Cannot shard %s: %s" % (filename, exc))
+            partition = sharding.partitioner(schema["types"][column_index])
+
+            # Rows that are too short go into the first shard, which rejects
+            # them like any other table would.
+            def route(row):
+                if column_index < len(row):
+                    return partition(row[column_index])
+                return 0
+
+            if sharding.directory:
+                start = clock()
+                count = self._insert_shards(filename, tablename, schema,
+                                            records, route)
+
+                self.dbc.commit()
+                paths = [os.path.abspath(sharding.shard_path(tablename, index))
+                         for index in range(sharding.count)]
+                self._temp_views.append(
+                    self._attach_shards(tablename, paths))
+
+                # Shards of databases stored in files are recorded so later
+                # runs can attach them again; see `attach_shards`.
+                with self.dbc:
+                    if databases.get("main"):
+                        cursor.execute(self.shards_schema)
+                        cursor.executemany(
+                            "INSERT OR REPLACE INTO %s VALUES (?, ?, ?)" %
+                            self.shards_table,
+                            [(tablename, index, path)
+                             for index, path in enumerate(paths)])
+                    if self.track_versions:
+                        self.bump_version(cursor, tablename)
+
+                if self.profiler:
+                    self.profiler.report("load", count, file=filename,
+                                         table=tablename,
+                                         insert=clock() - start,
+                                         **schema["timings"])
+                return count
+
+            selects = ("SELECT * FROM %s" % self.quote_identifier(name)
+                       for name in names)
+            with self.dbc:
+                for name in names:
+                    self.create_table(name, columns=schema["columns"],
+                                      types=schema["types"])
+                cursor.execute("CREATE VIEW IF NOT EXISTS %s AS %s" %
+                               (view, " UNION ALL ".join(selects)))
+
+            return self.insert(filename, tablename, schema, records,
+                               create_table=False, partition=(names, route))
+
+    def _attach_shards(self, tablename, paths):
+        """
+        Attach the shard databases of `tablename` at `paths` that are not
+        attached yet and return the statement that creates the temporary view
+        combining them.
+        """
+        cursor = self.dbc.cursor()
+        names = [Sharding.shard_name(tablename, index)
+                 for index in range(len(paths))]
+        attached = set(row[1] for row in
+                       cursor.execute("PRAGMA database_list"))
+        for name, path in zip(names, paths):
+            if name not in attached:
+                schema_name = self.quote_identifier(name)
+                cursor.execute("ATTACH DATABASE ? AS %s" % schema_name,
+                               (path, ))
+                # An exclusive locking mode set by the import profile would
+                # otherwise keep the shards locked, and the lock is only
+                # released once the shard is accessed.
+                cursor.execute("PRAGMA %s.locking_mode = NORMAL" % schema_name)
+                cursor.execute("SELECT COUNT(*) FROM %s.sqlite_master" %
+                               schema_name).fetchone()
+
+        view = self.quote_identifier(tablename)
+        selects = ("SELECT * FROM %s.%s" % (self.quote_identifier(name), view)
+                   for name in names)
+        return "CREATE TEMP VIEW IF NOT EXISTS %s AS %s" % (
+            view, " UNION ALL ".join(selects))
+
+    def attach_shards(self):
+        """
+        Attach the shard databases recorded in the `shards_table` by earlier
+        imports into the database and create the temporary views that combine
+        them, so tables sharded into a directory can be queried by later runs
+        just like by the run that imported them. Tables whose shards cannot
+        be attached are skipped with a warning. The names of the tables whose
+        views were created are returned.
+        """
+        cursor = self.dbc.cursor()
+        recorded = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (self.shards_table, )).fetchone()
+        if not recorded:
+            return list()
+
+        shards = cursor.execute("SELECT tablename, path FROM %s ORDER BY "
+                                "tablename, shard" % self.shards_table)
+        tables = list()
+        for tablename, rows in itertools.groupby(shards.fetchall(),
+                                                 operator.itemgetter(0)):
+            paths = [path for _, path in rows]
+            missing = [path for path in paths if not os.path.exists(path)]
+            if missing:
+                logging.warning("Cannot attach the shards of %s since %s no "
+                                "longer exists", tablename, missing[0])
+                continue
+
+            try:
+                with self.dbc:
+                    self.dbc.execute(self._attach_shards(tablename, paths))
+            except sqlite3.OperationalError as exc:
+                logging.warning("Cannot attach the shards of %s: %s",
+                                tablename, exc)
+                continue
+
+            logging.debug("Attached the %d shards of %s", len(paths),
+                          tablename)
+            tables.append(tablename)
+
+        return tables
+
+    def _insert_shards(self, filename, tablename, schema, records, route):
+        """
+        Insert `records` into the shard databases of `tablename` and return
+        the number of rows inserted. Each shard is written by its own thread
+        and connection while this thread uses `route` to map the parameters
+        of each record to the index of its shard. The shards only commit once
+        every one of them has inserted its rows; when any shard fails, all of
+        them roll back and the error is raised.
+        """
+        sharding = self.sharding
+        cancelled = threading.Event()
+        finished = threading.Condition()
+        ready = [0]
+        errors = list()
+        importers = list()
+        pipes = [queue.Queue(maxsize=4) for _ in range(sharding.count)]
+
+        def put(pipe, chunk):
+            while not cancelled.is_set():
                 try:
-                    next(sample_reader)
-                except StopIteration:
+                    pipe.put(chunk, timeout=0.1)
+                    return
+                except queue.Full:
                     pass
+
+        def receive(pipe):
+            while True:
+                try:
+                    chunk = pipe.get(timeout=0.1)
+                except queue.Empty:
+                    if cancelled.is_set():
+                        raise ValueError("Import of another shard failed")
+                    continue
+
+                if not chunk:
+                    return
+
+                for record in chunk:
+                    yield record
+
+        def before_commit(cursor):
+            with finished:
+                ready[0] += 1
+                finished.notify_all()
+                while ready[0] < sharding.count and not cancelled.is_set():
+                    finished.wait(0.1)
+
+            if cancelled.is_set():
+                raise ValueError("Import of another shard failed")
+
+        def write(index):
+            dbc = sqlite3.connect(sharding.shard_path(tablename, index))
+            try:
+                # Every shard is written by a copy of this importer with the
+                # same settings and its own connection and reject counters.
+                importer = copy.copy(self)
+                importer.dbc = dbc
+                importer.sharding = None
+                importer.profiler = None
+                importer.track_versions = False
+                importer.reject_counts = collections.Counter()
+                importer._profile_depth = 0
+                importer._temp_views = list()
+                importers.append(importer)
+                with importer.pragma_profile():
+                    return importer.insert(filename, tablename, schema,
+                                           receive(pipes[index]),
+                                           before_commit=before_commit)
+            except Exception as e:
+                # Only the first error is reported since the other shards
+                # fail because of it.
+                with finished:
+                    if not cancelled.is_set():
+                        errors.append(e)
+                    cancelled.set()
+                raise
+            finally:
+                dbc.close()
+
+        pool = multiprocessing.pool.ThreadPool(sharding.count)
+        results = [pool.apply_async(write, (index, ))
+                   for index in range(sharding.count)]
+        pool.close()
+
+        try:
+            batch_size = max(1, self.batch_size or 1)
+            chunks = [list() for _ in pipes]
+            for record in records:
+                if cancelled.is_set():
+                    break
+
+                index = route(record[1])
+                chunks[index].append(record)
+                if len(chunks[index]) >= batch_size:
+                    put(pipes[index], chunks[index])
+                    chunks[index] = list()
+
+            for pipe, chunk in zip(pipes, chunks):
+                if chunk:
+                    put(pipe, chunk)
+                put(pipe, list())
+
+        except BaseException:
+            cancelled.set()
+            raise
+
+        finally:
+            pool.join()
+
+        self.reject_counts.clear()
+        for importer in importers:
+            self.reject_counts.update(importer.reject_counts)
+
+        if errors:
+            raise errors[0]
+
+        return sum(result.get() for result in results)
+
+    def loadfiles(self, files, workers=1, create_indexes=True):
+        """
+        Load every `(filename, tablename)` pair in `files` into the database
+        and return a list containing the number of rows inserted from each
+        file. When `workers` is greater than 1, up to that many files are read
+        and parsed concurrently by a pool of threads. The parsed rows are
+        streamed to this thread in batches and written to the database in the
+        same order and with the same error handling as calling `loadfile` on
+        each file in turn. Files are always loaded one at a time in
+        incremental mode or when `sharding` is set. When `create_indexes` is
+        set, the indexes declared for each table are created after the last
+        file loaded into that table.
+        """
+        last_loads = dict((tablename.lower(), index)
+                          for index, (_, tablename) in enumerate(files))
+
+        def loaded(index, tablename):
+            if create_indexes and last_loads[tablename.lower()] == index:
+                self.create_indexes(tablename)
+
+        with self.pragma_profile():
+            # The shards of sharded tables are already written concurrently,
+            # and incremental imports need the state saved by earlier ones.
+            if (workers < 2 or len(files) < 2 or self.sharding or
+                    self.incremental):
+                counts = list()
+                for index, (filename, tablename) in enumerate(files):
+                    counts.append(self.loadfile(filename, tablename,
+                                                create_indexes=False))
+                    loaded(index, tablename)
+
+                return counts
+
+            # Each file gets a bounded queue so parsers cannot get too far
+            # ahead of the database writer.
+            cancelled = threading.Event()
+            pipes = [queue.Queue(maxsize=4) for _ in files]
+            pool = multiprocessing.pool.ThreadPool(workers)
+            for (filename, _), pipe in zip(files, pipes):
+                pool.apply_async(self._parse_into, (filename, pipe, cancelled))
+            pool.close()
+
+            try:
+                counts = list()
+                for index, (filename, tablename) in enumerate(files):
+                    counts.append(self._insert_from(filename, tablename,
+                                                    pipes[index]))
+                    loaded(index, tablename)
+
+                return counts
+
+            finally:
+                cancelled.set()
+                pool.join()
+
+    def _parse_into(self, filename, pipe, cancelled):
+        """
+        Parse `filename` and feed its schema followed by batches of records
+        into the `pipe` queue. Exceptions are passed through the queue for the
+        reading thread to raise. Parsing stops early once `cancelled` is set.
+        """
+        def put(kind, value):
+            while not cancelled.is_set():
+                try:
+                    pipe.put((kind, value), timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+
+            return False
+
+        try:
+            if cancelled.is_set():
+                return
+
+            with self.parse(filename) as (schema, records):
+                if not put("schema", schema):
+                    return
+
+                batch_size = max(1, self.batch_size or 1)
+                while True:
+                    chunk = list(itertools.islice(records, batch_size))
+                    if not put("records", chunk) or not chunk:
+                        return
+
+        except Exception as e:
+            put("error", e)
+
+    def _insert_from(self, filename, tablename, pipe):
+        """
+        Insert the records that `_parse_into` sends through `pipe` into the
+        `tablename` table and return the number of rows inserted.
+        """
+        start = clock()
+
+        def receive():
+            kind, value = pipe.get()
+            if kind == "error":
+                raise value
+            return value
+
+        def records():
+            while True:
+                chunk = receive()
+                if not chunk:
+                    return
+
+                for record in chunk:
+                    yield record
+
+        count = self.insert(filename, tablename, receive(), records())
+        logging.info("Loaded %s into %s in %0.2f sec (%s import profile)",
+                     filename, tablename, clock() - start, self.import_profile)
+        return count
+
+    @contextlib.contextmanager
+    def csv_open(self, path):
+        """
+        Context manager that opens `path` in a manner best suited for use with
+        the csv module and yields a tuple containing the opened stream and a
+        boolean indicating whether or not the stream can be rewound. When
+        `path` is "-", standard input is read instead. Files compressed with
+        one of the `compression_formats` are recognized by their magic number
+        and decompressed while they are read, and when `threaded_decompression`
+        is set, decompression is done in a separate thread.
+        """
+        if path == "-":
+            raw = io.open(sys.stdin.fileno(), mode="rb", closefd=False)
+        else:
+            raw = io.open(path, mode="rb")
+
+        streams = [raw]
+        try:
+            seekable = raw.seekable()
+            if seekable:
+                magic = raw.peek(8)
+            else:
+                # A peek at a pipe only returns what a single read produced,
+                # which may be shorter than the magic numbers.
+                magic = raw.read(8)
+                streams.append(io.BufferedReader(PrefixedReader(magic, raw)))
+
+            for name, signature, decompressor in self.compression_formats:
+                if magic.startswith(signature):
+                    logging.debug("Decompressing %s as %s", path, name)
+                    streams.append(decompressor(streams[-1]))
+                    if self.threaded_decompression:
+                        reader = ThreadedReader(streams[-1])
+                        streams.append(io.BufferedReader(reader))
+                        seekable = False
+                    break
+
+            # Byte offsets are only meaningful for uncompressed files.
+            if (self.incremental and len(streams) == 1 and seekable and
+                    path != "-"):
+                encoding = locale.getpreferredencoding(False)
+                streams.append(ByteCountingLines(raw, encoding))
+            elif PYTHON_3:
+                # https://docs.python.org/3/library/csv.html#csv.reader
+                streams.append(io.TextIOWrapper(streams[-1], newline="",
+                                                errors="surrogateescape"))
+            elif len(streams) == 1 and path != "-":
+                raw.close()
+                streams = [open(path, mode="rbU")]
+
+            yield streams[-1], seekable
+
+        finally:
+            for stream in reversed(streams):
+                stream.close()
+
+    @contextlib.contextmanager
+    def parse(self, filename, resume=None):
+        """
+        Context manager that opens `filename`, detects the CSV dialect and
+        schema of its contents and yields a `(schema, records)` tuple. The
+        `schema` is a dictionary with the keys "columns", a list of column
+        names taken from the header or `None` if the file has no header,
+        "types", the detected SQL type of each column, and "width", the number
+        of fields in the first record. The `records` are an iterator of
+        `(line_number, parameters)` pairs ready to be inserted into the
+        database. The schema also contains the "dialect" of the file and the
+        "stream" the records are read from and "timings", the number of
+        seconds spent detecting the dialect ("sniff") and the column types
+        ("detect"). Parsing does not touch the database, so this method may be
+        used from other threads.
+
+        When `resume` is given, it must be a dictionary with the keys "offset",
+        the byte offset in the file parsing should resume from, "lineno", the
+        line number of the last record that was parsed, and "dialect" and
+        "width" which are the same as in the schema of the original import.
+        The "columns" and "types" of the schema will then be `None`.
+        """
+        with self.csv_open(filename) as (iostream, seekable):
+            if resume:
+                iostream.seek(resume["offset"])
+                rowgen = self.reader(iostream, resume["dialect"])
+                records = enumerate(rowgen, resume["lineno"] + 1)
+                schema = {
+                    "columns": None,
+                    "types": None,
+                    "width": resume["width"],
+                    "dialect": resume["dialect"],
+                    "stream": iostream,
+                    "timings": {},
+                }
+                yield schema, records
+                return
+
+            # Use first 20 lines to determine CSV dialect. The lines are kept
+            # in memory and chained with the rest of the stream so the file
+            # never needs to be rewound.
+            start = clock()
+            sample_lines = list(itertools.islice(iostream, 20))
+            dialect = self.sniffer.sniff("".join(sample_lines))
+            lines = itertools.chain(sample_lines, iostream)
+            sniffed = clock()
+
+            # Sampling records from the whole file requires reading it twice,
+            # so the contents of unseekable files are spooled to a temporary
+            # file as they are scanned.
+            spool = None
+            if self.sampling != "head" and not seekable:
+                if PYTHON_3:
+                    spool = tempfile.TemporaryFile(
+                        mode="w+", newline="", errors="surrogateescape")
+                else:
+                    spool = tempfile.TemporaryFile(mode="w+b")
+
+                def spooled(lines):
+                    for line in lines:
+                        spool.write(line)
+                        yield line
+
+                lines = spooled(lines)
+
+            reader = self.reader(lines, dialect)
+            try:
+                first_row = next(reader)
+            except StopIteration:
+                raise ValueError("%s does not contain any records" % filename)
+
+            # Infer the column types of every record except the first one,
+            # which may be a header, from a sample of the file.
+            inference = TypeInference(self.typemap, self.typepatterns)
+            if self.sampling == "head":
+                sample = itertools.islice(reader, max(self.sample_size - 1, 0))
+                sample_rows = list(sample)
+                inference.update_many(sample_rows)
+                rowgen = itertools.chain(sample_rows, reader)
+
+            else:
+                if self.sampling == "full":
+                    while True:
+                        chunk = list(itertools.islice(reader, 10000))
+                        if not chunk:
+                            break
+                        inference.update_many(chunk)
+
+                else:
+                    sample_rows = self.reservoir_sample(reader,
+                                                        self.sample_size - 1)
+                    inference.update_many(sample_rows)
+
+                rewound = spool or iostream
+                rewound.seek(0)
+                rowgen = self.reader(rewound, dialect)
+                next(rowgen)
+
+            # Since column types can only be widened, the types of the
+            # complete sample are the types of the other records widened to
+            # accommodate the first record.
+            types_sans_row_one = inference.types()
+            inference.update(first_row)
+            types_with_row_one = inference.types()
+            has_header = types_sans_row_one != types_with_row_one
+            types = types_sans_row_one or types_with_row_one
+
+            if has_header:
                 first_line_number = 2
-                columns = sample_rows[0]
+                columns = [column or "" for column in first_row]
+
+            else:
+                first_line_number = 1
+                columns = None
+                rowgen = itertools.chain([first_row], rowgen)
+
+            self.headers[filename] = columns
+            records = enumerate(rowgen, first_line_number)
+            schema = {
+                "columns": columns,
+                "types": types,
+                "width": len(first_row),
+                "dialect": dialect,
+                "stream": rewound if self.sampling != "head" else iostream,
+                "timings": {
+                    "sniff": sniffed - start,
+                    "detect": clock() - sniffed,
+                },
+            }
+
+            try:
+                yield schema, records
+            finally:
+                if spool:
+                    spool.close()
+
+    def insert(self, filename, tablename, schema, records, create_table=True,
+               before_commit=None, partition=None):
+        """
+        Insert `records` parsed from `filename` into `tablename` and return the
+        number of rows inserted. When `create_table` is set, the table is
+        created using the `schema` if it does not already exist. See `parse`
+        for a description of `schema` and `records`. If `before_commit` is
+        specified, it is called with a cursor once all records have been
+        inserted but before the transaction is committed. When `partition` is
+        a `(tables, route)` pair, every row is inserted into the table in the
+        list `tables` at the index `route` returns for its parameters instead
+        of into `tablename`.
+        """
+        start = clock()
+        tables = [tablename]
+        route = None
+        if partition:
+            tables, route = partition
+
+        with self.dbc:
+            cursor = self.dbc.cursor()
+            if create_table:
+                for name in tables:
+                    self.create_table(name, columns=schema["columns"],
+                                      types=schema["types"])
+
+            table = self.quote_identifier(tables[0])
+            binds = ", ".join("?" * schema["width"])
+            queries = ["INSERT INTO %s VALUES (%s)" % (
+                           self.quote_identifier(name), binds)
+                       for name in tables]
+
+            # The types are read back from the table so records appended to
+            # existing tables are converted using the declared column types.
+            converters = None
+            if self.typed_values:
+                info = cursor.execute("PRAGMA table_info(%s)" % table)
+                types = [row[2].upper() for row in info]
+                if len(types) == schema["width"]:
+                    converters = [self.converters.get(t) for t in types]
+
+            try:
+                original_text_factory = self.dbc.text_factory
+                if not PYTHON_3:
+                    self.dbc.text_factory = str
+
+                if route:
+                    count = self.insert_rows(cursor, queries, records,
+                                             filename, converters, route)
+                else:
+                    count = self.insert_rows(cursor, queries[0], records,
+                                             filename, converters)
+                if self.track_versions:
+                    self.bump_version(cursor, tablename)
+                if before_commit:
+                    before_commit(cursor)
+
+            finally:
+                self.dbc.text_factory = original_text_factory
+
+        if self.profiler:
+            self.profiler.report("load", count, file=filename, table=tablename,
+                                 insert=clock() - start, **schema["timings"])
+
+        return count
+
+    @classmethod
+    def bump_version(cls, cursor, tablename):
+        """
+        Increment the change counter of `tablename` in the `versions_table`.
+        """
+        cursor.execute(cls.versions_schema)
+        cursor.execute("INSERT OR IGNORE INTO %s VALUES (?, 0)" %
+                       cls.versions_table, (tablename.lower(), ))
+        cursor.execute("UPDATE %s SET version = version + 1 WHERE name = ?" %
+                       cls.versions_table, (tablename.lower(), ))
+
+    def insert_rows(self, cursor, query, records, filename, converters=None,
+                    route=None):
+        """
+        Execute the INSERT `query` for every `(line_number, parameters)` pair
+        in `records` and return the number of rows inserted. Rows are sent to
+        SQLite in chunks of `batch_size` using `executemany`. When a chunk
+        fails, the offending row is reported and the remainder of that chunk is
+        inserted one row at a time so every invalid row is still handled
+        individually and identified by the `filename` and line number it came
+        from. When `converters` are given, each chunk is converted with
+        `convert_rows` before it is inserted. When `route` is given, `query`
+        is a list of queries, and each row is inserted by the query at the
+        index `route` returns for its parameters.
+        """
+        batch_size = max(1, self.batch_size or 1)
+        inserted = 0
+        self.reject_counts.clear()
+        self.rows_processed = 0
+        self._last_reject_summary = clock()
+        while True:
+            chunk = list(itertools.islice(records, batch_size))
+            if not chunk:
+                if self.reject_counts and self.log_warnings:
+                    self.log_rejects(filename)
+                return inserted
+
+            self.rows_processed += len(chunk)
+
+            if converters:
+                chunk = self.convert_rows(chunk, converters, filename)
+                if not chunk:
+                    continue
+
+            if route:
+                groups = [list() for _ in query]
+                for record in chunk:
+                    groups[route(record[1])].append(record)
+                groups = [pair for pair in zip(query, groups) if pair[1]]
+            else:
+                groups = [(query, chunk)]
+
+            for shard_query, group in groups:
+                # Keep track of the last row handed to executemany so the row
+                # that caused an exception can be identified.
+                position = [-1]
+
+                def parameters():
+                    for position[0], (lineno, row) in enumerate(group):
+                        yield row
+
+                logging.debug("Inserting rows %d through %d", group[0][0],
+                              group[-1][0])
+                try:
+                    cursor.executemany(shard_query, parameters())
+                    inserted += len(group)
+                    continue
+                except Exception as e:
+                    failed = position[0]
+                    if failed >= 0:
+                        inserted += failed
+                        self.insert_failed(e, filename, *group[failed])
+
+                for lineno, row in group[failed + 1:]:
+                    logging.debug("Inserting row: %r", row)
+                    try:
+                        cursor.execute(shard_query, row)
+                        inserted += 1
+                    except Exception as e:
+                        self.insert_failed(e, filename, lineno, row)
+
+    def convert_rows(self, chunk, converters, filename):
+        """
+        Convert the values of the rows in `chunk`, a list of `(line_number,
+        parameters)` pairs parsed from `filename`, and return the list of
+        converted pairs. The `converters` contain a function or `None` for
+        each column. Every column is converted with one call to `map`; if that
+        fails, the values of the column are converted one at a time and the
+        rows that cannot be converted are passed to `insert_failed` and left
+        out. `None` is never converted, and rows with the wrong number of
+        fields are returned as they are so they fail when they are inserted.
+        """
+        width = len(converters)
+        positions = [position for position, (_, row) in enumerate(chunk)
+                     if len(row) == width]
+        columns = list(zip(*[chunk[n][1] for n in positions]))
+        if not columns:
+            return chunk
+
+        rejected = set()
+        for index, convert in enumerate(converters):
+            if convert is None:
+                continue
+
+            values = columns[index]
+            try:
+                if None in values:
+                    columns[index] = [None if value is None else convert(value)
+                                      for value in values]
+                else:
+                    columns[index] = list(map(convert, values))
+                continue
+            except (ValueError, UnicodeError):
+                pass
+
+            converted = list()
+            for position, value in zip(positions, values):
+                try:
+                    value = None if value is None else convert(value)
+                except (ValueError, UnicodeError) as e:
+                    if position not in rejected:
+                        rejected.add(position)
+                        exc = ValueError("Column %d: %s" % (index + 1, e))
+                        self.insert_failed(exc, filename, *chunk[position])
+                converted.append(value)
+
+            columns[index] = converted
+
+        converted_chunk = list(chunk)
+        for position, row in zip(positions, zip(*columns)):
+            converted_chunk[position] = (chunk[position][0], row)
+
+        return [pair for position, pair in enumerate(converted_chunk)
+                if position not in rejected]
+
+    def insert_failed(self, exc, filename, lineno, row=None):
+        """
+        Handle an exception raised while inserting the `row` found on line
+        `lineno` of `filename`. The row is counted under the name of the
+        exception's class and, if there is a `reject_file`, written to it as a
+        CSV record containing the file name, line number, error class, error
+        message and the fields of the row. Depending on the importer's
+        settings, the exception will then be re-raised, logged as a warning or
+        ignored. Only the first `reject_warning_limit` rows of each file are
+        logged individually; after that, a summary of the rejected rows is
+        logged at most once every `reject_summary_interval` seconds.
+        """
+        kind = type(exc).__name__
+        self.reject_counts[kind] += 1
+        if self.reject_writer:
+            fields = ["" if value is None else value for value in row or ()]
+            self.reject_writer.writerow([filename, lineno, kind, str(exc)] +
+                                        fields)
+
+        if not self.ignore_errors or self.log_warnings:
+            if not exc.args:
+                exc.args = ("", )
+            suffix = " (%s, row %d) " % (filename, lineno)
+            exc.args = exc.args[:-1] + (exc.args[-1] + suffix,)
+
+        rejects = sum(self.reject_counts.values())
+        if not self.ignore_errors:
+            raise exc
+        elif self.log_warnings:
+            if rejects <= self.reject_warning_limit:
+                logging.warning("%s", exc)
+            elif (clock() - self._last_reject_summary >=
+                  self.reject_summary_interval):
+                self.log_rejects(filename)
+
+        rate = self.max_reject_rate
+        if self.max_rejects is not None and rejects > self.max_rejects:
+            raise ValueError("Aborting import of %s: more than %d rows were "
+                             "rejected" % (filename, self.max_rejects))
+        elif (rate is not None and
+              self.rows_processed >= self.reject_rate_min_rows and
+              rejects > rate * self.rows_processed):
+            raise ValueError("Aborting import of %s: more than %g%% of the "
+                             "rows were rejected" % (filename, rate * 100))
+
+    def log_rejects(self, filename):
+        """
+        Log the number of rows of `filename` rejected so far by error class.
+        """
+        self._last_reject_summary = clock()
+        rejects = sum(self.reject_counts.values())
+        counts = ", ".join("%s: %d" % item for item in
+                           sorted(self.reject_counts.items()))
+        logging.warning("Rejected %d of %d rows from %s (%s)", rejects,
+                        self.rows_processed, filename, counts)
+
+
+class ImportCache:
+    """
+    Directory of SQLite3 databases that each contain a copy of the rows
+    imported from one file. Entries are named after a fingerprint of the
+    file's path, size, modification time and contents along with the importer
+    settings that affect the imported data. When the total size of the cache
+    exceeds `max_size` bytes, the least recently used entries are removed.
+    """
+    table = "swadr_cached"
+    info_table = "swadr_cached_info"
+    suffix = ".sqlite3"
+
+    # Number of bytes at the start and at the end of each file that are
+    # hashed when computing fingerprints. Hashing entire files would take
+    # almost as long as importing them.
+    sample_bytes = 1 << 20
+
+    def __init__(self, directory, max_size=1 << 30):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def fingerprint(self, importer, path):
+        """
+        Return the fingerprint of the file at `path` when imported using
+        `importer` or `None` if `path` does not refer to a regular file.
+        """
+        if path == "-" or not os.path.isfile(path):
+            return None
+
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        digest = hashlib.sha1()
+        settings = [getattr(importer, name) for name in importer.data_settings]
+        key = (path, stat.st_size, stat.st_mtime, settings)
+        digest.update(repr(key).encode("utf-8"))
+
+        with open(path, "rb") as iostream:
+            digest.update(iostream.read(self.sample_bytes))
+            if stat.st_size > self.sample_bytes * 2:
+                iostream.seek(-self.sample_bytes, os.SEEK_END)
+            digest.update(iostream.read())
+
+        return digest.hexdigest()
+
+    def entry_path(self, fingerprint):
+        """
+        Return the path of the cache entry for `fingerprint`.
+        """
+        return os.path.join(self.directory, fingerprint + self.suffix)
+
+    def restore(self, importer, fingerprint, tablename):
+        """
+        Copy the rows stored in the cache entry for `fingerprint` into
+        `tablename` using the database connection of `importer`, creating the
+        table if it does not already exist. Tables created for files without
+        a header get column names generated from `tablename` like tables
+        created by `SQLite3CSVImporter.loadfile` do. The number of rows
+        copied is returned, or `None` if there is no such entry.
+        """
+        entry = self.entry_path(fingerprint)
+        if not os.path.exists(entry):
+            return None
+
+        dbc = importer.dbc
+        dbc.commit()
+        cursor = dbc.cursor()
+        cursor.execute("ATTACH DATABASE ? AS swadr_cache", (entry, ))
+        try:
+            with dbc:
+                info = list(cursor.execute(
+                    "PRAGMA swadr_cache.table_info(%s)" % self.table))
+                columns = [r[1] for r in info]
+                try:
+                    has_header, = cursor.execute(
+                        "SELECT has_header FROM swadr_cache.%s" %
+                        self.info_table).fetchone()
+                except sqlite3.OperationalError:
+                    # Entries created by older versions only have the column
+                    # names of the table the file was first imported into.
+                    has_header = True
+                importer.create_table(tablename,
+                                      columns=columns if has_header else None,
+                                      types=[r[2] for r in info])
+                cursor.execute("INSERT INTO %s SELECT * FROM swadr_cache.%s" %
+                               (importer.quote_identifier(tablename),
+                                self.table))
+                count = cursor.rowcount
+                if importer.track_versions:
+                    importer.bump_version(cursor, tablename)
+        finally:
+            cursor.execute("DETACH DATABASE swadr_cache")
+
+        # The modification time doubles as the last access time for eviction.
+        os.utime(entry, None)
+        return count
+
+    def store(self, importer, fingerprint, tablename, after_rowid, count,
+              has_header=True):
+        """
+        Create a cache entry for `fingerprint` containing the `count` rows of
+        `tablename` that follow the row with the ID `after_rowid`, then evict
+        old entries as needed. The entry records `has_header`, which indicates
+        whether the file the rows came from had a header.
+        """
+        entry = self.entry_path(fingerprint)
+        partial = "%s.%d.tmp" % (entry, os.getpid())
+        dbc = importer.dbc
+        cursor = dbc.cursor()
+        info = list(cursor.execute("PRAGMA table_info(%s)" %
+                                   importer.quote_identifier(tablename)))
+
+        # The entry is populated under a temporary name and then renamed so
+        # concurrent runs never see incomplete entries.
+        cache_dbc = sqlite3.connect(partial)
+        try:
+            cache_importer = SQLite3CSVImporter(cache_dbc)
+            with cache_dbc:
+                cache_importer.create_table(self.table,
+                                            columns=[r[1] for r in info],
+                                            types=[r[2] for r in info])
+                cache_dbc.execute("CREATE TABLE %s (has_header INTEGER)" %
+                                  self.info_table)
+                cache_dbc.execute("INSERT INTO %s VALUES (?)" %
+                                  self.info_table, (int(has_header), ))
+        finally:
+            cache_dbc.close()
+
+        dbc.commit()
+        cursor.execute("ATTACH DATABASE ? AS swadr_cache", (partial, ))
+        try:
+            cursor.execute("PRAGMA swadr_cache.journal_mode = OFF")
+            cursor.execute("PRAGMA swadr_cache.synchronous = OFF")
+            with dbc:
+                cursor.execute(
+                    "INSERT INTO swadr_cache.%s SELECT * FROM %s "
+                    "WHERE rowid > ? AND rowid <= ?" %
+                    (self.table, importer.quote_identifier(tablename)),
+                    (after_rowid, after_rowid + count))
+        finally:
+            cursor.execute("DETACH DATABASE swadr_cache")
+
+        getattr(os, "replace", os.rename)(partial, entry)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the total size of the
+        cache no longer exceeds `max_size`.
+        """
+        entries = list()
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+
+            logging.debug("Evicting %s from the import cache", path)
+            os.unlink(path)
+            total -= size
+
+    def loadfiles(self, importer, files, workers=1, refresh=False):
+        """
+        Load `files` using `importer` like `SQLite3CSVImporter.loadfiles`, but
+        restore files from the cache when possible and add the files that were
+        imported to the cache. When `refresh` is set, existing entries are
+        ignored and replaced. Files are still loaded in the given order. The
+        indexes declared with the importer are created after all of the files
+        have been loaded.
+        """
+        counts = list()
+        pending = list()
+        cursor = importer.dbc.cursor()
+
+        def last_rowid(tablename):
+            try:
+                query = "SELECT MAX(rowid) FROM %s"
+                table = importer.quote_identifier(tablename)
+                return cursor.execute(query % table).fetchone()[0] or 0
+            except sqlite3.OperationalError:
+                return 0
+
+        def load_pending():
+            if not pending:
+                return
+
+            last_rowids = dict((t, last_rowid(t)) for _, _, t in pending)
+            loaded = importer.loadfiles([(f, t) for _, f, t in pending],
+                                        workers=workers, create_indexes=False)
+            for (fingerprint, filename, tablename), count in zip(pending,
+                                                                 loaded):
+                if fingerprint:
+                    has_header = importer.headers.get(filename) is not None
+                    self.store(importer, fingerprint, tablename,
+                               last_rowids[tablename], count, has_header)
+                last_rowids[tablename] += count
+
+            counts.extend(loaded)
+            del pending[:]
+
+        with importer.pragma_profile():
+            for filename, tablename in files:
+                fingerprint = self.fingerprint(importer, filename)
+                if fingerprint and not refresh:
+                    if os.path.exists(self.entry_path(fingerprint)):
+                        load_pending()
+                        count = self.restore(importer, fingerprint, tablename)
+                        logging.info("Restored %s into %s from the import "
+                                     "cache", filename, tablename)
+                        counts.append(count)
+                        continue
+
+                pending.append((fingerprint, filename, tablename))
+
+            load_pending()
+
+            # Indexes are only created once every file has been loaded so
+            # neither the cache entries nor the restored rows are slowed down
+            # by index updates.
+            indexed = set()
+            for filename, tablename in files:
+                if tablename.lower() not in indexed:
+                    importer.create_indexes(tablename)
+                    indexed.add(tablename.lower())
+
+        return counts
+
+
+def _remove_authorizer(dbc):
+    """
+    Remove the authorizer callback of the connection `dbc`. Passing `None`
+    to `set_authorizer` only does this on Python 3.11 and later, so older
+    versions get a callback that allows everything instead.
+    """
+    if sys.version_info >= (3, 11):
+        dbc.set_authorizer(None)
+    else:
+        dbc.set_authorizer(lambda *args: sqlite3.SQLITE_OK)
+
+
+class LazyTables:
+    """
+    Tables whose files are only imported once a query uses them. Registering
+    a file creates its table using the schema detected from the start of the
+    file, so the table can be described and referred to right away, but the
+    rows are only loaded by `materialize` once a statement reads from or
+    modifies the table. Files that are never queried are never imported.
+
+    The empty tables created for files that were never imported are dropped
+    by `close` so they do not outlive the run and pass for tables without
+    any data. Their names are recorded in the `table` until then, so tables
+    left behind by runs that did not exit cleanly are dropped the next time
+    a `LazyTables` is created on the same database.
+    """
+    table = "swadr_lazy_tables"
+
+    def __init__(self, importer, cache=None, workers=1, refresh=False):
+        """
+        The files are loaded using `importer`, through the `ImportCache` given
+        as `cache` if there is one, with `workers` threads parsing them. The
+        `refresh` flag is passed to `ImportCache.loadfiles`.
+        """
+        self.importer = importer
+        self.cache = cache
+        self.workers = workers
+        self.refresh = refresh
+        self.pending = collections.OrderedDict()
+        self.created = set()
+
+        dbc = importer.dbc
+        with dbc:
+            dbc.execute("CREATE TABLE IF NOT EXISTS %s (name TEXT PRIMARY "
+                        "KEY)" % self.table)
+            stale = dbc.execute("SELECT name FROM %s" % self.table).fetchall()
+            for name, in stale:
+                self.drop(name)
+
+    def drop(self, tablename):
+        """
+        Drop `tablename` if it is still an empty placeholder and forget about
+        it. Placeholders that rows were added to by other programs are kept.
+        """
+        dbc = self.importer.dbc
+        table = self.importer.quote_identifier(tablename)
+        try:
+            if not dbc.execute("SELECT 1 FROM %s LIMIT 1" % table).fetchone():
+                dbc.execute("DROP TABLE %s" % table)
+                logging.debug("Dropped %s, which was never imported",
+                              tablename)
+        except sqlite3.OperationalError:
+            # The table has already been dropped.
+            pass
+
+        dbc.execute("DELETE FROM %s WHERE name = ?" % self.table,
+                    (tablename.lower(), ))
+        self.created.discard(tablename.lower())
+
+    def close(self):
+        """
+        Drop the tables of the files that were never imported.
+        """
+        dbc = self.importer.dbc
+        with dbc:
+            for key, files in self.pending.items():
+                if key in self.created:
+                    self.drop(files[0][1])
+
+            remaining = dbc.execute("SELECT 1 FROM %s" % self.table)
+            if not remaining.fetchone():
+                dbc.execute("DROP TABLE %s" % self.table)
+
+        self.pending.clear()
+
+    def register(self, filename, tablename):
+        """
+        Create `tablename` with the schema of `filename` without importing the
+        records in the file. Files read from standard input cannot be read
+        again later, so they are imported immediately.
+        """
+        importer = self.importer
+        if filename == "-":
+            importer.loadfile(filename, tablename)
+            return
+
+        key = tablename.lower()
+        if key not in self.pending:
+            exists = importer.dbc.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND "
+                "name = ? COLLATE NOCASE", (tablename, )).fetchone()
+            with importer.parse(filename) as (schema, records):
+                with importer.dbc:
+                    importer.create_table(tablename, columns=schema["columns"],
+                                          types=schema["types"])
+                    if not exists:
+                        importer.dbc.execute(
+                            "INSERT OR REPLACE INTO %s VALUES (?)" %
+                            self.table, (key, ))
+                        self.created.add(key)
+
+        self.pending.setdefault(key, list()).append((filename, tablename))
+        logging.info("Registered %s as %s", filename, tablename)
+
+    def referenced(self, query, params=()):
+        """
+        Return the names of the pending tables that `query` uses. The query is
+        compiled, but not run, by prefixing it with "EXPLAIN", and an
+        authorizer records every table the compiled statement would touch,
+        including the tables used by views and triggers.
+        """
+        used = list()
+        pending = self.pending
+
+        def authorizer(action, arg1, arg2, database, source):
+            name = arg1.lower() if arg1 else None
+            if name in pending and name not in used:
+                used.append(name)
+            return sqlite3.SQLITE_OK
+
+        if not pending:
+            return used
+
+        dbc = self.importer.dbc
+        dbc.set_authorizer(authorizer)
+        try:
+            dbc.execute("EXPLAIN " + query, params).fetchall()
+        except sqlite3.Error:
+            # The real statement will report the same error.
+            pass
+        finally:
+            _remove_authorizer(dbc)
+
+        return used
+
+    def materialize(self, query, params=()):
+        """
+        Import the files of every pending table `query` uses and return the
+        lowercase names of those tables.
+        """
+        used = self.referenced(query, params)
+        tables = [self.pending[name][0][1] for name in used]
+        files = [pair for name in used for pair in self.pending.pop(name)]
+        if files:
+            start = clock()
+            if self.cache:
+                self.cache.loadfiles(self.importer, files,
+                                     workers=self.workers,
+                                     refresh=self.refresh)
+            else:
+                self.importer.loadfiles(files, workers=self.workers)
+
+            logging.info("Materialized %s in %0.2f sec", ", ".join(tables),
+                         clock() - start)
+
+            dbc = self.importer.dbc
+            with dbc:
+                dbc.executemany("DELETE FROM %s WHERE name = ?" % self.table,
+                                [(name, ) for name in used])
+            self.created.difference_update(used)
+
+        return used
+
+
+class CachedCursor:
+    """
+    Read-only stand-in for a cursor whose rows come from `rows`, an iterable,
+    rather than from SQLite3. The `names` are the names of the columns, and
+    `cached` indicates whether the rows were restored from a `ResultCache`.
+    """
+    rowcount = -1
+
+    def __init__(self, names, rows, cached=False):
+        self.description = [(name, ) + (None, ) * 6 for name in names]
+        self.cached = cached
+        self._rows = iter(rows)
+
+    def __iter__(self):
+        return self._rows
+
+    def fetchone(self):
+        return next(self._rows, None)
+
+    def fetchmany(self, size=FETCH_SIZE):
+        return list(itertools.islice(self._rows, size))
+
+    def fetchall(self):
+        return list(self._rows)
+
+
+class ResultCache:
+    """
+    Cache of query results stored in the `table` of the database the queries
+    run on, so results can be reused by later runs of swadr on the same
+    database file. Entries are keyed by the text of the query, with comments
+    and redundant whitespace removed, and its parameters. Once the entries
+    take up more than `max_size` bytes, the least recently used ones are
+    removed. Results are stored as UTF-8 encoded JSON with BLOBs encoded as
+    objects holding their base64 encoded contents, and entries that cannot
+    be decoded are treated as if they were not in the cache.
+
+    Each entry records the version of every table the query read from along
+    with the schema version of the database. Table versions are counters
+    kept in `SQLite3CSVImporter.versions_table` that are incremented whenever
+    rows are imported by a `SQLite3CSVImporter` with `track_versions` set or
+    modified by statements run through `execute`, so entries are never used
+    once the data they were computed from may have changed. Changes made by
+    other connections are detected with `PRAGMA data_version` while the
+    connection is open. Changes made between runs are detected with the file
+    change counter in the header of the database, which is incremented by
+    every transaction: each transaction that writes to the cache records the
+    value the counter will have once it is committed in the `state_table`,
+    so the state stays with the database when the file is copied or moved.
+    The counter is not maintained in WAL mode, so the entries of databases
+    in WAL mode are only reused while the connection is open. Either kind of
+    change invalidates every entry since the affected tables are unknown.
+    Queries that read from temporary or attached databases are never cached.
+    """
+    table = "swadr_result_cache"
+    state_table = "swadr_result_cache_state"
+
+    # Minimum number of seconds between updates of the time an entry was last
+    # used.
+    touch_interval = 60
+
+    # Functions that may return different results each time they are called.
+    # Queries that use them are never cached.
+    volatile_functions = frozenset([
+        "changes", "current_date", "current_time", "current_timestamp",
+        "date", "datetime", "julianday", "last_insert_rowid", "random",
+        "randomblob", "strftime", "time", "timediff", "total_changes",
+        "unixepoch",
+    ])
+    # Older versions of the sqlite3 module do not define every action code.
+    function_action = getattr(sqlite3, "SQLITE_FUNCTION", 31)
+    read_actions = frozenset([sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ,
+                              function_action,
+                              getattr(sqlite3, "SQLITE_RECURSIVE", 33)])
+    write_actions = frozenset([sqlite3.SQLITE_INSERT, sqlite3.SQLITE_UPDATE,
+                               sqlite3.SQLITE_DELETE])
+    normalize_regex = re.compile(
+        r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])|"""
+        r"""(--[^\n]*|/\*.*?\*/|\s+)""", re.S)
+    blob_types = (bytes, bytearray, memoryview) if PYTHON_3 else (buffer, )
+    errors = "surrogatepass" if PYTHON_3 else "strict"
+
+    def __init__(self, dbc, max_size=64 << 20):
+        self.dbc = dbc
+        self.max_size = max_size
+        self.writing = False
+        cursor = dbc.cursor()
+        started = not self.in_transaction()
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS %s (\n"
+            "  key TEXT PRIMARY KEY,\n"
+            "  versions TEXT NOT NULL,\n"
+            "  schema_version INTEGER NOT NULL,\n"
+            "  result BLOB NOT NULL,\n"
+            "  size INTEGER NOT NULL,\n"
+            "  last_used REAL NOT NULL\n"
+            ")" % self.table)
+        cursor.execute("CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY "
+                       "KEY, change_counter INTEGER)" % self.state_table)
+        cursor.execute(SQLite3CSVImporter.versions_schema)
+        if started:
+            dbc.commit()
+
+        def default(value):
+            if isinstance(value, self.blob_types):
+                encoded = base64.b64encode(bytes(value)).decode("ascii")
+                return {"base64": encoded}
+            raise TypeError("%r is not JSON serializable" % (value, ))
+
+        self.encoder = json.JSONEncoder(default=default, ensure_ascii=False,
+                                        separators=(",", ":"))
+        self.data_version = self.pragma("data_version")
+        self.path = None
+        for _, name, path in dbc.execute("PRAGMA database_list"):
+            if name == "main" and path:
+                self.path = path
+
+        counter = self.path and self.change_counter()
+        if self.path and (counter is None or counter != self.load_state()):
+            logging.debug("Database changed since the result cache was last "
+                          "used; clearing the result cache")
+            self.clear()
+
+    def in_transaction(self):
+        return getattr(self.dbc, "in_transaction", self.writing)
+
+    def pragma(self, name):
+        return self.dbc.execute("PRAGMA %s" % name).fetchone()[0]
+
+    def change_counter(self):
+        """
+        Return the file change counter in the header of the database or
+        `None` if the database is in WAL mode, which does not maintain it.
+        """
+        if self.pragma("journal_mode").lower() == "wal":
+            return None
+
+        with open(self.path, "rb") as iostream:
+            iostream.seek(24)
+            header = iostream.read(4)
+
+        return struct.unpack(">I", header)[0] if len(header) == 4 else None
+
+    def load_state(self):
+        """
+        Return the change counter recorded by `begin` or `None` if there is
+        none.
+        """
+        row = self.dbc.execute("SELECT change_counter FROM %s WHERE id = 1" %
+                               self.state_table).fetchone()
+        return row[0] if row else None
 
-            else:
-                first_line_number = 1
-                columns = None
+    def begin(self):
+        """
+        Start a write transaction and record the value the file change counter
+        will have once it is committed. The database is locked before the
+        counter is read and before other connections are checked for changes,
+        so changes made by other programs are never recorded as if they were
+        made through the cache. Returns `True` if the cache was cleared
+        because of such changes.
+        """
+        self.dbc.execute("BEGIN IMMEDIATE")
+        self.writing = True
+        if self.path:
+            counter = self.change_counter()
+            if counter is not None:
+                counter = (counter + 1) & 0xffffffff
+            self.dbc.execute("INSERT OR REPLACE INTO %s VALUES (1, ?)" %
+                             self.state_table, (counter, ))
 
-            with self.dbc:
-                cursor = self.dbc.cursor()
-                if create_table:
-                    self.create_table(tablename, columns=columns, types=types)
+        return self.check_data_version()
+
+    def commit(self):
+        """
+        Commit the transaction started by `begin`.
+        """
+        self.dbc.commit()
+        self.writing = False
 
-                stream_reader = csv.reader(iostream, dialect)
-                rowgen = itertools.chain(sample_reader, stream_reader)
-                table = self.quote_identifier(tablename)
-                binds = ", ".join("?" * len(sample_rows[0]))
-                query = "INSERT INTO %s VALUES (%s)" % (tablename, binds)
+    def check_data_version(self):
+        """
+        Clear the cache if another connection changed the database since the
+        last time this method was called. Returns `True` if the cache was
+        cleared.
+        """
+        data_version = self.pragma("data_version")
+        if data_version == self.data_version:
+            return False
 
-                try:
-                    original_text_factory = self.dbc.text_factory
-                    if not PYTHON_3:
-                        self.dbc.text_factory = str
+        logging.debug("Database changed by another connection; clearing the "
+                      "result cache")
+        self.data_version = data_version
+        self.clear()
+        return True
+
+    def close(self):
+        """
+        Record the state of the database file so the next `ResultCache` on
+        the same database can tell whether other programs modified it in the
+        meantime. Nothing is recorded while a transaction is open since the
+        transaction will modify the file once it is committed.
+        """
+        if not self.path or self.in_transaction():
+            return
+
+        counter = self.change_counter()
+        if counter is not None and counter != self.load_state():
+            self.begin()
+            self.commit()
+
+    @classmethod
+    def normalize(cls, query):
+        """
+        Return `query` without comments, redundant whitespace or trailing
+        semicolons.
+        """
+        def replace(match):
+            return match.group(1) or " "
+
+        return cls.normalize_regex.sub(replace, query).strip(" ;")
+
+    def inspect(self, query, params=()):
+        """
+        Return a `(reads, writes, cacheable)` tuple for `query` containing the
+        lowercase names of the tables it reads from, the names of the tables
+        it modifies and whether its results may be cached. The query is
+        compiled, but not run, by prefixing it with "EXPLAIN", and an
+        authorizer records what the compiled statement would do.
+        """
+        reads = set()
+        writes = set()
+        cacheable = [True]
+
+        def authorizer(action, arg1, arg2, database, source):
+            # Tables in other databases are not tracked by the versions table
+            # and may not be the same tables the next time the query runs.
+            if database not in (None, "main"):
+                cacheable[0] = False
+
+            if action == sqlite3.SQLITE_READ and arg1:
+                reads.add(arg1.lower())
+            elif action == self.function_action:
+                if arg2 and arg2.lower() in self.volatile_functions:
+                    cacheable[0] = False
+            elif action in self.write_actions and arg1:
+                writes.add(arg1.lower())
+
+            if action not in self.read_actions:
+                cacheable[0] = False
+
+            return sqlite3.SQLITE_OK
+
+        self.dbc.set_authorizer(authorizer)
+        try:
+            self.dbc.execute("EXPLAIN " + query, params).fetchall()
+        except sqlite3.Error:
+            cacheable[0] = False
+        finally:
+            _remove_authorizer(self.dbc)
+
+        internal = (self.table, SQLite3CSVImporter.versions_table)
+        reads.difference_update(internal)
+        return sorted(reads), sorted(writes), cacheable[0]
+
+    def versions(self, tables):
+        """
+        Return a list of `[table, version]` pairs for the given `tables`.
+        """
+        if not tables:
+            return list()
+
+        query = "SELECT name, version FROM %s WHERE name IN (%s)" % (
+            SQLite3CSVImporter.versions_table, ", ".join("?" * len(tables)))
+        versions = dict(self.dbc.execute(query, tables).fetchall())
+        return [[table, versions.get(table, 0)] for table in tables]
+
+    def clear(self):
+        """
+        Remove every entry from the cache.
+        """
+        started = not self.in_transaction()
+        if started:
+            self.begin()
+        self.dbc.execute("DELETE FROM %s" % self.table)
+        if started:
+            self.commit()
+
+    def encode(self, value):
+        """
+        Return `value` encoded as UTF-8 encoded JSON.
+        """
+        return self.encoder.encode(value).encode("utf-8", self.errors)
+
+    def decode(self, result):
+        """
+        Return the `(names, rows)` pair encoded in the `result` of an entry or
+        `None` if it cannot be decoded.
+        """
+        def object_hook(value):
+            if "base64" in value:
+                blob = base64.b64decode(value["base64"].encode("ascii"))
+                return blob if PYTHON_3 else buffer(blob)
+            return value
+
+        try:
+            text = bytes(result).decode("utf-8", self.errors)
+            names, rows = json.loads(text, object_hook=object_hook)
+            return names, [tuple(row) for row in rows]
+        except (ValueError, TypeError, AttributeError):
+            return None
+
+    def execute(self, cursor, query, params=()):
+        """
+        Execute `query` with `params` using `cursor` and return an object that
+        can be used like a cursor to fetch the results. If the query only
+        reads data and its results are in the cache, they are returned
+        without executing it as a `CachedCursor` with `cached` set. Otherwise
+        the query is executed, and if it only reads data, its results are
+        added to the cache unless they take up more than `max_size` bytes.
+        The versions of the tables modified by other queries are incremented.
+        """
+        self.check_data_version()
+        reads, writes, cacheable = self.inspect(query, params)
+        if not cacheable:
+            cursor.execute(query, params)
+            for tablename in writes:
+                SQLite3CSVImporter.bump_version(self.dbc.cursor(), tablename)
+            return cursor
+
+        digest = hashlib.sha1()
+        digest.update(repr((self.normalize(query), params)).encode("utf-8"))
+        key = digest.hexdigest()
+        versions = json.dumps(self.versions(reads))
+        schema_version = self.pragma("schema_version")
+
+        started = not self.in_transaction()
+        row = self.dbc.execute(
+            "SELECT result, last_used FROM %s WHERE key = ? AND versions = ? "
+            "AND schema_version = ?" % self.table,
+            (key, versions, schema_version)).fetchone()
+        entry = row and self.decode(row[0])
+        if entry:
+            # Recording every use would mean writing to the database for each
+            # hit, so the time an entry was last used is only approximate.
+            now = time.time()
+            if now - row[1] > self.touch_interval:
+                if not (started and self.begin()):
+                    self.dbc.execute("UPDATE %s SET last_used = ? WHERE "
+                                     "key = ?" % self.table, (now, key))
+                if started:
+                    self.commit()
+
+            names, rows = entry
+            return CachedCursor(names, rows, cached=True)
+
+        cursor.execute(query, params)
+        if not cursor.description:
+            return cursor
+
+        # Rows are collected until they are known to fit in the cache. When
+        # they do not, the rows fetched so far are returned followed by the
+        # rest of the rows, and nothing is cached.
+        names = [column[0] for column in cursor.description]
+        rows = list()
+        size = 0
+        for batch in iter(lambda: cursor.fetchmany(FETCH_SIZE), []):
+            rows.extend(batch)
+            size += len(self.encode(batch))
+            if size > self.max_size:
+                remaining = fetch_rows(cursor)
+                return CachedCursor(names, itertools.chain(rows, remaining))
+
+        # The rows may predate changes another connection made while they
+        # were being fetched, in which case they are not cached.
+        if not (started and self.begin()):
+            result = self.encode((names, rows))
+            self.dbc.execute(
+                "INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?, ?)" %
+                self.table, (key, versions, schema_version,
+                             sqlite3.Binary(result), len(result), time.time()))
+            self.evict()
+        if started:
+            self.commit()
+
+        return CachedCursor(names, rows)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the entries take up at
+        most `max_size` bytes.
+        """
+        total = 0
+        expired = list()
+        entries = self.dbc.execute(
+            "SELECT key, size FROM %s ORDER BY last_used DESC" % self.table)
+        for key, size in entries.fetchall():
+            total += size
+            if total > self.max_size:
+                expired.append((key, ))
+
+        self.dbc.executemany("DELETE FROM %s WHERE key = ?" % self.table,
+                             expired)
+
+
+class Profiler:
+    """
+    Collect timings of queries and file imports. When `enabled` is set, a
+    summary of each measurement is printed to `dest`, standard error by
+    default, and when `log` is the path of a file, every measurement is
+    appended to it as a JSON object on its own line. Each kind of event is
+    split into the `stages` listed for it.
+    """
+    stages = {
+        "query": ("execute", "fetch", "render"),
+        "load": ("sniff", "detect", "insert"),
+    }
+
+    def __init__(self, enabled=False, log=None, dest=None):
+        self.enabled = enabled
+        self.log = log
+        self.dest = dest
+
+    def report(self, event, rows, dest=None, **details):
+        """
+        Record that an `event` processing `rows` rows took the durations in
+        seconds given for each of its stages in `details`. Any other `details`
+        such as the text of a query are only included in the log. The summary
+        is printed to `dest` when it is specified instead of `self.dest`.
+        """
+        if not self.enabled and not self.log:
+            return
+
+        stages = self.stages[event]
+        total = sum(details.get(stage, 0) for stage in stages)
+        rate = rows / total if total > 0 else None
+
+        if self.log:
+            record = dict(details, event=event, rows=rows, total=total,
+                          rows_per_sec=rate, time=time.time())
+            with open(self.log, "a") as iostream:
+                iostream.write(json.dumps(record, sort_keys=True) + "\n")
+
+        if self.enabled:
+            durations = ", ".join("%s %0.3f sec" % (stage, details[stage])
+                                  for stage in stages if stage in details)
+            text = "Timing: %s; %d row%s" % (durations, rows,
+                                             "" if rows == 1 else "s")
+            if rate is not None:
+                text += " (%d rows/sec)" % rate
+
+            if event == "load":
+                text += " from %(file)s into %(table)s" % details
+
+            dest = dest or self.dest
+            print(text, file=sys.stderr if dest is None else dest)
+
+
+class TimedCursor:
+    """
+    Wrapper for a SQLite3 cursor that keeps track of how many seconds have been
+    spent fetching rows from it in `elapsed`.
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.elapsed = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def fetchone(self):
+        start = clock()
+        try:
+            return self.cursor.fetchone()
+        finally:
+            self.elapsed += clock() - start
+
+    def fetchmany(self, size=FETCH_SIZE):
+        start = clock()
+        try:
+            return self.cursor.fetchmany(size)
+        finally:
+            self.elapsed += clock() - start
+
+
+def _wide_textwidth(text):
+    """
+    Return the number of columns `text` spans according to the wcwidth module.
+    """
+    if not PYTHON_3 and not isinstance(text, unicode):
+        text = text.decode("utf-8", "replace")
+
+    length = wcwidth.wcswidth(text)
+    return len(text) if length == -1 else length
+
+
+if lru_cache:
+    _wide_textwidth = lru_cache(maxsize=TEXTWIDTH_CACHE_SIZE)(_wide_textwidth)
+
+
+if hasattr(str, "isascii"):
+    _isascii = str.isascii
+else:
+    _isascii = lambda text: not NON_ASCII_REGEX.search(text)
+
+
+def textwidth(text):
+    """
+    Return the number of printed columns the given text will span in a
+    monospaced terminal. When the wcwidth module is not available, this falls
+    back to the length of the text which will be inaccurate for many
+    non-Latin characters. Text that only contains ASCII characters is always
+    measured by its length, and the widths of other text are cached.
+    """
+    if not WCWIDTH_SUPPORT or _isascii(text):
+        return len(text)
+
+    return _wide_textwidth(text)
+
+
+class OutputBuffer:
+    """
+    Collect text written to `dest`, or stdout when `dest` is `None`, and write
+    it in blocks of at least `flush_size` characters. Writing one large block
+    is much faster than calling `print` for every line when the output is a
+    pipe.
+    """
+    def __init__(self, dest=None, flush_size=OUTPUT_FLUSH_SIZE):
+        self.dest = dest
+        self.flush_size = flush_size
+        self.chunks = list()
+        self.size = 0
 
-                    for lineno, row in enumerate(rowgen, first_line_number):
-                        parameters = [val if val else None for val in row]
-                        logging.debug("Inserting row: %r", parameters)
+    def write(self, text):
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.size >= self.flush_size:
+            self.flush()
 
-                        try:
-                            cursor.execute(query, parameters)
+    def flush(self):
+        if self.chunks:
+            dest = sys.stdout if self.dest is None else self.dest
+            dest.write("".join(self.chunks))
+            self.chunks = list()
+            self.size = 0
 
-                        except Exception as e:
-                            if not self.ignore_errors or self.log_warnings:
-                                if not e.args:
-                                    e.args = ("", )
-                                suffix = " (%s, row %d) " % (filename, lineno)
-                                e.args = e.args[:-1] + (e.args[-1] + suffix,)
 
-                            if not self.ignore_errors:
-                                self.dbc.text_factory = original_text_factory
-                                raise
-                            elif self.log_warnings:
-                                logging.warning("%s", e)
+def fetch_rows(cursor, size=FETCH_SIZE):
+    """
+    Yield the rows of a query result from `cursor`, retrieving `size` rows at a
+    time with `fetchmany`.
+    """
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
 
-                finally:
-                    self.dbc.text_factory = original_text_factory
+        for row in rows:
+            yield row
 
 
-def pretty_print_table(table, breakafter=[0], dest=None, tabsize=8):
+def pretty_print_table(table, breakafter=[0], dest=None, tabsize=8,
+                       window=None, spool=False, flush_size=OUTPUT_FLUSH_SIZE):
     """
     Pretty-print data from a table in a style similar to MySQL CLI. The
     `breakafter` option is used to determine where row-breaks should be
@@ -250,7 +3046,7 @@ def pretty_print_table(table, breakafter=[0], dest=None, tabsize=8):
     ... ["Bob", 10, "Blue"],
     ... ["Rob", 25, "Red"],
     ... ["Penny", 70, "Purple"]]
-    >>> pretty_print_table(table)
+    >>> count = pretty_print_table(table)
     +-------+-----+----------------+
     | Name  | Age | Favorite Color |
     +-------+-----+----------------+
@@ -263,124 +3059,756 @@ def pretty_print_table(table, breakafter=[0], dest=None, tabsize=8):
     providing a file-like object as the `dest` parameter.
 
     The `tabsize` parameter controls how many spaces tabs are expanded to.
+
+    Rows are consumed from `table` lazily. When `window` is set, the column
+    widths are computed from the first `window` rows, and the rows after that
+    are printed as they are read; if one of them is wider than its column, the
+    column is widened and a row-break is inserted above it. When `spool` is
+    set, every row is written to a temporary file so the column widths can be
+    computed from the entire table without keeping it in memory. The number of
+    rows printed, counting the header, is returned, so `count` is 4 above.
+
+    Output is written to `dest` in blocks of roughly `flush_size` characters.
     """
-    # The textwidth function returns the number of printed columns the given
-    # text will span in a monospaced terminal. When the wcwidth module is not
-    # available, this falls back to the len builtin which will be inaccurate
-    # for many non-Latin characters.
-    if not WCWIDTH_SUPPORT:
-        textwidth = len
+    colwidths = list()
+    left_aligned = list()
+
+    def split(row):
+        """
+        Split each cell in `row` into lines. A list of the lines in each cell,
+        a list of the widths of those lines and a list of flags indicating
+        which cells are numbers is returned.
+        """
+        cells = list()
+        widths = list()
+        numeric = list()
+        for column in row:
+            numeric.append(isinstance(column, numbers.Number))
+            if column is None:
+                column = "NULL"
+            else:
+                if PYTHON_3 or not isinstance(column, unicode):
+                    column = str(column)
 
-    elif PYTHON_3:
-        def textwidth(text):
-            length = wcwidth.wcswidth(text)
-            return len(text) if length == -1 else length
+                column = column.expandtabs(tabsize)
 
-    else:
-        def textwidth(text):
-            if isinstance(text, unicode):
-                length = wcwidth.wcswidth(text)
-                return len(text) if length == -1 else length
+            lines = column.split("\n")
+            cells.append(lines)
+            widths.append([textwidth(line) for line in lines])
+
+        return cells, widths, numeric
+
+    def fit(cells, widths, numeric):
+        """
+        Update the column widths if any of the cells are wider than the
+        widest, previously encountered cell in each column.
+        """
+        for index, linewidths in enumerate(widths):
+            width = max(linewidths)
+            if index == len(colwidths):
+                colwidths.append(width)
+                left_aligned.append(True)
+            elif width > colwidths[index]:
+                colwidths[index] = width
+
+            if numeric[index]:
+                left_aligned[index] = False
+
+    output = OutputBuffer(dest, flush_size)
+
+    def print_break():
+        dashes = ("-" * width for width in colwidths)
+        output.write("+-" + "-+-".join(dashes) + "-+\n")
+
+    def print_row(cells, widths):
+        for lineindex in range(max(map(len, cells))):
+            printcols = list()
+            for index, lines in enumerate(cells):
+                if lineindex < len(lines):
+                    column = lines[lineindex]
+                    width = widths[index][lineindex]
+                else:
+                    column = ""
+                    width = 0
+
+                if not PYTHON_3 and isinstance(column, unicode):
+                    column = column.encode("utf-8", "replace")
+
+                padding = " " * (colwidths[index] - width)
+                if left_aligned[index]:
+                    printcols.append(column + padding)
+                else:
+                    printcols.append(padding + column)
+
+            output.write("| " + " | ".join(printcols) + " |\n")
+
+    def unspool(spoolfile):
+        spoolfile.seek(0)
+        while True:
+            try:
+                yield pickle.load(spoolfile)
+            except EOFError:
+                return
+
+    rows = (split(row) for row in table)
+    with tempfile.TemporaryFile() if spool else io.BytesIO() as spoolfile:
+        if spool:
+            for row in rows:
+                fit(*row)
+                pickle.dump(row, spoolfile, pickle.HIGHEST_PROTOCOL)
+            measured = unspool(spoolfile)
+        else:
+            measured = list(itertools.islice(rows, window))
+            for row in measured:
+                fit(*row)
+
+        pending = itertools.chain(measured, rows)
+        row = next(pending, None)
+        if row is None:
+            return 0
+
+        print_break()
+        printed_widths = list(colwidths)
+        rowindex = 0
+        while row is not None:
+            # The next row is read before this one is printed so a break can
+            # be inserted after the last row.
+            following = next(pending, None)
+            fit(*row)
+            if colwidths != printed_widths:
+                print_break()
+                printed_widths = list(colwidths)
+
+            print_row(*row[:2])
+
+            # Check if row-break should be inserted after row
+            if ((breakafter is True) or (following is None) or
+              (breakafter and rowindex in breakafter)):
+                print_break()
+
+            row = following
+            rowindex += 1
+
+        output.flush()
+
+    return rowindex
+
+
+def _binary_stream(dest):
+    """
+    Return a stream binary data can be written to for `dest`, a text stream
+    such as stdout.
+    """
+    dest = sys.stdout if dest is None else dest
+    dest.flush()
+    return getattr(dest, "buffer", dest)
+
+
+def write_csv(cursor, dest=None, flush_size=OUTPUT_FLUSH_SIZE):
+    """
+    Write the results of the query executed with `cursor` to `dest` as CSV
+    with a header row. The number of rows written is returned.
+    """
+    def encode(value):
+        if not PYTHON_3 and isinstance(value, unicode):
+            return value.encode("utf-8", "replace")
+        return value
+
+    output = OutputBuffer(dest, flush_size)
+    writer = csv.writer(output)
+    writer.writerow([encode(d[0]) for d in cursor.description])
+    count = 0
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+
+        if not PYTHON_3:
+            rows = [[encode(value) for value in row] for row in rows]
+
+        writer.writerows(rows)
+        count += len(rows)
+
+    output.flush()
+    return count
+
+
+def write_jsonl(cursor, dest=None, flush_size=OUTPUT_FLUSH_SIZE):
+    """
+    Write the results of the query executed with `cursor` to `dest` as JSON
+    Lines: one JSON object mapping column names to values per row. BLOBs are
+    written as base64 encoded strings. The number of rows written is returned.
+    """
+    def default(value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return base64.b64encode(bytes(value)).decode("ascii")
+        raise TypeError("%r is not JSON serializable" % (value, ))
+
+    encoder = json.JSONEncoder(default=default, ensure_ascii=False)
+    names = [d[0] for d in cursor.description]
+    output = OutputBuffer(dest, flush_size)
+    count = 0
+    for row in fetch_rows(cursor):
+        record = collections.OrderedDict(zip(names, row))
+        output.write(encoder.encode(record) + "\n")
+        count += 1
+
+    output.flush()
+    return count
+
+
+def write_columnar(cursor, dest=None):
+    """
+    Write the results of the query executed with `cursor` to `dest` in a
+    binary, columnar format. When pyarrow is installed, the results are
+    written as an Apache Arrow IPC stream with one record batch per
+    `FETCH_SIZE` rows. Since SQLite columns can hold values of any type, the
+    batches are first spooled to a temporary file so the type of each column
+    can be derived from all of its values; see `_arrow_type`. Otherwise, the
+    `COLUMNAR_MAGIC` header is followed by blocks, each of which is a 4-byte,
+    big-endian length followed by that many bytes of UTF-8 encoded JSON. The
+    first block is the list of column names, and every other block holds a
+    batch of rows as a list containing a list of values for each column.
+    BLOBs are written as objects with a "base64" key holding their base64
+    encoded contents. Use `read_columnar` to read the fallback format. The
+    number of rows written is returned.
+    """
+    stream = _binary_stream(dest)
+    names = [d[0] for d in cursor.description]
+    count = 0
+
+    if pyarrow is None:
+        def default(value):
+            if isinstance(value, (bytes, bytearray, memoryview)):
+                encoded = base64.b64encode(bytes(value)).decode("ascii")
+                return {"base64": encoded}
+            raise TypeError("%r is not JSON serializable" % (value, ))
+
+        encoder = json.JSONEncoder(default=default, ensure_ascii=False)
+        errors = "surrogatepass" if PYTHON_3 else "strict"
+
+        def write_block(value):
+            block = encoder.encode(value).encode("utf-8", errors)
+            stream.write(struct.pack(">I", len(block)))
+            stream.write(block)
+
+        stream.write(COLUMNAR_MAGIC)
+        write_block(names)
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+
+            write_block([list(column) for column in zip(*rows)])
+            count += len(rows)
+
+        stream.flush()
+        return count
+
+    kinds = [set() for name in names]
+    with tempfile.TemporaryFile() as spool:
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+
+            columns = [list(column) for column in zip(*rows)]
+            for column, seen in zip(columns, kinds):
+                seen.update(_arrow_kind(value) for value in column)
+            marshal.dump(columns, spool)
+            count += len(rows)
+
+        types = [_arrow_type(seen) for seen in kinds]
+        schema = pyarrow.schema(list(zip(names, types)))
+        writer = pyarrow.ipc.new_stream(stream, schema)
+        spool.seek(0)
+        batches = 0
+        while True:
+            try:
+                columns = marshal.load(spool)
+            except EOFError:
+                break
+
+            arrays = [
+                pyarrow.array(_arrow_values(column, kind), type=kind)
+                for column, kind in zip(columns, types)
+            ]
+            writer.write_batch(
+                pyarrow.RecordBatch.from_arrays(arrays, schema=schema))
+            batches += 1
+
+    # An empty result is written as a batch with no rows so the stream still
+    # contains the names of the columns.
+    if not batches:
+        arrays = [pyarrow.array([], type=kind) for kind in types]
+        writer.write_batch(
+            pyarrow.RecordBatch.from_arrays(arrays, schema=schema))
+
+    writer.close()
+    stream.flush()
+    return count
+
+
+def _arrow_kind(value):
+    """
+    Return the SQLite storage class of `value` as one of "null", "integer",
+    "real", "text" or "blob".
+    """
+    if value is None:
+        return "null"
+    elif isinstance(value, float):
+        return "real"
+    elif isinstance(value, numbers.Integral):
+        return "integer"
+    elif isinstance(value, str if PYTHON_3 else unicode):
+        return "text"
+    return "blob"
+
+
+def _arrow_type(kinds):
+    """
+    Return the Arrow type for a column whose values have the storage classes
+    in the set `kinds`. Integers that share a column with REAL values are
+    promoted to float64. Columns mixing numbers and TEXT become strings,
+    and columns containing BLOBs alongside other values become binary.
+    Columns that only contain NULL have the Arrow null type.
+    """
+    kinds = kinds - set(["null"])
+    if not kinds:
+        return pyarrow.null()
+    elif kinds == set(["integer"]):
+        return pyarrow.int64()
+    elif kinds <= set(["integer", "real"]):
+        return pyarrow.float64()
+    elif "blob" in kinds:
+        return pyarrow.large_binary()
+    return pyarrow.large_string()
+
+
+def _arrow_values(column, kind):
+    """
+    Convert the values in `column` to ones that pyarrow accepts for the Arrow
+    type `kind` returned by `_arrow_type`. Numbers in string and binary
+    columns are converted to their decimal representation.
+    """
+    def text(value):
+        if _arrow_kind(value) == "integer":
+            return str(int(value))
+        elif _arrow_kind(value) == "real":
+            return repr(value)
+        return value
+
+    if kind == pyarrow.float64():
+        return [None if v is None else float(v) for v in column]
+    elif kind == pyarrow.large_string():
+        return [None if v is None else text(v) for v in column]
+    elif kind == pyarrow.large_binary():
+        return [
+            None if v is None else
+            bytes(v) if _arrow_kind(v) == "blob" else
+            text(v).encode("utf-8")
+            for v in column
+        ]
+    return column
+
+
+def read_columnar(stream):
+    """
+    Read results written by `write_columnar` in its fallback format from the
+    binary `stream`. A list of column names and a generator that yields each
+    row as a tuple are returned.
+    """
+    if stream.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+        raise ValueError("Stream does not contain columnar swadr output")
+
+    errors = "surrogatepass" if PYTHON_3 else "strict"
+
+    def object_hook(value):
+        if "base64" in value:
+            return base64.b64decode(value["base64"].encode("ascii"))
+        return value
+
+    def read_block():
+        header = stream.read(4)
+        if not header:
+            return None
+        elif len(header) < 4:
+            raise ValueError("Columnar swadr output is truncated")
+
+        size, = struct.unpack(">I", header)
+        block = stream.read(size)
+        if len(block) < size:
+            raise ValueError("Columnar swadr output is truncated")
+        return json.loads(block.decode("utf-8", errors),
+                          object_hook=object_hook)
+
+    names = read_block()
+    if names is None:
+        raise ValueError("Columnar swadr output is truncated")
+
+    def rows():
+        while True:
+            columns = read_block()
+            if columns is None:
+                return
+
+            for row in zip(*columns):
+                yield row
+
+    return names, rows()
+
+
+class QuerySplitter:
+    """
+    Incremental splitter that breaks SQL text into complete statements as it
+    is fed. The text is tokenized in a single pass using the state machine of
+    `sqlite3_complete`, so a statement is complete at the same point
+    `sqlite3.complete_statement` would consider it complete, and whatever was
+    scanned before a chunk ended is never scanned again.
+    """
+    # States and tokens of the state machine used by sqlite3_complete. A
+    # statement is complete once a semicolon leads to the START state.
+    INVALID, START, NORMAL, EXPLAIN, CREATE, TRIGGER, SEMI, END = range(8)
+    tkSEMI, tkWS, tkOTHER, tkEXPLAIN, tkCREATE, tkTEMP, tkTRIGGER, tkEND = \
+        range(8)
+    transitions = (
+        (1, 0, 2, 3, 4, 2, 2, 2),
+        (1, 1, 2, 3, 4, 2, 2, 2),
+        (1, 2, 2, 2, 2, 2, 2, 2),
+        (1, 3, 3, 2, 4, 2, 2, 2),
+        (1, 4, 2, 2, 2, 4, 5, 2),
+        (6, 5, 5, 5, 5, 5, 5, 5),
+        (6, 6, 5, 5, 5, 5, 5, 7),
+        (1, 7, 5, 5, 5, 5, 5, 5),
+    )
+    keywords = {
+        "create": tkCREATE,
+        "end": tkEND,
+        "explain": tkEXPLAIN,
+        "temp": tkTEMP,
+        "temporary": tkTEMP,
+        "trigger": tkTRIGGER,
+    }
+
+    # Quoted strings, identifiers and comments are skipped by searching for
+    # the text that closes them.
+    closers = {"'": "'", '"': '"', "`": "`", "[": "]", "/*": "*/", "--": "\n"}
+    token_regex = re.compile(
+        r"[ \t\n\f\r]+|(?:[0-9A-Za-z_$]|[^\x00-\x7f])+|--|/\*|.", re.S)
+
+    # In the NORMAL and TRIGGER states, only semicolons change the state, so
+    # everything up to the next character that may start a semicolon, quoted
+    # text or a comment is skipped without being tokenized.
+    special_regex = re.compile(r"[;'\"`\[/-]")
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.state = self.INVALID
+        self.closer = None
+
+    @property
+    def pending(self):
+        """
+        Text fed to the splitter that does not form a complete statement yet.
+        """
+        return self.buffer
+
+    def terminator(self):
+        """
+        Return the character needed to terminate the pending text: the quote
+        character of an unterminated string or identifier, ";" when a
+        semicolon would complete the statement or `None` when neither would,
+        e.g. inside a comment or the body of a trigger.
+        """
+        # A token at the end of the text that has not been scanned yet because
+        # it may continue in the next chunk is scanned as though it does not.
+        state = self.state
+        token_text = self.buffer[self.position:]
+        if token_text and not self.closer:
+            token = self.keywords.get(token_text.lower(), self.tkOTHER)
+            state = self.transitions[state][token]
+
+        if state in (self.TRIGGER, self.SEMI):
+            return None
+        elif self.closer:
+            return self.closer if self.closer in ("'", '"', "`") else None
+
+        return ";"
+
+    def feed(self, text):
+        """
+        Add `text` to the pending text and return a list of the statements,
+        stripped of surrounding whitespace, that were completed by it.
+        """
+        queries = list()
+        buffer = self.buffer + text
+        length = len(buffer)
+        position = self.position
+        start = 0
+        transitions = self.transitions
+        state = self.state
+        closer = self.closer
+        match = self.token_regex.match
+        search = self.special_regex.search
+
+        while position < length:
+            if state in (self.NORMAL, self.TRIGGER) and not closer:
+                special = search(buffer, position)
+                if not special:
+                    position = length
+                    break
+
+                position = special.start()
+
+            if closer:
+                end = buffer.find(closer, position)
+                if end == -1:
+                    position = max(position, length - len(closer) + 1)
+                    break
+
+                position = end + len(closer)
+                closer = None
+                continue
+
+            end = match(buffer, position).end()
+            token_text = buffer[position:end]
+            char = token_text[0]
+
+            # Identifiers, "-" and "/" may continue in the next chunk.
+            if end == length and (token_text in ("-", "/") or
+                                  char.isalnum() or char in "_$" or
+                                  char > "\x7f"):
+                break
+
+            if token_text in self.closers:
+                closer = self.closers[token_text]
+                comment = token_text in ("--", "/*")
+                token = self.tkWS if comment else self.tkOTHER
+            elif char == ";":
+                token = self.tkSEMI
+            elif char in " \t\n\f\r":
+                token = self.tkWS
             else:
-                text = text.decode("utf-8", "replace")
-                length = wcwidth.wcswidth(text)
-                return len(text) if length == -1 else length
+                token = self.keywords.get(token_text.lower(), self.tkOTHER)
+
+            state = transitions[state][token]
+            position = end
+            if state == self.START and token == self.tkSEMI:
+                query = buffer[start:position].strip()
+                if query:
+                    queries.append(query)
+                start = position
+                state = self.INVALID
+
+        self.buffer = buffer[start:]
+        self.position = position - start
+        self.state = state
+        self.closer = closer
+        return queries
+
+
+def query_split(text):
+    """
+    Yield individual SQLite3 queries found in the given `text`. The last
+    yielded query may be incomplete. Use `sqlite3.complete_statement` to verify
+    whether or not it is a fragment.
+    """
+    splitter = QuerySplitter()
+    for query in splitter.feed(text):
+        yield query
+
+    if splitter.pending.strip():
+        yield splitter.pending
+
+
+def execute_script(connection, iostream, transaction_size=1000,
+                   stop_on_error=False, results=None, lazy=None, cache=None,
+                   progress_interval=5):
+    """
+    Execute the SQL statements read from the text stream `iostream` on
+    `connection` and return a `(executed, failed)` tuple containing the number
+    of statements that succeeded and the number that failed. The script is
+    read in blocks of `SCRIPT_BLOCK_SIZE` characters and split by a
+    `QuerySplitter`, so it never needs to fit in memory.
+
+    Statements are grouped into transactions of up to `transaction_size`
+    statements; with a `transaction_size` of 1 or less, every statement is
+    committed on its own. Statements that begin, end or roll back
+    transactions themselves commit the current group first, and no groups
+    are started while a transaction opened by the script is active. The same
+    goes for statements SQLite refuses or ignores inside a transaction, like
+    VACUUM, ATTACH and changes to the journal mode, which run on their own.
+
+    Failed statements are logged along with their position in the script.
+    When `stop_on_error` is set, the first error is re-raised instead. Either
+    way, every statement that succeeded is committed. When `results` is given,
+    it is called with the cursor of every statement that returns rows. The
+    pending tables of `lazy`, a `LazyTables` instance, are materialized as
+    statements use them, and statements are executed through `cache`, a
+    `ResultCache`, when it is given. Progress is logged at most once every
+    `progress_interval` seconds.
+    """
+    cursor = connection.cursor()
+    splitter = QuerySplitter()
+    executed = failed = grouped = 0
+    start = reported = clock()
+    batching = False
+
+    def statements():
+        for block in iter(lambda: iostream.read(SCRIPT_BLOCK_SIZE), ""):
+            for query in splitter.feed(block):
+                yield query
+
+        if splitter.pending.strip():
+            yield splitter.pending
 
-    table = list(table)
-    last = len(table) - 1
-    colwidths = list()
-    table_lines = list()
-    left_aligned = [True] * len(table[0]) if table else []
-    for rowindex, row in enumerate(table):
-        # Split each cell into lines
-        cells = list()
-        for colindex, column in enumerate(row):
-            if column is None:
-                column = "NULL"
-            else:
-                if isinstance(column, numbers.Number):
-                    left_aligned[colindex] = False
+    def in_transaction():
+        return getattr(connection, "in_transaction", batching)
 
-                if PYTHON_3 or not isinstance(column, unicode):
-                    column = str(column)
+    def commit():
+        # A failed statement may have already rolled the transaction back.
+        if in_transaction():
+            cursor.execute("COMMIT")
 
-                column = column.expandtabs(tabsize)
+    original_isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    try:
+        for number, query in enumerate(statements(), 1):
+            unbatched = (TRANSACTION_CONTROL_REGEX.match(query) or
+                         NON_TRANSACTIONAL_REGEX.match(query))
+            if batching and unbatched:
+                commit()
+                batching = False
+            elif (transaction_size > 1 and not batching and
+                  not unbatched and not in_transaction()):
+                cursor.execute("BEGIN")
+                batching = True
+                grouped = 0
 
-            cells.append(column.split("\n"))
+            try:
+                params = tuple()
+                if METAQUERY_REGEX.match(query):
+                    query, params = metaquery_conversion(query)
+                if lazy:
+                    lazy.materialize(query, params)
 
-        # Check if row-break should be inserted after row
-        separate = ((breakafter is True) or
-                    (rowindex == last) or
-                    (breakafter and rowindex in breakafter))
+                if cache:
+                    result = cache.execute(cursor, query, params)
+                else:
+                    result = cursor.execute(query, params)
+                if results and result.description:
+                    results(result)
 
-        # Find tallest cell in the row
-        row_height = max(map(len, cells))
+                executed += 1
+            except sqlite3.Error as exc:
+                failed += 1
+                if stop_on_error:
+                    raise
 
-        # Update the column widths if any of the cells are wider than the
-        # widest, previously encountered cell in each column.
-        initialize = not table_lines
-        for index, contents in enumerate(cells):
-            width = max(map(textwidth, contents))
-            if initialize:
-                colwidths.append(width)
-            else:
-                colwidths[index] = max(width, colwidths[index])
+                logging.warning("Statement %d: %s", number, exc)
 
-            if initialize:
-                table_lines.append([None])
+            if batching:
+                grouped += 1
+                if grouped >= transaction_size:
+                    commit()
+                    batching = False
 
-            # Pad line count of each cell in the row to match the row_height
-            cells[index] += [""] * (row_height - len(contents))
+            now = clock()
+            if now - reported >= progress_interval:
+                reported = now
+                logging.info("Executed %d statements (%d/sec)", number,
+                             number / (now - start))
+    finally:
+        if batching:
+            commit()
+        connection.isolation_level = original_isolation_level
 
-            # Add lines to line table and insert a break if needed
-            table_lines[index].extend(cells[index] + [None] * separate)
+    logging.info("Executed %d statements in %0.2f sec (%d failed)",
+                 executed + failed, clock() - start, failed)
+    return executed, failed
 
-    # Transpose the table and print each row. Rows containing `None` indicate a
-    # row break should be inserted.
-    for row in zip(*table_lines):
-        printcols = list()
 
-        if row[0] is None:
-            print("+-", end="", file=dest)
-            for index, column in enumerate(row):
-                printcols.append("-" * colwidths[index])
+def read_only_query(connection, query, params=()):
+    """
+    Return whether `query` only reads from the main database of `connection`,
+    in which case it can be run on any other connection to the same database
+    file. Like `ResultCache.inspect`, this compiles the query prefixed with
+    "EXPLAIN" under an authorizer without running it. Queries that use
+    temporary or attached databases or that fail to compile are not
+    considered read-only.
+    """
+    read_only = [True]
 
-            print(*printcols, sep="-+-", end="-+\n", file=dest)
+    def authorizer(action, arg1, arg2, database, source):
+        if (action not in ResultCache.read_actions or
+                database not in (None, "main")):
+            read_only[0] = False
 
-        else:
-            print("| ", end="", file=dest)
-            for index, column in enumerate(row):
-                if not PYTHON_3 and isinstance(column, unicode):
-                    column = column.encode("utf-8", "replace")
+        return sqlite3.SQLITE_OK
 
-                padding = " " * (colwidths[index] - textwidth(column))
-                if left_aligned[index]:
-                    printcols.append(column + padding)
-                else:
-                    printcols.append(padding + column)
+    connection.set_authorizer(authorizer)
+    try:
+        connection.execute("EXPLAIN " + query, params).fetchall()
+    except sqlite3.Error:
+        read_only[0] = False
+    finally:
+        _remove_authorizer(connection)
 
-            print(*printcols, sep=" | ", end=" |\n", file=dest)
+    return read_only[0]
 
 
-def query_split(text):
+def parallel_queries(database, queries, workers=4):
     """
-    Yield individual SQLite3 queries found in the given `text`. The last
-    yielded query may be incomplete. Use `sqlite3.complete_statement` to verify
-    whether or not it is a fragment.
+    Execute the read-only `queries` on the SQLite3 database file `database`
+    using up to `workers` threads, each with its own connection, and yield a
+    `(cursor, execute, fetch)` tuple for every query in the order the queries
+    were given. The `cursor` is a `CachedCursor` holding the rows of the
+    query, and `execute` and `fetch` are the number of seconds spent running
+    the query and fetching its rows. The sqlite3 module releases the GIL while
+    statements run, so independent queries are executed concurrently, but
+    the rows of every query are held in memory until they are yielded, which
+    makes this best suited to queries with small results like aggregates.
+
+    The connections are made read-only with "PRAGMA query_only", and each
+    reads a consistent snapshot of the database, so changes must be committed
+    before calling this function.
     """
-    segments = re.split("(;)", text)
-    length = len(segments)
-    j = 0
-    for k in range(length + 1):
-        query = ''.join(segments[j:k]).strip()
-        if query and sqlite3.complete_statement(query):
-            yield query
-            j = k
+    local = threading.local()
+    connections = list()
+    lock = threading.Lock()
+
+    def run(query):
+        connection = getattr(local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(database, check_same_thread=False)
+            connection.execute("PRAGMA query_only = ON")
+            local.connection = connection
+            with lock:
+                connections.append(connection)
+
+        start = clock()
+        cursor = connection.execute(query)
+        executed = clock()
+        names = [d[0] for d in cursor.description or ()]
+        rows = cursor.fetchall()
+        return CachedCursor(names, rows), executed - start, clock() - executed
+
+    pool = multiprocessing.pool.ThreadPool(max(1, min(workers, len(queries))))
+    try:
+        for result in pool.imap(run, queries):
+            yield result
+    finally:
+        # Queries still running when the caller stops early or a query fails
+        # are interrupted rather than waited on.
+        with lock:
+            for connection in connections:
+                connection.interrupt()
 
-    if j != length:
-        tail = ''.join(segments[j:])
-        if tail.strip():
-            yield tail
+        pool.terminate()
+        pool.join()
+        for connection in connections:
+            connection.close()
 
 
 def metaquery_conversion(original_query, original_params=tuple()):
@@ -430,79 +3858,338 @@ def metaquery_conversion(original_query, original_params=tuple()):
     return original_query, original_params
 
 
-def sqlite3_repl(connection, input_function=None, dest=None):
+def explain_query_plan(cursor, query, params=tuple()):
+    """
+    Return the plan SQLite3 would use to execute `query` as a list of
+    `(id, parent, detail)` tuples.
+    """
+    rows = cursor.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()
+    return [(row[0], row[1], row[-1]) for row in rows]
+
+
+def format_query_plan(plan):
+    """
+    Return a query `plan` from `explain_query_plan` drawn as a tree in the same
+    style as the sqlite3 command line shell:
+
+    >>> print(format_query_plan([(2, 0, "SCAN A"), (7, 0, "LIST SUBQUERY 1"),
+    ...                          (9, 7, "SCAN B")]))
+    QUERY PLAN
+    |--SCAN A
+    `--LIST SUBQUERY 1
+       `--SCAN B
+    """
+    children = collections.defaultdict(list)
+    for node, parent, detail in plan:
+        children[parent].append((node, detail))
+
+    lines = ["QUERY PLAN"]
+
+    def draw(parent, prefix):
+        nodes = children[parent]
+        for index, (node, detail) in enumerate(nodes):
+            last = index == len(nodes) - 1
+            lines.append(prefix + ("`--" if last else "|--") + detail)
+            if node != parent:
+                draw(node, prefix + ("   " if last else "|  "))
+
+    draw(0, "")
+    return "\n".join(lines)
+
+
+def suggest_indexes(cursor, query, plan):
+    """
+    Return a list of CREATE INDEX statements that would let SQLite3 execute
+    `query`, whose plan is `plan`, without scanning entire tables. Two kinds
+    of plan entries lead to suggestions: searches using automatic indexes,
+    which SQLite3 builds from scratch every time the query is run, and scans
+    of tables whose columns are compared to constants in the query. The
+    latter are found with a simple, textual analysis of the query, so the
+    suggestions are hints rather than guarantees.
+    """
+    quote = SQLite3CSVImporter.quote_identifier
+    identifier = r'(?:\w+|"(?:[^"]|"")+"|`[^`]+`|\[[^\]]+\])'
+
+    def unquote(name):
+        if name[0] in "\"`[":
+            return name[1:-1].replace('""', '"')
+        return name
+
+    tables = dict(
+        (name.lower(), name) for (name, ) in cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"))
+
+    # Map the names used in the plan, which are aliases when the query has
+    # them, to tables.
+    aliases = dict((name, tables[name]) for name in tables)
+    keywords = set(("on", "using", "where", "group", "order", "limit",
+                    "join", "inner", "left", "right", "full", "cross",
+                    "natural", "outer", "union", "except", "intersect",
+                    "window", "having", "indexed", "not"))
+    pattern = r"(?:\bFROM|\bJOIN|,)\s*(%s)(?:\s+(?:AS\s+)?(%s))?" % (
+        identifier, identifier)
+    for match in re.finditer(pattern, query, re.IGNORECASE):
+        table = unquote(match.group(1)).lower()
+        alias = match.group(2)
+        if table in tables and alias and alias.lower() not in keywords:
+            aliases[unquote(alias).lower()] = tables[table]
+
+    # Columns compared to literals or parameters
+    operators = r"(==?|<=?|>=?|\bIN\s*\(|\bBETWEEN\b|\bLIKE\b|\bGLOB\b)"
+    pattern = r"(?:(%s)\s*\.\s*)?(%s)\s*%s\s*(?:'|\?|:|@|\$|[-+]?\.?[0-9])" % (
+        identifier, identifier, operators)
+    comparisons = list()
+    for match in re.finditer(pattern, query, re.IGNORECASE):
+        qualifier = match.group(1) and unquote(match.group(1)).lower()
+        equality = match.group(3).strip()[:2].upper() in ("=", "==", "IN")
+        comparisons.append((qualifier, unquote(match.group(2)), equality))
+
+    suggestions = list()
+    for _, _, detail in plan:
+        match = re.match(r"(SCAN|SEARCH)(?: TABLE)? (\S+)(.*)", detail)
+        if not match or match.group(2).lower() not in aliases:
+            continue
+
+        name = match.group(2).lower()
+        table = aliases[name]
+        automatic = re.search(r"USING AUTOMATIC .*INDEX \((.*)\)",
+                              match.group(3))
+
+        if automatic:
+            columns = [re.split("[=<>]", term)[0]
+                       for term in automatic.group(1).split(" AND ")]
+
+        elif match.group(1) == "SCAN" and not match.group(3).strip():
+            known = dict(
+                (row[1].lower(), row[1]) for row in
+                cursor.execute("PRAGMA table_info(%s)" % quote(table)))
+            equalities = list()
+            ranges = list()
+            for qualifier, column, equality in comparisons:
+                if qualifier not in (None, name, table.lower()):
+                    continue
+                column = known.get(column.lower())
+                if column and column not in equalities + ranges:
+                    (equalities if equality else ranges).append(column)
+
+            columns = equalities + ranges[:1]
+
+        else:
+            continue
+
+        if not columns:
+            continue
+
+        # Skip indexes that already exist
+        existing = list()
+        for row in cursor.execute("PRAGMA index_list(%s)" % quote(table)):
+            existing.append([info[2] for info in cursor.execute(
+                "PRAGMA index_info(%s)" % quote(row[1]))])
+
+        if any(index[:len(columns)] == columns for index in existing):
+            continue
+
+        statement = SQLite3CSVImporter.index_statement(table, columns)
+        if statement not in suggestions:
+            suggestions.append(statement)
+
+    return suggestions
+
+
+def sqlite3_repl(connection, input_function=None, dest=None, window=1000,
+                 spool=False, profiler=None, lazy=None, transaction_size=1000,
+                 stop_on_error=False, result_cache=None):
     """
     Interactive REPL loop for SQLite3 designed to emulate the MySQL CLI
     REPL. Ctrl+C clears the current line buffer, and Ctrl+D exits the loop.
     When an incomplete query spans multiple lines, the prompt will change
     to provide a hint to the user about what token is missing to terminate
-    the query. This function accepts a SQLite3 connection instance.
-    """
-    try:
-        clock = time.monotonic
-    except AttributeError:
-        clock = time.time
+    the query. This function accepts a SQLite3 connection instance. Results
+    are printed as they are fetched; the `window` and `spool` parameters are
+    passed to `pretty_print_table`.
 
+    Lines starting with a "." are commands for the REPL itself; ".help" lists
+    them. The ".explain" command shows the plan of a query along with indexes
+    that would speed it up, and ".index" creates those indexes. When the
+    `profiler` is enabled, which can be toggled with the
+    ".timing" command, the time spent executing each statement, fetching its
+    results and rendering them is reported after the results.
+
+    When `lazy` is a `LazyTables` instance, the pending tables each statement
+    uses are materialized before it is executed. The ".read" command runs a
+    script with `execute_script` using the `transaction_size` and
+    `stop_on_error` settings. Statements are executed through `result_cache`
+    when it is given, and results restored from the cache are reported as
+    such.
+    """
     if not input_function:
         input_function = input if PYTHON_3 else raw_input
 
+    if profiler is None:
+        profiler = Profiler()
+
+    def help_command(argument):
+        return "\n".join(".%-20s %s" % (name + " " + commands[name][1],
+                                         commands[name][2])
+                         for name in sorted(commands))
+
+    def timing_command(argument):
+        if argument in ("on", "off"):
+            profiler.enabled = argument == "on"
+        elif argument:
+            return "Usage: .timing [on|off]"
+        else:
+            profiler.enabled = not profiler.enabled
+
+        return "Timing is %s" % ("on" if profiler.enabled else "off")
+
+    def explain_command(argument):
+        query = re.sub(r"[;\s]+$", "", argument)
+        if not query:
+            return "Usage: .explain QUERY"
+
+        plan = explain_query_plan(cursor, query)
+        lines = [format_query_plan(plan)]
+        suggestions = suggest_indexes(cursor, query, plan)
+        if suggestions:
+            lines.append("\nSuggested indexes:")
+            lines.extend("  %s;" % statement for statement in suggestions)
+            lines.append('Use ".index QUERY" to create them.')
+
+        return "\n".join(lines)
+
+    def index_command(argument):
+        query = re.sub(r"[;\s]+$", "", argument)
+        if not query:
+            return "Usage: .index QUERY"
+
+        suggestions = suggest_indexes(cursor, query,
+                                      explain_query_plan(cursor, query))
+        for statement in suggestions:
+            print(statement + ";", file=dest)
+            cursor.execute(statement)
+
+        n = len(suggestions)
+        return "Query OK, %d index%s created" % (n, "" if n == 1 else "es")
+
+    def read_command(argument):
+        if not argument:
+            return "Usage: .read FILE"
+
+        def results(cursor):
+            headers = [d[0] for d in cursor.description]
+            rows = itertools.chain([headers], fetch_rows(cursor))
+            pretty_print_table(rows, dest=dest, window=window, spool=spool)
+
+        start = clock()
+        try:
+            with io.open(argument) as iostream:
+                executed, failed = execute_script(connection, iostream,
+                    transaction_size=transaction_size,
+                    stop_on_error=stop_on_error, results=results, lazy=lazy,
+                    cache=result_cache)
+        except EnvironmentError as exc:
+            return "%s" % exc
+
+        return "Script OK, %d statement%s executed, %d failed (%0.2f sec)" % (
+            executed, "" if executed == 1 else "s", failed, clock() - start)
+
+    commands = {
+        "explain": (explain_command, "QUERY",
+                    "Show the query plan and suggest indexes."),
+        "help": (help_command, "", "Show this list of commands."),
+        "index": (index_command, "QUERY",
+                  "Create the indexes suggested for a query."),
+        "read": (read_command, "FILE", "Execute the statements in a file."),
+        "timing": (timing_command, "[on|off]",
+                   "Report execute, fetch and render times of statements."),
+    }
+
     linebuffer = ""
+    splitter = QuerySplitter()
     original_connection_isolation_level = connection.isolation_level
     connection.isolation_level = None
     cursor = connection.cursor()
     while True:
         prompt = "sqlite> "
-        if linebuffer.strip():
-            for query in query_split(linebuffer):
+        if (not splitter.pending.strip() and
+                linebuffer.lstrip().startswith(".")):
+            name, _, argument = linebuffer.strip().partition(" ")
+            if name[1:] in commands:
+                try:
+                    text = commands[name[1:]][0](argument.strip())
+                except sqlite3.Error as exc:
+                    text = "%s" % exc
+            else:
+                text = ('Unknown command "%s"; enter ".help" for a list of '
+                        'commands' % (name, ))
+
+            print(text, end="\n\n", file=dest)
+            linebuffer = ""
+
+        elif linebuffer:
+            for query in splitter.feed(linebuffer):
                 params = tuple()
-                if sqlite3.complete_statement(query):
-                    try:
-                        query, params = metaquery_conversion(query, params)
+                measurement = None
+                try:
+                    query, params = metaquery_conversion(query, params)
+                    if lazy:
+                        lazy.materialize(query, params)
 
-                        start = clock()
+                    start = clock()
+                    if result_cache:
+                        results = result_cache.execute(cursor, query, params)
+                    else:
                         results = cursor.execute(query, params)
-                        duration = clock() - start
-
-                        if cursor.rowcount > -1:
-                            n = cursor.rowcount
-                            s = "" if n == 1 else "s"
-                            prefix = "Query OK, %d row%s affected" % (n, s)
-
-                        elif cursor.description:
-                            results = list(results)
-                            n = len(results)
-                            s = "" if n == 1 else "s"
-                            prefix = "%d row%s in set" % (n, s)
-
-                            headers = [d[0] for d in cursor.description]
-                            tbl = [headers] + results
-                            pretty_print_table(tbl, dest=dest)
-
-                        else:
-                            prefix = "Query OK, but no data returned"
-
-                        if duration >= 0:
-                            text = "%s (%0.2f sec)" % (prefix, duration)
-                        else:
-                            text = "%s (execution time unknown)" % (prefix,)
-
-                    except sqlite3.Error as exc:
-                        text = "%s" % exc
-
-                    print(text, end="\n\n", file=dest)
-                    linebuffer = ""
-
-                elif query:
-                    linebuffer = query
-                    # Figure out what token is needed to complete the query and
-                    # adjust the prompt accordingly.
-                    terminators = (";", '"', "'", "`", '\\"', "\\'", "\\`")
-                    for chars in terminators:
-                        if sqlite3.complete_statement(query + chars + ";"):
-                            prompt = "     " + chars[-1] + "> "
-                            break
+                    duration = clock() - start
+
+                    if results.rowcount > -1:
+                        n = results.rowcount
+                        s = "" if n == 1 else "s"
+                        prefix = "Query OK, %d row%s affected" % (n, s)
+                        measurement = {"rows": n}
+
+                    elif results.description:
+                        headers = [d[0] for d in results.description]
+                        timed = TimedCursor(results)
+                        rows = fetch_rows(timed)
+                        tbl = itertools.chain([headers], rows)
+                        start = clock()
+                        n = pretty_print_table(tbl, dest=dest,
+                            window=window, spool=spool) - 1
+                        s = "" if n == 1 else "s"
+                        prefix = "%d row%s in set" % (n, s)
+                        if getattr(results, "cached", False):
+                            prefix += " from cache"
+                        measurement = {
+                            "rows": n,
+                            "fetch": timed.elapsed,
+                            "render": clock() - start - timed.elapsed,
+                        }
+
+                    else:
+                        prefix = "Query OK, but no data returned"
+                        measurement = {"rows": 0}
+
+                    if duration >= 0:
+                        text = "%s (%0.2f sec)" % (prefix, duration)
                     else:
-                        prompt = "     -> "
+                        text = "%s (execution time unknown)" % (prefix,)
+
+                except sqlite3.Error as exc:
+                    text = "%s" % exc
+
+                print(text, file=dest)
+                if measurement is not None:
+                    profiler.report("query", dest=dest, sql=query,
+                                    execute=duration, **measurement)
+
+                print(file=dest)
+
+            linebuffer = ""
+            if splitter.pending.strip():
+                # Hint at what token is needed to complete the query.
+                prompt = "     %s> " % (splitter.terminator() or "-")
 
         try:
             linebuffer += input_function(prompt) + "\n"
@@ -514,6 +4201,7 @@ def sqlite3_repl(connection, input_function=None, dest=None):
         except KeyboardInterrupt:
             # ^C to reset the line buffer
             linebuffer = ""
+            splitter = QuerySplitter()
             print("\n", end="", file=dest)
 
 
@@ -537,11 +4225,19 @@ def cli(argv, dest=None):
                             as the table name; loading a file with "-A" will
                             populate the table "A". Similarly, the table schema
                             will be auto-detected when no "--schema" option
-                            immediately precedes this option.
+                            immediately precedes this option. When FILE is
+                            "-", the data is read from standard input. Files
+                            compressed with gzip, bzip2, xz or zstd (when the
+                            zstandard module is installed) are decompressed
+                            automatically.
 
      --table=TABLE          Name of table used to store the contents of the
                             next specified CSV file.
 
+     --index=TABLE:COLUMNS  Create an index on the comma-separated COLUMNS of
+                            TABLE once all of the files loaded into TABLE have
+                            been imported. Can be used repeatedly.
+
      --invalid=METHOD       Determines how rows of invalid data handled. The
                             METHOD can be "warn", "ignore", or "fail" which
                             will cause the script to emit a warning and skip
@@ -549,6 +4245,122 @@ def cli(argv, dest=None):
                             script execution respectively. When unspecified,
                             defaults to "warn."
 
+     --batch-size=ROWS      Number of rows inserted into the database at a
+                            time while importing files. When unspecified,
+                            defaults to 1000. Setting this to 1 will cause
+                            rows to be inserted individually.
+
+     --import-profile=NAME  Database settings used while importing files. The
+                            "default" profile leaves the settings untouched
+                            while the "bulk" profile disables journaling and
+                            synchronous writes and enlarges the page cache for
+                            faster imports; the original settings are restored
+                            once all files have been loaded. When unspecified,
+                            defaults to "default."
+
+     --sampling=METHOD      Determines which records are used to detect the
+                            types of each column. The METHOD can be "head",
+                            "reservoir" or "full" which will use the first
+                            records of each file, records chosen at random from
+                            the whole file or every record in the file
+                            respectively. The latter two methods read each file
+                            twice, copying unseekable input to a temporary file
+                            as it is read. When unspecified, defaults to
+                            "head."
+
+     --sample-size=N        Number of records used to detect column types when
+                            the sampling method is "head" or "reservoir". When
+                            unspecified, defaults to 20.
+
+     --parser=PARSER        Determines how records are split into fields. With
+                            "auto", lines that contain no quote or escape
+                            characters are split on the delimiter directly and
+                            other lines are parsed by Python's csv module.
+                            With "csv", the csv module parses every line. When
+                            unspecified, defaults to "auto."
+
+     --lazy                 Only import each file once a query uses its table.
+                            Tables are created from the detected schema right
+                            away, but files whose tables are never queried are
+                            never imported.
+
+     --typed-values         Convert values to the storage class of their
+                            column's type before inserting them instead of
+                            relying on SQLite's type affinity. Numbers with
+                            leading zeros are never converted, so columns
+                            containing them are detected as TEXT. Rows with
+                            values that cannot be converted are handled like
+                            any other invalid data.
+
+     --reject-file=FILE     Write rows of invalid data to FILE as CSV records
+                            containing the name of the file the row came from,
+                            its line number, the error class, the error message
+                            and the fields of the row.
+
+     --max-rejects=LIMIT    Abort the import of a file once more than LIMIT
+                            rows have been rejected. When LIMIT ends with "%",
+                            the import is aborted once more than that
+                            percentage of the rows processed so far has been
+                            rejected, which is checked after the first 1000
+                            rows. The rows already imported from the file are
+                            discarded unless the "bulk" import profile is
+                            used, in which case the table may keep some of them
+                            or be corrupted since the rollback journal is
+                            disabled.
+
+     --shard-by=COLUMN      Partition the rows of every file across several
+                            shards by the value of COLUMN and create a view
+                            that combines the shards under the name of the
+                            table. Rows are split by the CRC-32 checksum of the
+                            value unless "--shard-bounds" is specified.
+
+     --shards=N             Number of shards rows are split into by checksum.
+                            When unspecified, defaults to 4.
+
+     --shard-bounds=VALUES  Split rows by range using the comma-separated,
+                            sorted VALUES as the lower bounds of every shard
+                            but the first.
+
+     --shard-dir=DIR        Store each shard in its own database file in DIR
+                            instead of in a table of the database. The files
+                            are written concurrently and attached to the
+                            database, and the view combining them is temporary.
+                            Since SQLite allows at most 10 attached databases,
+                            the number of shards times the number of files
+                            cannot exceed 10. Existing shard databases are only
+                            replaced when the database is in memory.
+
+     --threaded-decompression
+                            Decompress compressed files in a separate thread so
+                            decompression overlaps with importing the data.
+
+     --incremental          Only import records appended to each file since it
+                            was last loaded into the same table of the
+                            database. If a file shrank or its first line
+                            changed, the table is dropped and reloaded.
+
+     --import-workers=N     Number of files parsed concurrently while importing
+                            data. Parsed rows are still written to the database
+                            by a single connection in the order the files were
+                            specified. When unspecified, defaults to 1.
+
+     --cache-dir=DIR        Directory used to cache imported files. When a file
+                            is imported again without having changed, its data
+                            is copied from the cache instead of being parsed.
+                            Defaults to the value of the SWADR_CACHE_DIR
+                            environment variable; when neither is set, the
+                            cache is not used.
+
+     --cache-size=BYTES     Maximum total size of the import cache. The least
+                            recently used entries are removed when the cache
+                            grows larger than this. When unspecified, defaults
+                            to 1073741824 (1 GiB).
+
+     --refresh-cache        Import every file even when it is in the cache and
+                            replace the cached copies.
+
+     --no-cache             Do not use the import cache.
+
      --loglevel=LEVEL       Set logging verbosity level. In order from the
                             highest verbosity to the lowest verbosity, can be
                             one of "DEBUG", "INFO", "WARNING", "ERROR",
@@ -558,6 +4370,77 @@ def cli(argv, dest=None):
                             line arguments instead of tab-separating the
                             results.
 
+     --output-format=FORMAT Format of the results of queries passed as command
+                            line arguments. The FORMAT can be "tsv", "pretty",
+                            "csv", "jsonl" or "columnar" which will write tab-
+                            separated values, tables like those in interactive
+                            mode, CSV with a header, one JSON object per row or
+                            an Apache Arrow IPC stream (a stream of JSON blocks
+                            readable by swadr.read_columnar when pyarrow is not
+                            installed) respectively. Columnar output can only
+                            hold the results of a single query. When
+                            unspecified, defaults to "tsv."
+
+     --pretty-window=ROWS   Number of rows used to determine the width of each
+                            column when pretty-printing results. Rows after
+                            these are printed as they are fetched, and columns
+                            are widened as needed. When unspecified, defaults
+                            to 1000.
+
+     --pretty-spool         Write pretty-printed results to a temporary file
+                            first so the column widths can be computed from
+                            every row without holding them in memory.
+
+     --flush-size=CHARS     Amount of query output collected in memory before
+                            it is written out. When unspecified, defaults to
+                            65536.
+
+     --buffer-stdout        Fully buffer standard output when it is not a
+                            terminal instead of writing it line by line.
+
+     --timing               Report how long it takes to detect the dialect and
+                            column types of each file, to insert its rows and
+                            to execute each query, fetch its results and print
+                            them. Timings are printed to standard error, or
+                            after the results in interactive mode where they
+                            can also be toggled with ".timing".
+
+     --timing-log=FILE      Append the timings of every import and query to
+                            FILE as JSON objects, one per line.
+
+     --file=SCRIPT          Execute the SQL statements in SCRIPT after the data
+                            has been imported and before any queries passed as
+                            arguments. When SCRIPT is "-", the statements are
+                            read from standard input. This option may be given
+                            more than once.
+
+     --transaction-size=N   Number of statements from scripts executed in each
+                            transaction. Statements are committed one at a time
+                            when N is 1 or less. When unspecified, defaults to
+                            1000.
+
+     --stop-on-error        Stop executing a script when one of its statements
+                            fails instead of logging the error and continuing.
+
+     --result-cache         Store the results of queries in the database and
+                            reuse them when the same query is run again and the
+                            tables it reads have not changed since.
+
+     --result-cache-size=BYTES
+                            Maximum total size of the cached results. The least
+                            recently used results are removed when the cache
+                            grows larger than this. When unspecified, defaults
+                            to 67108864 (64 MiB).
+
+     --query-workers=N      Number of queries passed as arguments executed
+                            concurrently, each by its own read-only connection
+                            to the database, when a "--database" is specified.
+                            Results are still printed in the order the queries
+                            were given. Queries are executed one at a time when
+                            any of them modifies the database, uses temporary
+                            tables or when the result cache is enabled. When
+                            unspecified, defaults to 1.
+
      --database=FILE        Path of the SQLite3 database the queries should be
                             executed on. When unspecified, the data is stored
                             volatile memory and becomes inaccessible after the
@@ -579,7 +4462,17 @@ def cli(argv, dest=None):
         letters = string.uppercase
 
     colopts = ":".join(letters) + ":hvqi"
-    longopts = ["table=", "invalid=", "help", "pretty", "database="]
+    longopts = ["table=", "invalid=", "help", "pretty", "database=",
+        "batch-size=", "import-profile=", "import-workers=",
+        "sampling=", "sample-size=", "threaded-decompression",
+        "cache-dir=", "cache-size=", "refresh-cache", "no-cache",
+        "incremental", "pretty-window=", "pretty-spool",
+        "flush-size=", "buffer-stdout",
+        "output-format=", "timing", "timing-log=", "index=", "parser=",
+        "typed-values", "reject-file=", "max-rejects=", "lazy",
+        "file=", "transaction-size=", "stop-on-error", "result-cache",
+        "result-cache-size=", "query-workers=", "shard-by=", "shards=",
+        "shard-bounds=", "shard-dir="]
     options, arguments = getopt.gnu_getopt(argv[1:], colopts, longopts)
 
     if not argv[1:] or ("--help", "") in options or ("-h", "") in options:
@@ -592,8 +4485,30 @@ def cli(argv, dest=None):
     loglevel = loglevels.index("WARNING")
 
     database = None
-    prettify = False
+    output_format = "tsv"
+    pretty_window = 1000
+    flush_size = OUTPUT_FLUSH_SIZE
+    buffer_stdout = False
+    timing = False
+    timing_log = None
+    reject_path = None
+    lazy = False
+    scripts = list()
+    transaction_size = 1000
+    stop_on_error = False
+    use_result_cache = False
+    result_cache_size = 64 << 20
+    query_workers = 1
+    shard_column = None
+    shard_count = 4
+    shard_bounds = None
+    shard_directory = None
+    pretty_spool = False
     interact = False
+    import_workers = 1
+    cache_directory = os.environ.get("SWADR_CACHE_DIR")
+    cache_size = 1 << 30
+    refresh_cache = False
     table = None
     loadfile_args = list()
     importer_kwargs = dict()
@@ -611,6 +4526,121 @@ def cli(argv, dest=None):
             elif option == "--table":
                 table = value
 
+            elif option == "--index":
+                tablename, _, columns = value.partition(":")
+                columns = [column.strip() for column in columns.split(",")]
+                if not tablename or not all(columns):
+                    raise getopt.GetoptError("Invalid index '%s'" % value)
+
+                importer_kwargs.setdefault("indexes", dict())
+                importer_kwargs["indexes"].setdefault(tablename, list())
+                importer_kwargs["indexes"][tablename].append(columns)
+
+            elif option == "--batch-size":
+                try:
+                    importer_kwargs["batch_size"] = int(value)
+                except ValueError:
+                    raise getopt.GetoptError("Invalid batch size '%s'" % value)
+
+                if importer_kwargs["batch_size"] < 1:
+                    raise getopt.GetoptError("Batch size must be positive")
+
+            elif option == "--import-profile":
+                if value not in SQLite3CSVImporter.import_profiles:
+                    raise getopt.GetoptError("Invalid import profile")
+
+                importer_kwargs["import_profile"] = value
+
+            elif option == "--sampling":
+                if value not in SQLite3CSVImporter.sampling_methods:
+                    raise getopt.GetoptError("Invalid sampling method")
+
+                importer_kwargs["sampling"] = value
+
+            elif option == "--sample-size":
+                try:
+                    importer_kwargs["sample_size"] = int(value)
+                except ValueError:
+                    raise getopt.GetoptError("Invalid sample size")
+
+                if importer_kwargs["sample_size"] < 2:
+                    raise getopt.GetoptError("Sample size must be at least 2")
+
+            elif option == "--parser":
+                if value not in SQLite3CSVImporter.parsers:
+                    raise getopt.GetoptError("Invalid parser")
+
+                importer_kwargs["parser"] = value
+
+            elif option == "--typed-values":
+                importer_kwargs["typed_values"] = True
+
+            elif option == "--lazy":
+                lazy = True
+
+            elif option == "--reject-file":
+                reject_path = value
+
+            elif option == "--max-rejects":
+                try:
+                    if value.endswith("%"):
+                        limit = float(value[:-1]) / 100
+                        importer_kwargs["max_reject_rate"] = limit
+                    else:
+                        limit = int(value)
+                        importer_kwargs["max_rejects"] = limit
+                except ValueError:
+                    raise getopt.GetoptError("Invalid reject limit")
+
+                if limit < 0:
+                    raise getopt.GetoptError("Reject limit cannot be negative")
+
+            elif option == "--shard-by":
+                shard_column = value
+
+            elif option == "--shards":
+                try:
+                    shard_count = int(value)
+                except ValueError:
+                    raise getopt.GetoptError("Invalid number of shards")
+
+                if shard_count < 1:
+                    raise getopt.GetoptError("Number of shards must be "
+                                             "positive")
+
+            elif option == "--shard-bounds":
+                shard_bounds = value.split(",")
+
+            elif option == "--shard-dir":
+                shard_directory = value
+
+            elif option == "--threaded-decompression":
+                importer_kwargs["threaded_decompression"] = True
+
+            elif option == "--incremental":
+                importer_kwargs["incremental"] = True
+
+            elif option == "--import-workers":
+                try:
+                    import_workers = int(value)
+                except ValueError:
+                    raise getopt.GetoptError("Invalid worker count")
+
+            elif option == "--cache-dir":
+                cache_directory = value
+
+            elif option == "--cache-size":
+                try:
+                    cache_size = int(value)
+                except ValueError:
+                    raise getopt.GetoptError("Invalid cache size")
+
+            elif option == "--refresh-cache":
+                refresh_cache = True
+
+            elif option == "--no-cache":
+                cache_directory = None
+
             elif option == "--loglevel":
                 try:
                     loglevel = loglevels.index(value.upper())
@@ -618,7 +4648,70 @@ def cli(argv, dest=None):
                     raise getopt.GetoptError("Invalid log level '%s'" % value)
 
             elif option == "--pretty":
-                prettify = True
+                output_format = "pretty"
+
+            elif option == "--output-format":
+                if value not in OUTPUT_FORMATS:
+                    raise getopt.GetoptError("Invalid output format")
+
+                output_format = value
+
+            elif option == "--pretty-window":
+                try:
+                    pretty_window = int(value)
+                except ValueError:
+                    raise getopt.GetoptError("Invalid window size")
+
+                if pretty_window < 1:
+                    raise getopt.GetoptError("Window size must be positive")
+
+            elif option == "--pretty-spool":
+                pretty_spool = True
+
+            elif option == "--flush-size":
+                try:
+                    flush_size = int(value)
+                except ValueError:
+                    raise getopt.GetoptError("Invalid flush size")
+
+            elif option == "--buffer-stdout":
+                buffer_stdout = True
+
+            elif option == "--timing":
+                timing = True
+
+            elif option == "--timing-log":
+                timing_log = value
+
+            elif option == "--file":
+                scripts.append(value)
+
+            elif option == "--transaction-size":
+                try:
+                    transaction_size = int(value)
+                except ValueError:
+                    raise getopt.GetoptError("Invalid transaction size")
+
+            elif option == "--stop-on-error":
+                stop_on_error = True
+
+            elif option == "--result-cache":
+                use_result_cache = True
+
+            elif option == "--result-cache-size":
+                try:
+                    result_cache_size = int(value)
+                except ValueError:
+                    raise getopt.GetoptError("Invalid result cache size")
+
+            elif option == "--query-workers":
+                try:
+                    query_workers = int(value)
+                except ValueError:
+                    raise getopt.GetoptError("Invalid worker count")
+
+                if query_workers < 1:
+                    raise getopt.GetoptError("Worker count must be positive")
 
             elif option == "--database":
                 database = value
@@ -641,46 +4734,263 @@ def cli(argv, dest=None):
     if not interact and database is None:
         interact = True
 
+    if shard_column:
+        if importer_kwargs.get("incremental"):
+            raise getopt.GetoptError("Sharded tables cannot be loaded "
+                                     "incrementally")
+        if lazy:
+            raise getopt.GetoptError("Sharded tables cannot be loaded lazily")
+
+        if shard_bounds is not None:
+            shard_count = len(shard_bounds) + 1
+        attached = shard_count * len(loadfile_args)
+        if shard_directory and attached > Sharding.max_attached:
+            raise getopt.GetoptError(
+                "Sharding %d file(s) into %d databases each would attach %d "
+                "databases, more than the %d SQLite allows" %
+                (len(loadfile_args), shard_count, attached,
+                 Sharding.max_attached))
+
+        importer_kwargs["sharding"] = Sharding(shard_column, shard_count,
+                                               bounds=shard_bounds,
+                                               directory=shard_directory)
+    elif shard_bounds or shard_directory:
+        raise getopt.GetoptError("The column used to shard tables must be "
+                                 "specified with --shard-by")
+
+    if output_format == "columnar" and len(arguments) + len(scripts) > 1:
+        raise getopt.GetoptError("Only one query or script can be executed "
+                                 "when the output format is columnar")
+
     loglevel = loglevels[loglevel]
     logging.getLogger().setLevel(getattr(logging, loglevel))
     logging.debug("Log level set to %s.", loglevel)
 
-    connection = sqlite3.connect(database or ":memory:")
-    importer = SQLite3CSVImporter(dbc=connection, **importer_kwargs)
+    stdout = sys.stdout
+    reject_file = None
+    lazy_tables = None
+    try:
+        # Python only line-buffers standard output when it is a terminal, but
+        # the buffer it uses otherwise is small, so it is replaced with a
+        # stream whose buffer holds a whole block of output until `cli`
+        # returns.
+        if buffer_stdout and dest is None and not stdout.isatty():
+            stdout.flush()
+            if PYTHON_3:
+                sys.stdout = io.open(stdout.fileno(), "w",
+                    buffering=max(flush_size, io.DEFAULT_BUFFER_SIZE),
+                    encoding=stdout.encoding, errors=stdout.errors,
+                    closefd=False)
+            else:
+                sys.stdout = os.fdopen(os.dup(stdout.fileno()), "w",
+                    max(flush_size, io.DEFAULT_BUFFER_SIZE))
+
+        if reject_path:
+            if PYTHON_3:
+                reject_file = io.open(reject_path, "w", newline="")
+            else:
+                reject_file = open(reject_path, "wb")
+            importer_kwargs["reject_file"] = reject_file
+
+        connection = sqlite3.connect(database or ":memory:")
+        profiler = Profiler(enabled=timing, log=timing_log)
 
-    for args in loadfile_args:
-        importer.loadfile(*args)
+        # Once a database has been used with the result cache, imports keep the
+        # table versions up to date even when the cache is not being used.
+        versions_table = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = ?",
+            (SQLite3CSVImporter.versions_table, )).fetchone()
+        importer_kwargs["track_versions"] = bool(use_result_cache or
+                                                 versions_table)
+        importer = SQLite3CSVImporter(dbc=connection, profiler=profiler,
+                                      **importer_kwargs)
+        importer.attach_shards()
 
-    cursor = connection.cursor()
-    for query in arguments:
-        if len(arguments) > 1:
-            logging.info("Executing '%s'", query)
-        else:
-            logging.debug("Executing '%s'", query)
+        if loadfile_args:
+            start = clock()
+            if cache_directory and importer.incremental:
+                logging.warning("The import cache is not used in incremental "
+                                "mode")
+                cache_directory = None
+            elif cache_directory and importer.sharding:
+                logging.warning("The import cache is not used for sharded "
+                                "tables")
+                cache_directory = None
+
+            cache = None
+            if cache_directory:
+                cache = ImportCache(cache_directory, max_size=cache_size)
 
-        results = cursor.execute(query)
+            if lazy:
+                lazy_tables = LazyTables(importer, cache=cache,
+                                         workers=import_workers,
+                                         refresh=refresh_cache)
+                for filename, tablename in loadfile_args:
+                    lazy_tables.register(filename, tablename)
+            elif cache:
+                cache.loadfiles(importer, loadfile_args,
+                                workers=import_workers, refresh=refresh_cache)
+            else:
+                importer.loadfiles(loadfile_args, workers=import_workers)
+
+            if not lazy:
+                logging.info("Imported %d file(s) in %0.2f sec (%s import "
+                             "profile)", len(loadfile_args), clock() - start,
+                             importer.import_profile)
+
+        columnar_written = []
+
+        def write_results(cursor):
+            """
+            Write the rows of `cursor` in the selected output format and return
+            the number of rows written.
+            """
+            if output_format == "pretty":
+                count = 0
+                first = cursor.fetchone()
+                if first is not None:
+                    headers = [d[0] for d in cursor.description]
+                    rows = itertools.chain([headers, first],
+                                           fetch_rows(cursor))
+                    count = pretty_print_table(rows, dest=dest,
+                        window=pretty_window, spool=pretty_spool,
+                        flush_size=flush_size) - 1
+
+            elif not cursor.description:
+                count = max(cursor.rowcount, 0)
+
+            elif output_format == "csv":
+                count = write_csv(cursor, dest, flush_size)
+
+            elif output_format == "jsonl":
+                count = write_jsonl(cursor, dest, flush_size)
+
+            elif output_format == "columnar":
+                # A second stream appended to the first could not be read.
+                if columnar_written:
+                    raise ValueError("Columnar output can only contain the "
+                                     "results of one query")
+                columnar_written.append(True)
+                count = write_columnar(cursor, dest)
+
+            else:
+                def printable(var):
+                    """
+                    Return print function-friendly variable.
+                    """
+                    if not PYTHON_3 and isinstance(var, unicode):
+                        return var.encode("utf-8", "replace")
+                    else:
+                        return var
+
+                count = 0
+                output = OutputBuffer(dest, flush_size)
+                for r in fetch_rows(cursor):
+                    columns = ("" if c is None else str(printable(c))
+                               for c in r)
+                    output.write("\t".join(columns) + "\n")
+                    count += 1
+
+                output.flush()
+
+            return count
 
-        if prettify:
-            results = list(results)
-            if results:
-                headers = [d[0] for d in cursor.description]
-                pretty_print_table([headers] + results, dest=dest)
+        result_cache = None
+        if use_result_cache:
+            result_cache = ResultCache(connection, max_size=result_cache_size)
+
+        for script in scripts:
+            logging.info("Executing script %s", script)
+            if script == "-":
+                iostream = sys.stdin
+            else:
+                iostream = io.open(script)
+
+            try:
+                execute_script(connection, iostream,
+                               transaction_size=transaction_size,
+                               stop_on_error=stop_on_error,
+                               results=write_results, lazy=lazy_tables,
+                               cache=result_cache)
+            finally:
+                if iostream is not sys.stdin:
+                    iostream.close()
+
+        parallel = (query_workers > 1 and len(arguments) > 1 and
+                    database not in (None, "", ":memory:") and
+                    not result_cache)
+        if parallel:
+            for query in arguments:
+                if lazy_tables:
+                    lazy_tables.materialize(query)
+
+                if not read_only_query(connection, query):
+                    logging.info("Executing queries one at a time since '%s' "
+                                 "is not read-only", query)
+                    parallel = False
+                    break
+
+        if parallel:
+            logging.info("Executing %d queries with up to %d workers",
+                         len(arguments), query_workers)
+            connection.commit()
+            results = parallel_queries(database, arguments, query_workers)
+            with contextlib.closing(results):
+                for query, (cached, execute, fetch) in zip(arguments, results):
+                    start = clock()
+                    count = write_results(cached)
+                    profiler.report("query", count, sql=query, execute=execute,
+                                    fetch=fetch, render=clock() - start)
         else:
-            def printable(var):
-                """
-                Return print function-friendly variable.
-                """
-                if not PYTHON_3 and isinstance(var, unicode):
-                    return var.encode("utf-8", "replace")
+            cursor = connection.cursor()
+            for query in arguments:
+                if len(arguments) > 1:
+                    logging.info("Executing '%s'", query)
+                else:
+                    logging.debug("Executing '%s'", query)
+
+                if lazy_tables:
+                    lazy_tables.materialize(query)
+
+                start = clock()
+                if result_cache:
+                    results = result_cache.execute(cursor, query)
                 else:
-                    return var
+                    results = cursor.execute(query)
+                executed = clock()
+                timed = TimedCursor(results)
+                count = write_results(timed)
+
+                profiler.report("query", count, sql=query,
+                                execute=executed - start, fetch=timed.elapsed,
+                                render=clock() - executed - timed.elapsed)
+
+        if interact:
+            sqlite3_repl(connection, dest=dest, window=pretty_window,
+                         spool=pretty_spool, profiler=profiler,
+                         lazy=lazy_tables, transaction_size=transaction_size,
+                         stop_on_error=stop_on_error,
+                         result_cache=result_cache)
 
-            for r in results:
-                columns = ("" if c is None else printable(c) for c in r)
-                print(*columns, sep="\t", file=dest)
+        if result_cache:
+            result_cache.close()
 
-    if interact:
-        sqlite3_repl(connection, dest=dest)
+        if dest is None:
+            sys.stdout.flush()
+    finally:
+        # Tables of files that were never imported are dropped even when a
+        # query fails so later runs cannot mistake them for empty tables.
+        if lazy_tables:
+            lazy_tables.close()
+
+        if reject_file:
+            reject_file.close()
+
+        if sys.stdout is not stdout:
+            try:
+                sys.stdout.close()
+            finally:
+                sys.stdout = stdout
 
 
 def main():
@@ -691,6 +5001,9 @@ def main():
     except getopt.GetoptError as exc:
         logging.fatal("Could not parse command line options: %s", exc)
         sys.exit(EXIT_GENERAL_FAILURE)
+    except ValueError as exc:
+        logging.fatal("%s", exc)
+        sys.exit(EXIT_GENERAL_FAILURE)
     except sqlite3.DatabaseError as exc:
         logging.fatal("Error updating database: %s", exc)
         sys.exit(EXIT_DATABASE_ERROR)
@@ -1,10 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import csv
+import getopt
 import io
+import json
 import os
+import random
+import re
+import shutil
 import sqlite3
+import subprocess
 import sys
 import tempfile
+import time
 import unittest
 
 import swadr
@@ -51,6 +59,134 @@ class SQLite3CSVImporterTests(unittest.TestCase):
         finally:
             os.unlink(tmpio.name)
 
+    def test_batched_insert_reports_failed_row(self):
+        dbc = sqlite3.connect(":memory:")
+        importer = swadr.SQLite3CSVImporter(dbc, batch_size=4)
+        # Line 23 is short one column, so the last batch will fail part way
+        # through and the rest of that batch is inserted row by row.
+        file_lines = ["A,B,C\n"] + ["1,2,3\n"] * 21 + ["7,8\n"]
+        file_lines += ["4,5,6\n"] * 4
+        contents = "".join(file_lines).encode("ascii")
+
+        try:
+            tmpio = tempfile.NamedTemporaryFile(delete=False)
+            filename = tmpio.name
+            tmpio.write(contents)
+            tmpio.close()
+            importer.ignore_errors = False
+            try:
+                importer.loadfile(filename, "A")
+                self.fail("Expected sqlite3.Error")
+            except sqlite3.Error as exc:
+                self.assertTrue(str(exc).endswith("row 23) "))
+
+            importer.ignore_errors = True
+            importer.log_warnings = False
+            importer.loadfile(filename, "B")
+        finally:
+            os.unlink(tmpio.name)
+
+        cursor = dbc.cursor()
+        got = list(cursor.execute("SELECT COUNT(*) FROM B"))
+        self.assertEqual(got, [(25, )])
+
+    def test_import_profile_restores_settings(self):
+        directory = tempfile.mkdtemp()
+        database = os.path.join(directory, "test.db")
+        try:
+            dbc = sqlite3.connect(database)
+            importer = swadr.SQLite3CSVImporter(dbc, import_profile="bulk")
+            cursor = dbc.cursor()
+            before = cursor.execute("PRAGMA synchronous").fetchone()
+
+            with importer.pragma_profile():
+                got = cursor.execute("PRAGMA synchronous").fetchone()
+                self.assertEqual(got, (0, ))
+                got = cursor.execute("PRAGMA journal_mode").fetchone()
+                self.assertEqual(got, (unicode("off"), ))
+                importer.loadfile(resource_path("samples", "grades.tsv"), "A")
+
+            after = cursor.execute("PRAGMA synchronous").fetchone()
+            self.assertEqual(after, before)
+            got = cursor.execute("PRAGMA journal_mode").fetchone()
+            self.assertEqual(got, (unicode("delete"), ))
+            got = list(cursor.execute("SELECT COUNT(*) FROM A"))
+            self.assertEqual(got, [(9, )])
+            dbc.close()
+        finally:
+            if os.path.exists(database):
+                os.unlink(database)
+            os.rmdir(directory)
+
+    def test_loadfiles_parallel_matches_sequential(self):
+        files = [
+            (resource_path("samples", "students.csv"), "A"),
+            (resource_path("samples", "grades.tsv"), "B"),
+            (resource_path("samples", "grades-no-header.tsv"), "B"),
+            (resource_path("samples", "grades.tsv"), "C"),
+        ]
+
+        tables = list()
+        for workers in (1, 3):
+            dbc = sqlite3.connect(":memory:")
+            importer = swadr.SQLite3CSVImporter(dbc, batch_size=2)
+            counts = importer.loadfiles(files, workers=workers)
+            self.assertEqual(counts, [3, 9, 9, 9])
+
+            cursor = dbc.cursor()
+            contents = list()
+            for table in ("A", "B", "C"):
+                contents.append(list(cursor.execute("SELECT * FROM " + table)))
+            tables.append(contents)
+
+        self.assertEqual(tables[0], tables[1])
+
+    def test_declared_indexes_created_after_last_load(self):
+        connection = sqlite3.connect(":memory:")
+        importer = swadr.SQLite3CSVImporter(connection,
+            indexes={"students": [["Name"], ("Class", "Age")]})
+        importer.declare_index("Grades", ["Student"])
+        importer.declare_index("grades", ["Student"])
+
+        created = list()
+        create_indexes = importer.create_indexes
+
+        def record(tablename):
+            rows = connection.execute("SELECT COUNT(*) FROM %s" % tablename)
+            created.append((tablename, rows.fetchone()[0]))
+            create_indexes(tablename)
+
+        importer.create_indexes = record
+        students = resource_path("samples", "students.csv")
+        grades = resource_path("samples", "grades.tsv")
+        counts = importer.loadfiles([(students, "students"),
+                                     (grades, "grades"),
+                                     (students, "students")])
+
+        # Indexes are only built once the last file for a table is loaded.
+        self.assertEqual(created, [("grades", counts[1]),
+                                   ("students", counts[0] + counts[2])])
+        indexes = [row[0] for row in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' "
+            "ORDER BY name")]
+        self.assertEqual(indexes, ["grades_Student_idx",
+                                   "students_Class_Age_idx",
+                                   "students_Name_idx"])
+
+    def test_loadfiles_parallel_raises_errors(self):
+        dbc = sqlite3.connect(":memory:")
+        importer = swadr.SQLite3CSVImporter(dbc)
+        files = [
+            (resource_path("samples", "grades.tsv"), "A"),
+            (resource_path("samples", "does-not-exist.tsv"), "B"),
+            (resource_path("samples", "grades.tsv"), "C"),
+        ]
+        self.assertRaises(EnvironmentError, importer.loadfiles, files, 2)
+
+        cursor = dbc.cursor()
+        tables = list(cursor.execute("SELECT name FROM sqlite_master"))
+        self.assertEqual(tables, [(unicode("A"), )])
+
     def test_detect_types(self):
         if swadr.PYTHON_3:
             blob = bytes(range(256)).decode("utf-8", errors="surrogateescape")
@@ -67,6 +203,354 @@ class SQLite3CSVImporterTests(unittest.TestCase):
         expected = ["INTEGER", "TEXT", "REAL", "BLOB"]
         self.assertEqual(got, expected)
 
+    def test_detect_types_ragged_and_empty_columns(self):
+        table = [
+            ["1", "", "x", "4"],
+            ["2", "", "3.5"],
+            ["", "", "7"],
+        ]
+        got = swadr.SQLite3CSVImporter.detect_types(table)
+        self.assertEqual(got, ["INTEGER", "TEXT", "TEXT"])
+        self.assertEqual(swadr.SQLite3CSVImporter.detect_types([]), [])
+
+    def test_detect_types_column_checks_match_row_checks(self):
+        values = ["", "1", "-2", " 3 ", "4.5", "1e3", ".5", "nan", "7\n8",
+                  "inf", "x", "+9", "1_000", unicode("\u0663")]
+        if swadr.PYTHON_3:
+            values.append(b"\xff".decode("utf-8", errors="surrogateescape"))
+
+        importer = swadr.SQLite3CSVImporter
+        rng = random.Random(0)
+        for _ in range(500):
+            table = [[rng.choice(values) for _ in range(6)]
+                     for _ in range(rng.randint(1, 5))]
+            inference = swadr.TypeInference(importer.typemap)
+            for row in table:
+                inference.update(row)
+
+            self.assertEqual(importer.detect_types(table), inference.types())
+
+    def test_loadfile_sampling_methods(self):
+        file_lines = ["A,B\n"] + ["1,2\n"] * 50 + ["3,4.5\n"] * 2
+        contents = "".join(file_lines).encode("ascii")
+        expected = {
+            "head": ["INTEGER", "INTEGER"],
+            "reservoir": ["INTEGER", "REAL"],
+            "full": ["INTEGER", "REAL"],
+        }
+
+        try:
+            tmpio = tempfile.NamedTemporaryFile(delete=False)
+            filename = tmpio.name
+            tmpio.write(contents)
+            tmpio.close()
+            for sampling, types in expected.items():
+                dbc = sqlite3.connect(":memory:")
+                importer = swadr.SQLite3CSVImporter(dbc, sampling=sampling,
+                                                    sample_size=100)
+                if sampling == "head":
+                    importer.sample_size = 20
+                count = importer.loadfile(filename, "A")
+                self.assertEqual(count, 52)
+
+                cursor = dbc.cursor()
+                results = list(cursor.execute("PRAGMA table_info(A)"))
+                self.assertEqual([r[2] for r in results], types)
+                self.assertEqual([r[1] for r in results], ["A", "B"])
+        finally:
+            os.unlink(tmpio.name)
+
+    def test_loadfile_typed_values(self):
+        file_lines = (["A,B,C,D,E\n", "1,1.5,x,007,nan\n"] +
+                      ["1,3,y,1,2.5\n"] * 30 +
+                      ["N/A,2.5,z,2,1\n", ",4,,3,1\n",
+                       "99999999999999999999,5,w,4,1\n", "05,6,v,5,1\n",
+                       "6,inf,u,6,inf\n"])
+        contents = "".join(file_lines).encode("ascii")
+        query = "SELECT typeof(A), typeof(B), typeof(C), COUNT(*) FROM T " \
+                "GROUP BY 1, 2, 3 ORDER BY 4, 1"
+
+        try:
+            tmpio = tempfile.NamedTemporaryFile(delete=False)
+            filename = tmpio.name
+            tmpio.write(contents)
+            tmpio.close()
+
+            dbc = sqlite3.connect(":memory:")
+            importer = swadr.SQLite3CSVImporter(dbc, log_warnings=False,
+                                                typed_values=True)
+            self.assertEqual(importer.loadfile(filename, "T"), 33)
+            self.assertEqual(list(dbc.execute(query)), [
+                ("null", "real", "null", 1),
+                ("real", "real", "text", 1),
+                ("integer", "real", "text", 31),
+            ])
+            self.assertEqual(dbc.execute("SELECT A FROM T WHERE C = 'w'")
+                             .fetchone(), (1e20, ))
+            self.assertEqual(dbc.execute("SELECT D FROM T WHERE C = 'x'")
+                             .fetchone(), ("007", ))
+            self.assertEqual(list(dbc.execute("SELECT DISTINCT typeof(D) "
+                                              "FROM T")), [("text", )])
+            self.assertEqual(dbc.execute("SELECT E FROM T WHERE C = 'x'")
+                             .fetchone(), ("nan", ))
+            self.assertEqual(list(dbc.execute("SELECT DISTINCT typeof(E) "
+                                              "FROM T")), [("text", )])
+            self.assertEqual(dbc.execute("SELECT MIN(A) FROM T").fetchone(),
+                             (1, ))
+
+            importer.ignore_errors = False
+            self.assertRaises(ValueError, importer.loadfile, filename, "T")
+        finally:
+            os.unlink(tmpio.name)
+
+    def test_rejected_rows(self):
+        file_lines = ["A,B\n"] + ["1,2\n"] * 25 + ["N/A,2\n"] * 3 + ["1,2,3\n"]
+        contents = "".join(file_lines).encode("ascii")
+
+        try:
+            tmpio = tempfile.NamedTemporaryFile(delete=False)
+            filename = tmpio.name
+            tmpio.write(contents)
+            tmpio.close()
+
+            dbc = sqlite3.connect(":memory:")
+            reject_file = io.StringIO()
+            importer = swadr.SQLite3CSVImporter(dbc, log_warnings=False,
+                typed_values=True, reject_file=reject_file)
+            self.assertEqual(importer.loadfile(filename, "T"), 25)
+            self.assertEqual(dict(importer.reject_counts),
+                             {"ValueError": 3, "ProgrammingError": 1})
+
+            reject_file.seek(0)
+            rejects = list(csv.reader(reject_file))
+            self.assertEqual([row[:3] for row in rejects], [
+                [filename, "27", "ValueError"],
+                [filename, "28", "ValueError"],
+                [filename, "29", "ValueError"],
+                [filename, "30", "ProgrammingError"],
+            ])
+            self.assertEqual(rejects[0][4:], ["N/A", "2"])
+            self.assertEqual(rejects[3][4:], ["1", "2", "3"])
+
+            # The rows of aborted imports are rolled back.
+            importer.max_rejects = 3
+            self.assertRaises(ValueError, importer.loadfile, filename, "U")
+            count = dbc.execute("SELECT COUNT(*) FROM U")
+            self.assertEqual(count.fetchone(), (0, ))
+
+            importer.max_rejects = None
+            importer.reject_rate_min_rows = 10
+            importer.max_reject_rate = 0.2
+            self.assertEqual(importer.loadfile(filename, "V"), 25)
+            importer.max_reject_rate = 0.1
+            self.assertRaises(ValueError, importer.loadfile, filename, "W")
+        finally:
+            os.unlink(tmpio.name)
+
+    def test_lazy_tables(self):
+        connection = sqlite3.connect(":memory:")
+        importer = swadr.SQLite3CSVImporter(connection)
+        lazy = swadr.LazyTables(importer)
+        students = resource_path("samples", "students.csv")
+        grades = resource_path("samples", "grades.tsv")
+        lazy.register(students, "students")
+        lazy.register(grades, "Grades")
+
+        def count(tablename):
+            query = "SELECT COUNT(*) FROM %s" % tablename
+            return connection.execute(query).fetchone()[0]
+
+        # The tables exist, but nothing has been imported yet.
+        self.assertEqual((count("students"), count("grades")), (0, 0))
+        self.assertEqual(lazy.referenced("SELECT * FROM sqlite_master"), [])
+
+        connection.execute("CREATE VIEW v AS SELECT * FROM grades")
+        self.assertEqual(lazy.materialize("SELECT * FROM V LIMIT 1"),
+                         ["grades"])
+        self.assertEqual(lazy.materialize("SELECT * FROM V LIMIT 1"), [])
+        self.assertEqual(list(lazy.pending), ["students"])
+
+        expected = swadr.SQLite3CSVImporter(sqlite3.connect(":memory:"))
+        self.assertEqual(count("grades"), expected.loadfile(grades, "g"))
+        self.assertEqual(count("students"), 0)
+
+    def test_lazy_tables_do_not_outlive_run(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "lazy.sqlite3")
+        students = resource_path("samples", "students.csv")
+        grades = resource_path("samples", "grades.tsv")
+
+        def tables(connection):
+            query = "SELECT name FROM sqlite_master WHERE type = 'table'"
+            return sorted(row[0] for row in connection.execute(query))
+
+        try:
+            connection = sqlite3.connect(path)
+            lazy = swadr.LazyTables(swadr.SQLite3CSVImporter(connection))
+            lazy.register(students, "students")
+            lazy.register(grades, "grades")
+            lazy.materialize("SELECT * FROM grades")
+            lazy.close()
+            connection.close()
+
+            connection = sqlite3.connect(path)
+            self.assertEqual(tables(connection), ["grades"])
+            connection.close()
+
+            # Tables left behind by a run that did not exit cleanly are
+            # dropped by the next run.
+            connection = sqlite3.connect(path)
+            lazy = swadr.LazyTables(swadr.SQLite3CSVImporter(connection))
+            lazy.register(students, "students")
+            connection.close()
+
+            connection = sqlite3.connect(path)
+            lazy = swadr.LazyTables(swadr.SQLite3CSVImporter(connection))
+            self.assertEqual(tables(connection),
+                             ["grades", lazy.table])
+            lazy.close()
+            self.assertEqual(tables(connection), ["grades"])
+            connection.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_result_cache(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "results.sqlite3")
+        try:
+            connection = sqlite3.connect(path)
+            cursor = connection.cursor()
+            importer = swadr.SQLite3CSVImporter(connection,
+                                                track_versions=True)
+            students = resource_path("samples", "students.csv")
+            importer.loadfile(students, "students")
+            cache = swadr.ResultCache(connection)
+
+            def run(query):
+                results = cache.execute(cursor, query)
+                return getattr(results, "cached", False), results.fetchall()
+
+            query = "SELECT COUNT(*) FROM students"
+            cached, rows = run(query)
+            self.assertFalse(cached)
+            self.assertEqual(run(query), (True, rows))
+            self.assertEqual(run("SELECT  COUNT(*)\nFROM students -- n\n;"),
+                             (True, rows))
+
+            # Imports and statements run through the cache invalidate it.
+            importer.loadfile(students, "students")
+            cached, doubled = run(query)
+            self.assertFalse(cached)
+            self.assertEqual(doubled, [(rows[0][0] * 2, )])
+            run("DELETE FROM students WHERE rowid > %d" % rows[0][0])
+            connection.commit()
+            self.assertEqual(run(query), (False, rows))
+            self.assertEqual(run(query), (True, rows))
+
+            # Changes made by other connections are detected.
+            other = sqlite3.connect(path)
+            with other:
+                other.execute("DELETE FROM students")
+            self.assertEqual(run(query), (False, [(0, )]))
+            other.close()
+
+            self.assertEqual(run("SELECT random() IS NULL")[0], False)
+            self.assertEqual(run("SELECT random() IS NULL")[0], False)
+
+            # Reads from temporary tables are never cached.
+            cursor.execute("CREATE TEMP TABLE t (x)")
+            cursor.execute("INSERT INTO t VALUES (1)")
+            self.assertEqual(run("SELECT x FROM t"), (False, [(1, )]))
+            self.assertEqual(run("SELECT x FROM t"), (False, [(1, )]))
+            cursor.execute("DROP TABLE t")
+
+            # Changes made while no cache was open are detected by the next
+            # cache opened on the database.
+            self.assertEqual(run(query), (True, [(0, )]))
+            cache.close()
+            connection.close()
+            connection = sqlite3.connect(path)
+            cursor = connection.cursor()
+            cache = swadr.ResultCache(connection)
+            self.assertEqual(run(query), (True, [(0, )]))
+            cache.close()
+            connection.close()
+
+            # The state of the cache is stored in the database, so copies of
+            # the database keep their cached results.
+            copy = os.path.join(directory, "copy.sqlite3")
+            shutil.copyfile(path, copy)
+            connection = sqlite3.connect(copy)
+            cursor = connection.cursor()
+            cache = swadr.ResultCache(connection)
+            self.assertEqual(run(query), (True, [(0, )]))
+            connection.close()
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ["copy.sqlite3", "results.sqlite3"])
+
+            other = sqlite3.connect(path)
+            with other:
+                other.execute("INSERT INTO students DEFAULT VALUES")
+            other.close()
+            connection = sqlite3.connect(path)
+            cursor = connection.cursor()
+            cache = swadr.ResultCache(connection)
+            self.assertEqual(run(query), (False, [(1, )]))
+
+            # Values of every storage class survive the round trip, and
+            # entries that cannot be decoded are treated as misses.
+            blobs = "SELECT x'00ff' AS b, 1.5, 2, 'text', NULL"
+            cached, rows = run(blobs)
+            self.assertEqual(run(blobs), (True, rows))
+            connection.execute("UPDATE %s SET result = x'80'" % cache.table)
+            connection.commit()
+            self.assertEqual(run(blobs), (False, rows))
+            self.assertEqual(run(blobs), (True, rows))
+
+            cache.max_size = 0
+            self.assertEqual(run("SELECT 1"), (False, [(1, )]))
+            cache.evict()
+            count = "SELECT COUNT(*) FROM %s" % cache.table
+            self.assertEqual(connection.execute(count).fetchone(), (0, ))
+            connection.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_split_reader_matches_csv_module(self):
+        class EscapedDialect(csv.Dialect):
+            delimiter = "|"
+            quotechar = "'"
+            escapechar = "\\"
+            doublequote = False
+            skipinitialspace = False
+            lineterminator = "\n"
+            quoting = csv.QUOTE_MINIMAL
+
+        def csv_reader(lines, dialect, batch_size=None):
+            for row in csv.reader(lines, dialect):
+                yield [value if value else None for value in row]
+
+        split_reader = swadr.SQLite3CSVImporter.split_reader
+        readers = [(csv_reader, None), (split_reader, 1000),
+                   (split_reader, 2)]
+        rng = random.Random(0)
+        alphabet = ["a", ",", "\t", "|", '"', "'", "\\", "\r\n", "\n", "\r",
+                    " "]
+        for dialect in (csv.excel, csv.excel_tab, EscapedDialect):
+            for _ in range(500):
+                text = "".join(rng.choice(alphabet) for _ in range(20))
+                results = list()
+                for reader, batch_size in readers:
+                    iostream = io.StringIO(unicode(text), newline="")
+                    try:
+                        results.append(list(reader(iostream, dialect,
+                                                   batch_size)))
+                    except csv.Error:
+                        results.append("Error")
+
+                self.assertEqual(results[0], results[1], repr(text))
+                self.assertEqual(results[0], results[2], repr(text))
+
     def test_quote_identifier(self):
         dbc = sqlite3.connect(":memory:")
         with dbc:
@@ -175,6 +659,197 @@ class SQLite3CSVImporterTests(unittest.TestCase):
         got = list(cursor.execute("SELECT * FROM A"))
         self.assertEqual(got, expected)
 
+    def test_loadfile_from_unseekable_stdin(self):
+        script = resource_path("swadr.py")
+        test_file = resource_path("samples", "grades.tsv")
+        for sampling in ("head", "full"):
+            with open(test_file, "rb") as iostream:
+                process = subprocess.Popen(
+                    [sys.executable, script, "--sampling=" + sampling,
+                     "--database=:memory:", "-A", "-",
+                     "SELECT COUNT(*), SUM(Grade) FROM A"],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                stdout, _ = process.communicate(iostream.read())
+
+            self.assertEqual(process.returncode, 0)
+            self.assertEqual(stdout.strip(), "9\t689".encode("ascii"))
+
+    def test_max_rejects_exits_cleanly(self):
+        script = resource_path("swadr.py")
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "data.csv")
+            reject_path = os.path.join(directory, "rejects.csv")
+            with open(filename, "w") as iostream:
+                iostream.write("a,b\n" + "1,2\n" * 25 + "1,N/A\n")
+
+            process = subprocess.Popen(
+                [sys.executable, script, "--database=:memory:",
+                 "--typed-values", "--reject-file=" + reject_path,
+                 "--max-rejects=0",
+                 "-T", filename], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            _, stderr = process.communicate()
+
+            self.assertEqual(process.returncode, swadr.EXIT_GENERAL_FAILURE)
+            self.assertIn(b"more than 0 rows were rejected", stderr)
+            self.assertNotIn(b"Traceback", stderr)
+            with open(reject_path) as iostream:
+                self.assertEqual([row[1] for row in csv.reader(iostream)],
+                                 ["27"])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_loadfile_compressed(self):
+        import bz2
+        import gzip
+        with open(resource_path("samples", "grades.tsv"), "rb") as iostream:
+            contents = iostream.read()
+
+        def gzip_compress(data):
+            buf = io.BytesIO()
+            gzipfile = gzip.GzipFile(fileobj=buf, mode="wb")
+            try:
+                gzipfile.write(data)
+            finally:
+                gzipfile.close()
+            return buf.getvalue()
+
+        def bz2_compress(data):
+            compressor = bz2.BZ2Compressor()
+            return compressor.compress(data) + compressor.flush()
+
+        formats = [name for name, _, _ in
+                   swadr.SQLite3CSVImporter.compression_formats]
+        compressors = [gzip_compress]
+        if "bzip2" in formats:
+            compressors.append(bz2_compress)
+        if "xz" in formats:
+            import lzma
+            compressors.append(lzma.compress)
+
+        for compress in compressors:
+            for threaded in (False, True):
+                try:
+                    tmpio = tempfile.NamedTemporaryFile(delete=False)
+                    tmpio.write(compress(contents))
+                    tmpio.close()
+                    dbc = sqlite3.connect(":memory:")
+                    importer = swadr.SQLite3CSVImporter(
+                        dbc, threaded_decompression=threaded)
+                    self.assertEqual(importer.loadfile(tmpio.name, "A"), 9)
+                finally:
+                    os.unlink(tmpio.name)
+
+                cursor = dbc.cursor()
+                got = list(cursor.execute("SELECT SUM(Grade) FROM A"))
+                self.assertEqual(got, [(689, )])
+
+    def test_loadfile_compressed_from_pipe(self):
+        with open(resource_path("samples", "grades.tsv"), "rb") as iostream:
+            contents = iostream.read()
+
+        buf = io.BytesIO()
+        gzipfile = swadr.gzip.GzipFile(fileobj=buf, mode="wb")
+        gzipfile.write(contents)
+        gzipfile.close()
+        compressed = buf.getvalue()
+
+        # The magic number arrives in separate writes to the pipe.
+        process = subprocess.Popen(
+            [sys.executable, resource_path("swadr.py"), "--database=:memory:",
+             "-A", "-", "SELECT COUNT(*), SUM(Grade) FROM A"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        process.stdin.write(compressed[:1])
+        process.stdin.flush()
+        time.sleep(0.2)
+        stdout, _ = process.communicate(compressed[1:])
+
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual(stdout.strip(), "9\t689".encode("ascii"))
+
+    def test_loadfile_incremental(self):
+        header = "Name\tCount\n"
+        try:
+            tmpio = tempfile.NamedTemporaryFile(delete=False)
+            tmpio.write((header + "a\t1\nb\t2\nc\t").encode("ascii"))
+            tmpio.close()
+
+            dbc = sqlite3.connect(":memory:")
+            importer = swadr.SQLite3CSVImporter(dbc, incremental=True)
+            cursor = dbc.cursor()
+            query = "SELECT * FROM A"
+
+            # The incomplete last line is left for the next import.
+            self.assertEqual(importer.loadfile(tmpio.name, "A"), 2)
+            with open(tmpio.name, "ab") as iostream:
+                iostream.write("3\nd\t4\n".encode("ascii"))
+            self.assertEqual(importer.loadfile(tmpio.name, "A"), 2)
+            self.assertEqual(importer.loadfile(tmpio.name, "A"), 0)
+            got = [tuple(row) for row in cursor.execute(query)]
+            expected = [("a", 1), ("b", 2), ("c", 3), ("d", 4)]
+            self.assertEqual(got, expected)
+
+            # Truncating the file causes a full reload.
+            with open(tmpio.name, "wb") as iostream:
+                iostream.write((header + "e\t5\n").encode("ascii"))
+            self.assertEqual(importer.loadfile(tmpio.name, "A"), 1)
+            got = [tuple(row) for row in cursor.execute(query)]
+            self.assertEqual(got, [("e", 5)])
+        finally:
+            os.unlink(tmpio.name)
+
+    def test_loadfile_incremental_from_stdin(self):
+        script = resource_path("swadr.py")
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "incremental.sqlite3")
+            # Earlier versions saved the state of standard input like that of
+            # any other file, which broke every later run.
+            dbc = sqlite3.connect(path)
+            swadr.SQLite3CSVImporter(dbc, incremental=True).loadfile(
+                resource_path("samples", "grades.tsv"), "A")
+            with dbc:
+                dbc.execute("UPDATE swadr_import_offsets SET path = ?",
+                            (os.path.abspath("-"), ))
+            dbc.close()
+
+            for _ in range(2):
+                with open(resource_path("samples", "grades.tsv")) as stdin:
+                    process = subprocess.Popen(
+                        [sys.executable, script, "--incremental",
+                         "--database=" + path, "-A", "-",
+                         "SELECT COUNT(*) FROM A"],
+                        stdin=stdin, stdout=subprocess.PIPE)
+                    stdout, _ = process.communicate()
+
+                self.assertEqual(process.returncode, 0)
+                self.assertEqual(stdout.strip(), b"9")
+
+            dbc = sqlite3.connect(path)
+            count = dbc.execute("SELECT COUNT(*) FROM swadr_import_offsets")
+            self.assertEqual(count.fetchone(), (0, ))
+            dbc.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_loadfiles_incremental_with_workers(self):
+        files = [(resource_path("samples", "students.csv"), "A"),
+                 (resource_path("samples", "grades.tsv"), "B")]
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "incremental.sqlite3")
+            for expected in ([3, 9], [0, 0], [0, 0]):
+                dbc = sqlite3.connect(path)
+                importer = swadr.SQLite3CSVImporter(dbc, incremental=True)
+                self.assertEqual(importer.loadfiles(files, workers=2),
+                                 expected)
+                count = dbc.execute("SELECT COUNT(*) FROM A").fetchone()
+                self.assertEqual(count, (3, ))
+                dbc.close()
+        finally:
+            shutil.rmtree(directory)
+
     def test_loadfile_header_detection(self):
         dbc = sqlite3.connect(":memory:")
         importer = swadr.SQLite3CSVImporter(dbc)
@@ -198,6 +873,154 @@ class SQLite3CSVImporterTests(unittest.TestCase):
         self.assertEqual(names_with_headers,
                          expected_column_names_with_headers)
 
+    def test_loadfile_sharded(self):
+        lines = ["Id,Name\n"] + ["%d,n%d\n" % (n, n % 5) for n in range(300)]
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "data.csv")
+        try:
+            with open(path, "w") as iostream:
+                iostream.write("".join(lines))
+
+            # Shard tables split by checksum.
+            dbc = sqlite3.connect(":memory:")
+            sharding = swadr.Sharding("name", count=3)
+            importer = swadr.SQLite3CSVImporter(dbc, sharding=sharding,
+                indexes={"A": [("Name", )]})
+            self.assertEqual(importer.loadfile(path, "A"), 300)
+            self.assertEqual(dbc.execute("SELECT COUNT(*), SUM(Id) FROM A")
+                             .fetchone(), (300, 44850))
+            partition = sharding.partitioner("TEXT")
+            for n in range(5):
+                shard = "A_shard_%d" % partition("n%d" % n)
+                count = dbc.execute("SELECT COUNT(*) FROM %s WHERE Name = ?"
+                                    % shard, ("n%d" % n, )).fetchone()
+                self.assertEqual(count, (60, ))
+            indexes = dbc.execute("SELECT COUNT(*) FROM sqlite_master WHERE "
+                                  "type = 'index'").fetchone()
+            self.assertEqual(indexes, (3, ))
+
+            # Shard databases split by range.
+            dbc = sqlite3.connect(":memory:")
+            sharding = swadr.Sharding("Id", bounds=["20", "100"],
+                                      directory=os.path.join(directory, "s"))
+            importer = swadr.SQLite3CSVImporter(dbc, sharding=sharding)
+            self.assertEqual(importer.loadfile(path, "B"), 300)
+            query = 'SELECT COUNT(*), MIN(Id) FROM "B_shard_%d".B'
+            counts = [dbc.execute(query % n).fetchone() for n in range(3)]
+            self.assertEqual(counts, [(20, 0), (80, 20), (200, 100)])
+            self.assertEqual(dbc.execute("SELECT COUNT(*) FROM B").fetchone(),
+                             (300, ))
+            dbc.close()
+
+            # Importing again replaces the shard databases of an in-memory
+            # database, but they are never appended to.
+            for _ in range(2):
+                dbc = sqlite3.connect(":memory:")
+                importer = swadr.SQLite3CSVImporter(dbc, sharding=sharding)
+                self.assertEqual(importer.loadfile(path, "B"), 300)
+                count = dbc.execute("SELECT COUNT(*) FROM B").fetchone()
+                self.assertEqual(count, (300, ))
+                self.assertRaises(ValueError, importer.loadfile, path, "B")
+                dbc.close()
+
+            dbc = sqlite3.connect(os.path.join(directory, "main.sqlite3"))
+            importer = swadr.SQLite3CSVImporter(dbc, sharding=sharding)
+            self.assertRaises(ValueError, importer.loadfile, path, "B")
+            dbc.close()
+
+            # Shard databases of a database stored in a file are attached
+            # again by later connections.
+            main = os.path.join(directory, "persistent.sqlite3")
+            sharding = swadr.Sharding("Id", count=2,
+                                      directory=os.path.join(directory, "u"))
+            dbc = sqlite3.connect(main)
+            importer = swadr.SQLite3CSVImporter(dbc, sharding=sharding)
+            self.assertEqual(importer.loadfile(path, "C"), 300)
+            dbc.close()
+
+            dbc = sqlite3.connect(main)
+            importer = swadr.SQLite3CSVImporter(dbc)
+            self.assertRaises(sqlite3.OperationalError, dbc.execute,
+                              "SELECT COUNT(*) FROM C")
+            self.assertEqual(importer.attach_shards(), ["C"])
+            self.assertEqual(dbc.execute("SELECT COUNT(*), SUM(Id) FROM C")
+                             .fetchone(), (300, 44850))
+            dbc.close()
+
+            sharding = swadr.Sharding("Missing")
+            self.assertRaises(ValueError, sharding.column_index, ["Id", "N"])
+
+            process = subprocess.Popen(
+                [sys.executable, resource_path("swadr.py"),
+                 "--database=:memory:", "--shard-by=Nope", "-A", path],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            _, stderr = process.communicate()
+            self.assertEqual(process.returncode, swadr.EXIT_GENERAL_FAILURE)
+            self.assertIn(b"no column named 'Nope'", stderr)
+            self.assertNotIn(b"Traceback", stderr)
+
+            # The shard databases must fit within SQLite's attach limit.
+            argv = ["_", "--database=:memory:", "--shard-by=Id", "--shards=6",
+                    "--shard-dir=" + os.path.join(directory, "t"), "-A", path,
+                    "-B", path]
+            self.assertRaises(getopt.GetoptError, swadr.cli, argv)
+            self.assertFalse(os.path.exists(os.path.join(directory, "t")))
+        finally:
+            shutil.rmtree(directory)
+
+
+class ImportCacheTests(unittest.TestCase):
+    def test_restore_and_eviction(self):
+        directory = tempfile.mkdtemp()
+        files = [
+            (resource_path("samples", "grades.tsv"), "A"),
+            (resource_path("samples", "students.csv"), "B"),
+            (resource_path("samples", "grades-no-header.tsv"), "A"),
+        ]
+
+        try:
+            cache = swadr.ImportCache(directory)
+            tables = list()
+            for attempt in range(2):
+                dbc = sqlite3.connect(":memory:")
+                importer = swadr.SQLite3CSVImporter(dbc)
+                if attempt:
+                    # Everything should be restored from the cache.
+                    importer.loadfile = None
+                counts = cache.loadfiles(importer, files)
+                self.assertEqual(counts, [9, 3, 9])
+                self.assertEqual(len(os.listdir(directory)), 3)
+
+                cursor = dbc.cursor()
+                contents = list()
+                for table in ("A", "B"):
+                    query = "SELECT * FROM " + table
+                    contents.append(list(cursor.execute(query)))
+                    query = "PRAGMA table_info(%s)" % table
+                    contents.append(list(cursor.execute(query)))
+                tables.append(contents)
+
+            self.assertEqual(tables[0], tables[1])
+
+            # Tables of files without a header are named after the table they
+            # are restored into rather than the one they were cached from.
+            dbc = sqlite3.connect(":memory:")
+            importer = swadr.SQLite3CSVImporter(dbc)
+            importer.loadfile = None
+            cache.loadfiles(importer, [(files[2][0], "C"), (files[0][0], "D")])
+            for table, expected in (("C", "c1"), ("D", "Assignment")):
+                info = dbc.execute("PRAGMA table_info(%s)" % table)
+                self.assertEqual(info.fetchone()[1], expected)
+
+            cache.max_size = 0
+            cache.evict()
+            self.assertEqual(os.listdir(directory), [])
+        finally:
+            for name in os.listdir(directory):
+                os.unlink(os.path.join(directory, name))
+            os.rmdir(directory)
+
 
 class SWADRModuleFunctionTests(unittest.TestCase):
     def test_query_split(self):
@@ -211,6 +1034,133 @@ class SWADRModuleFunctionTests(unittest.TestCase):
         got = list(swadr.query_split(script))
         self.assertEqual(got, expected)
 
+    def test_query_splitter_matches_complete_statement(self):
+        def reference_split(text):
+            segments = re.split("(;)", text)
+            j = 0
+            for k in range(len(segments) + 1):
+                query = "".join(segments[j:k]).strip()
+                if query and sqlite3.complete_statement(query):
+                    yield query
+                    j = k
+
+            if "".join(segments[j:]).strip():
+                yield "".join(segments[j:])
+
+        rng = random.Random(0)
+        alphabet = [";", "'", '"', "`", "[", "]", "--", "\n", "/*", "*/",
+                    "/", "-", " ", "x", "CREATE", "temp", "TRIGGER", "BEGIN",
+                    "END", "explain", "1"]
+        for _ in range(2000):
+            text = " ".join(rng.choice(alphabet) for _ in range(20))
+            expected = list(reference_split(text))
+            self.assertEqual(list(swadr.query_split(text)), expected)
+
+            # Feeding the text in chunks produces the same statements.
+            splitter = swadr.QuerySplitter()
+            queries = list()
+            for start in range(0, len(text), 3):
+                queries.extend(splitter.feed(text[start:start + 3]))
+            if splitter.pending.strip():
+                queries.append(splitter.pending)
+                terminator = splitter.terminator()
+                if terminator:
+                    completed = splitter.pending + terminator + ";"
+                    self.assertTrue(sqlite3.complete_statement(completed))
+
+            self.assertEqual(queries, expected, repr(text))
+
+    def test_execute_script(self):
+        connection = sqlite3.connect(":memory:")
+        statements = list()
+        connection.set_trace_callback(statements.append)
+        script = io.StringIO(unicode(
+            "CREATE TABLE t (x INTEGER PRIMARY KEY);\n"
+            "INSERT INTO t VALUES (1); INSERT INTO t VALUES (1);\n"
+            "INSERT INTO t VALUES (2); INSERT INTO t VALUES (3);\n"
+            "BEGIN; INSERT INTO t VALUES (4); ROLLBACK;\n"
+            "SELECT ';' AS x; SELECT COUNT(*) FROM t"))
+        results = list()
+
+        def collect(cursor):
+            results.extend(cursor.fetchall())
+
+        executed, failed = swadr.execute_script(connection, script,
+            transaction_size=2, results=collect)
+        self.assertEqual((executed, failed), (9, 1))
+        self.assertEqual(results, [(";", ), (3, )])
+        self.assertEqual(statements.count("BEGIN"), 4)
+        self.assertEqual(statements.count("COMMIT"), 4)
+        self.assertEqual(statements.count("BEGIN;"), 1)
+        self.assertFalse(connection.in_transaction)
+
+        script = io.StringIO(unicode("INSERT INTO t VALUES (5);\n"
+                                     "INSERT INTO t VALUES (1);\n"
+                                     "INSERT INTO t VALUES (6);\n"))
+        self.assertRaises(sqlite3.IntegrityError, swadr.execute_script,
+                          connection, script, stop_on_error=True)
+        rows = connection.execute("SELECT x FROM t ORDER BY x").fetchall()
+        self.assertEqual(rows, [(1, ), (2, ), (3, ), (5, )])
+
+    def test_execute_script_non_transactional(self):
+        directory = tempfile.mkdtemp()
+        try:
+            connection = sqlite3.connect(os.path.join(directory, "db"))
+            script = io.StringIO(unicode(
+                "CREATE TABLE t (x); INSERT INTO t VALUES (1);\n"
+                "VACUUM; INSERT INTO t VALUES (2);\n"
+                "PRAGMA journal_mode = WAL; INSERT INTO t VALUES (3);\n"
+                "ATTACH ':memory:' AS other; DETACH other;"))
+            results = list()
+
+            def collect(cursor):
+                results.extend(cursor.fetchall())
+
+            executed, failed = swadr.execute_script(connection, script,
+                transaction_size=1000, stop_on_error=True, results=collect)
+            self.assertEqual((executed, failed), (8, 0))
+            self.assertEqual(results, [("wal", )])
+            rows = connection.execute("SELECT x FROM t ORDER BY x").fetchall()
+            self.assertEqual(rows, [(1, ), (2, ), (3, )])
+            connection.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_parallel_queries(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "parallel.sqlite3")
+        try:
+            connection = sqlite3.connect(path)
+            connection.execute("CREATE TABLE t (x INTEGER)")
+            connection.executemany("INSERT INTO t VALUES (?)",
+                                   [(n, ) for n in range(100)])
+            connection.execute("CREATE TEMP TABLE u (y)")
+            connection.commit()
+
+            for query in ("SELECT x FROM t", "SELECT SUM(x) FROM t"):
+                self.assertTrue(swadr.read_only_query(connection, query))
+            for query in ("DELETE FROM t", "SELECT y FROM u",
+                          "PRAGMA user_version = 1", "SELECT z FROM t"):
+                self.assertFalse(swadr.read_only_query(connection, query))
+
+            queries = ["SELECT COUNT(*) AS n FROM t",
+                       "SELECT x FROM t WHERE x < 3 ORDER BY x",
+                       "SELECT SUM(x) FROM t", "SELECT MAX(x) FROM t"]
+            results = list(swadr.parallel_queries(path, queries, workers=2))
+            self.assertEqual([cursor.fetchall() for cursor, _, _ in results],
+                             [[(100, )], [(0, ), (1, ), (2, )], [(4950, )],
+                              [(99, )]])
+            self.assertEqual(results[0][0].description[0][0], "n")
+
+            results = swadr.parallel_queries(path, ["SELECT * FROM missing"])
+            self.assertRaises(sqlite3.OperationalError, list, results)
+            results = swadr.parallel_queries(path, ["DELETE FROM t"])
+            self.assertRaises(sqlite3.OperationalError, list, results)
+            connection.close()
+        finally:
+            os.unlink(path)
+            os.rmdir(directory)
+
     def test_metaquery_conversion(self):
         # Each entry is (query, number_of_rows_query_should_return).
         tests = [
@@ -438,6 +1388,239 @@ class SWADRModuleFunctionTests(unittest.TestCase):
         txtio.seek(0)
         self.assertEqual(txtio.read(), expected)
 
+    def test_pretty_print_table_streaming(self):
+        table = [["Name", "Count"]] + [["Row %02d" % n, n] for n in range(50)]
+        table.append(["A much wider row", 123456])
+
+        if swadr.PYTHON_3:
+            txtio = io.StringIO()
+        else:
+            txtio = io.BytesIO()
+
+        swadr.pretty_print_table(table, dest=txtio)
+        expected = txtio.getvalue()
+
+        # Results that fit in the window or are spooled look the same as when
+        # the table is printed all at once.
+        for kwargs in ({"window": len(table)}, {"spool": True}):
+            txtio.seek(0)
+            txtio.truncate()
+            rows = iter(table)
+            self.assertEqual(
+                swadr.pretty_print_table(rows, dest=txtio, **kwargs),
+                len(table))
+            self.assertEqual(txtio.getvalue(), expected)
+
+        # Rows after the window are printed as they are read, and columns are
+        # widened when a row does not fit.
+        txtio.seek(0)
+        txtio.truncate()
+        swadr.pretty_print_table(iter(table), dest=txtio, window=10)
+        lines = txtio.getvalue().splitlines()
+        self.assertEqual(lines[1], "| Name   | Count |")
+        self.assertEqual(lines[-4], "| Row 49 |    49 |")
+        self.assertEqual(lines[-3:], [
+            "+------------------+--------+",
+            "| A much wider row | 123456 |",
+            "+------------------+--------+",
+        ])
+
+    def test_textwidth(self):
+        self.assertEqual(swadr.textwidth("Hello\tworld"), 11)
+        self.assertEqual(swadr.textwidth(u""), 0)
+        if swadr.WCWIDTH_SUPPORT:
+            for _ in range(2):
+                self.assertEqual(swadr.textwidth(u"\u65e5\u672c\u8a9e"), 6)
+                self.assertEqual(swadr.textwidth(u"a\U0001f600"), 3)
+
+    def test_buffer_stdout_is_restored(self):
+        stdout = sys.stdout
+        tmpio = tempfile.TemporaryFile(mode="w+")
+        try:
+            sys.stdout = tmpio
+            swadr.cli(["_", "--database=:memory:", "--buffer-stdout",
+                       "SELECT 1"])
+            self.assertIs(sys.stdout, tmpio)
+        finally:
+            sys.stdout = stdout
+
+        tmpio.seek(0)
+        self.assertEqual(tmpio.read(), "1\n")
+        tmpio.close()
+
+    def test_output_buffer_writes_in_blocks(self):
+        class Destination:
+            def __init__(self):
+                self.writes = list()
+
+            def write(self, text):
+                self.writes.append(text)
+
+        dest = Destination()
+        table = [["Column"]] + [["Row %04d" % n] for n in range(1000)]
+        swadr.pretty_print_table(table, dest=dest, flush_size=4096)
+        self.assertEqual(len(dest.writes), 4)
+        self.assertTrue(all(len(text) >= 4096 for text in dest.writes[:-1]))
+
+        if swadr.PYTHON_3:
+            txtio = io.StringIO()
+        else:
+            txtio = io.BytesIO()
+
+        swadr.pretty_print_table(table, dest=txtio)
+        self.assertEqual("".join(dest.writes), txtio.getvalue())
+
+    def test_output_formats(self):
+        connection = sqlite3.connect(":memory:")
+        cursor = connection.cursor()
+        query = "SELECT 1 AS a, 'x,\"y\"' AS b, NULL AS c, 2.5 AS d"
+
+        if swadr.PYTHON_3:
+            txtio = io.StringIO()
+        else:
+            txtio = io.BytesIO()
+
+        cursor.execute(query)
+        self.assertEqual(swadr.write_csv(cursor, txtio), 1)
+        self.assertEqual(txtio.getvalue(), 'a,b,c,d\r\n1,"x,""y""",,2.5\r\n')
+
+        txtio.seek(0)
+        txtio.truncate()
+        cursor.execute(query)
+        self.assertEqual(swadr.write_jsonl(cursor, txtio), 1)
+        self.assertEqual(json.loads(txtio.getvalue()),
+            {"a": 1, "b": 'x,"y"', "c": None, "d": 2.5})
+
+        pyarrow = swadr.pyarrow
+        try:
+            swadr.pyarrow = None
+            binio = io.BytesIO()
+            cursor.execute("SELECT 1 AS a, 'x' AS b UNION ALL "
+                           "SELECT 2.5, NULL UNION ALL SELECT X'00ff', ?",
+                           (u"\u263a", ))
+            self.assertEqual(swadr.write_columnar(cursor, binio), 3)
+        finally:
+            swadr.pyarrow = pyarrow
+
+        self.assertTrue(binio.getvalue().startswith(b"SWADRCOL2\n"))
+        binio.seek(0)
+        names, rows = swadr.read_columnar(binio)
+        self.assertEqual(names, ["a", "b"])
+        self.assertEqual(list(rows),
+            [(1, "x"), (2.5, None), (b"\x00\xff", u"\u263a")])
+
+        # Every result would be a separate stream that could not be read.
+        argv = ["_", "--database=:memory:", "--output-format=columnar",
+                "SELECT 1", "SELECT 2"]
+        self.assertRaises(getopt.GetoptError, swadr.cli, argv)
+        script = tempfile.NamedTemporaryFile(mode="w", delete=False)
+        try:
+            script.write("SELECT 1;\nSELECT 2;\n")
+            script.close()
+            argv = ["_", "--database=:memory:", "--output-format=columnar",
+                    "--file=" + script.name]
+            self.assertRaises(ValueError, swadr.cli, argv, dest=io.BytesIO())
+        finally:
+            os.unlink(script.name)
+
+    @unittest.skipUnless(swadr.pyarrow, "pyarrow is not installed")
+    def test_write_columnar_arrow(self):
+        dbc = sqlite3.connect(":memory:")
+        dbc.execute("CREATE TABLE t (i INTEGER, n, s TEXT, b BLOB)")
+        rows = [(k, None, "s%d" % k, b"x") for k in range(swadr.FETCH_SIZE)]
+        rows.append((2.5, 7, 3, "y"))
+        dbc.executemany("INSERT INTO t VALUES (?, ?, ?, ?)", rows)
+        binio = io.BytesIO()
+        cursor = dbc.execute("SELECT * FROM t")
+        self.assertEqual(swadr.write_columnar(cursor, binio), len(rows))
+        table = swadr.pyarrow.ipc.open_stream(binio.getvalue()).read_all()
+        self.assertEqual([str(kind) for kind in table.schema.types],
+            ["double", "int64", "large_string", "large_binary"])
+        self.assertEqual(table.num_rows, len(rows))
+        self.assertEqual(table.slice(len(rows) - 1).to_pylist(),
+            [{"i": 2.5, "n": 7, "s": "3", "b": b"y"}])
+
+        binio = io.BytesIO()
+        cursor = dbc.execute("SELECT * FROM t WHERE 0")
+        self.assertEqual(swadr.write_columnar(cursor, binio), 0)
+        table = swadr.pyarrow.ipc.open_stream(binio.getvalue()).read_all()
+        self.assertEqual(table.column_names, ["i", "n", "s", "b"])
+        self.assertEqual(table.num_rows, 0)
+
+    def test_repl_timing(self):
+        lines = iter([".timing on", "SELECT 1;", ".timing off", "SELECT 2;",
+                      ".bogus"])
+
+        def input_function(prompt):
+            try:
+                return next(lines)
+            except StopIteration:
+                raise EOFError
+
+        if swadr.PYTHON_3:
+            txtio = io.StringIO()
+        else:
+            txtio = io.BytesIO()
+
+        with tempfile.NamedTemporaryFile(delete=False) as logfile:
+            pass
+
+        try:
+            profiler = swadr.Profiler(log=logfile.name)
+            connection = sqlite3.connect(":memory:")
+            swadr.sqlite3_repl(connection, input_function, dest=txtio,
+                               profiler=profiler)
+            with open(logfile.name) as iostream:
+                records = [json.loads(line) for line in iostream]
+        finally:
+            os.unlink(logfile.name)
+
+        output = txtio.getvalue()
+        self.assertEqual(output.count("Timing: execute"), 1)
+        self.assertIn("Timing is on", output)
+        self.assertIn('Unknown command ".bogus"', output)
+        self.assertEqual([r["sql"] for r in records], ["SELECT 1", "SELECT 2"])
+        for record in records:
+            self.assertEqual(record["event"], "query")
+            self.assertEqual(record["rows"], 1)
+            self.assertTrue(all(record[stage] >= 0
+                                for stage in ("execute", "fetch", "render")))
+
+    def test_query_plan_and_index_suggestions(self):
+        connection = sqlite3.connect(":memory:")
+        cursor = connection.cursor()
+        cursor.execute("CREATE TABLE A (name, class, age)")
+        cursor.execute("CREATE TABLE B (assignment, grade, student)")
+
+        query = ("SELECT name, AVG(grade) FROM A AS a INNER JOIN B ON "
+                 "a.name = student WHERE a.age > 10 GROUP BY student")
+        plan = swadr.explain_query_plan(cursor, query)
+        text = swadr.format_query_plan(plan)
+        self.assertTrue(text.startswith("QUERY PLAN\n|--"))
+        self.assertEqual(len(text.splitlines()), len(plan) + 1)
+
+        self.assertTrue(swadr.suggest_indexes(cursor, query, plan))
+
+        # Creating the suggested indexes changes the plan, which may lead to
+        # more suggestions, but eventually no table is searched with a
+        # temporary index.
+        for _ in range(5):
+            plan = swadr.explain_query_plan(cursor, query)
+            suggestions = swadr.suggest_indexes(cursor, query, plan)
+            if not suggestions:
+                break
+
+            for statement in suggestions:
+                cursor.execute(statement)
+
+        self.assertEqual(suggestions, [])
+        for _, _, detail in plan:
+            self.assertNotIn("AUTOMATIC", detail)
+
+        query = "SELECT * FROM A WHERE rowid = 1"
+        plan = swadr.explain_query_plan(cursor, query)
+        self.assertEqual(swadr.suggest_indexes(cursor, query, plan), [])
+
 
 def resource_path(*args):
     return os.path.join(SCRIPT_DIRECTORY, *args)